@@ -0,0 +1,285 @@
+import argparse
+import asyncio
+import json
+import logging
+import statistics
+import sys
+import time
+from pathlib import Path
+from typing import Callable, Optional
+
+from aiohttp import web
+
+import pixels
+from pixels import diff, discord_mirror, metrics, mock_server, run_for_zone, run_protections, zone
+from pixels.api import APIBase, cmpc, python_discord
+
+
+__version__ = '1.0.0'
+
+
+HOST = 'localhost'
+PORT = 8765
+ZONE_PATH = Path('images/00bibi.json')
+CANVAS_MAX_AGE_SECONDS = 0.5
+
+
+def get_parser() -> argparse.ArgumentParser:
+    """Get this script's parser."""
+    parser = argparse.ArgumentParser(
+        description='run the client against local stand-ins for the apis and report how fast it goes, as json'
+    )
+
+    parser.add_argument('--version', action='version', version=__version__)
+    parser.add_argument('-l', '--latency', type=float, default=0.005, help='seconds per response, default %(default)s')
+    parser.add_argument(
+        '-r', '--ratelimit', type=float, nargs=3, default=[50, 1, 5], metavar=('LIMIT', 'PERIOD', 'COOLDOWN'),
+        help='python discord rate limit per endpoint, default %(default)s'
+    )
+    parser.add_argument('-n', '--requests', type=int, default=100, help='requests per timing run, default %(default)s')
+    parser.add_argument('-z', '--zone', type=Path, default=ZONE_PATH, help='zone to draw, default %(default)s')
+    parser.add_argument('-t', '--timeout', type=float, default=120, help='give up on a scenario after this long')
+    parser.add_argument('-o', '--output', type=Path, help='write the results here instead of stdout')
+    parser.add_argument('-v', '--verbose', action='store_true', help='print the client\'s logs as well')
+
+    return parser
+
+
+class MockServer:
+    """A stand-in api running on the loop in the background."""
+
+    def __init__(self, app: web.Application, port: int = PORT):
+        self.app = app
+        self.port = port
+        self.runner = web.AppRunner(app, access_log=None)
+
+    @property
+    def base_url(self) -> str:
+        return f'http://{HOST}:{self.port}/'
+
+    async def start(self):
+        await self.runner.setup()
+        await web.TCPSite(self.runner, HOST, self.port).start()
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+
+def summarise_latencies(latencies: list[float]) -> dict[str, float]:
+    latencies = sorted(latencies)
+    return {
+        'count': len(latencies),
+        'mean': statistics.fmean(latencies),
+        'p50': latencies[len(latencies) // 2],
+        'p95': latencies[int(len(latencies) * 0.95)],
+        'max': latencies[-1],
+    }
+
+
+async def wait_until(condition: Callable[[], bool], timeout: float, interval: float = 0.05) -> float:
+    """Wait until condition() is true, and return how long it took. Raises TimeoutError if it takes too long."""
+    loop = asyncio.get_event_loop()
+    started_at = loop.time()
+    while not condition():
+        if loop.time() - started_at > timeout:
+            raise asyncio.TimeoutError
+        await asyncio.sleep(interval)
+    return loop.time() - started_at
+
+
+async def bench_fetch(api_instance: APIBase, requests: int, canvas: Optional[mock_server.MockCanvas] = None) -> dict:
+    """Time fetching the whole canvas, changing a pixel on the mock canvas before each fetch if there is one."""
+    latencies = []
+    for i in range(requests):
+        if canvas is not None:
+            canvas.set_pixel(i % canvas.image.width, 0, [i % 256, 0, 0])
+        started_at = time.perf_counter()
+        await api_instance.get_pixels(max_age=0)
+        latencies.append(time.perf_counter() - started_at)
+    return summarise_latencies(latencies)
+
+
+async def bench_reverts(api_instance: APIBase, requests: int, canvas: mock_server.MockCanvas) -> dict:
+    """Set pixels, have the mock canvas undo each one, and count how often fetching again shows it undone.
+
+    Both fetches after the undo are answered as unchanged, the first by its digest and the second with a 304.
+    """
+    seen = [0, 0]
+    for i in range(requests):
+        x, y = i % canvas.image.width, 1 + i // canvas.image.width
+        original = canvas.image.getpixel((x, y))[:3]
+        await api_instance.get_pixels(max_age=0)
+        await api_instance.set_pixel(x, y, [255 - channel for channel in original])
+        canvas.set_pixel(x, y, list(original))
+        for attempt in range(len(seen)):
+            fetched = await api_instance.get_pixels(max_age=0)
+            seen[attempt] += fetched.getpixel((x, y))[:3] == original
+    return {
+        'reverts': requests,
+        'seen_after_digest': seen[0],
+        'seen_after_304': seen[1],
+    }
+
+
+async def bench_set_pixel(api_instance: APIBase, requests: int) -> dict:
+    started_at = time.perf_counter()
+    latencies = []
+    for i in range(requests):
+        request_started_at = time.perf_counter()
+        await api_instance.set_pixel(i % 100, i // 100, [0, 0, 0])
+        latencies.append(time.perf_counter() - request_started_at)
+    duration = time.perf_counter() - started_at
+    return {
+        'pixels_per_second': requests / duration,
+        'latency': summarise_latencies(latencies),
+    }
+
+
+async def bench_convergence(task, canvas: mock_server.MockCanvas, z: zone.Zone, timeout: float) -> dict:
+    """Run a task drawing the zone, and time how long until the mock canvas matches it."""
+    running = asyncio.ensure_future(task)
+    try:
+        duration = await wait_until(lambda: not diff.get_incorrect_pixels(z, canvas.image), timeout)
+        result = {'seconds': duration, 'pixels_per_second': z.area_opaque / duration}
+    except asyncio.TimeoutError:
+        result = {'seconds': None, 'remaining': len(diff.get_incorrect_pixels(z, canvas.image))}
+    running.cancel()
+    try:
+        await running
+    except asyncio.CancelledError:
+        pass
+    return result
+
+
+async def bench_mirror(api_instance: APIBase, canvas: mock_server.MockCanvas, webhook: MockServer) -> dict:
+    """Run the mirror over a canvas that changes for a while and then goes quiet."""
+    webhook_url = webhook.base_url + 'webhook'
+    running = asyncio.ensure_future(discord_mirror.run(
+        0, webhook_url, api_instance, interval=1, change_threshold=50, max_poll_interval=2
+    ))
+    for i in range(100):
+        canvas.set_pixel(i, 0, [0, 0, 0])
+        await asyncio.sleep(0.02)
+    await asyncio.sleep(3)
+    running.cancel()
+    try:
+        await running
+    except asyncio.CancelledError:
+        pass
+
+    uploads = webhook.app['uploads']
+    return {
+        'uploads': len(uploads),
+        'upload_bytes': sum(uploads),
+    }
+
+
+def run_scenario(loop: asyncio.AbstractEventLoop, server: MockServer, make_api, scenario) -> dict:
+    """Start the server, run the scenario against a fresh api, and add the server's stats to the result."""
+    loop.run_until_complete(server.start())
+    api_instance = make_api(server.base_url)
+    try:
+        result = loop.run_until_complete(scenario(api_instance))
+    finally:
+        loop.run_until_complete(api_instance.close())
+        loop.run_until_complete(server.stop())
+    result['server'] = server.app['stats'].to_dict()
+    return result
+
+
+def main():
+    """Run every scenario and print the results."""
+    parser = get_parser()
+    args = parser.parse_args()
+    if not args.verbose:
+        # keep stdout for the results, the logs still go to the debug log
+        pixels.stream_handler.setLevel(logging.CRITICAL)
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    z = zone.Zone(args.zone)
+    ratelimit = (int(args.ratelimit[0]), args.ratelimit[1], args.ratelimit[2])
+
+    def make_cmpc(base_url: str) -> APIBase:
+        return cmpc.APICMPC(username='benchmark', base_url=base_url, canvas_max_age=CANVAS_MAX_AGE_SECONDS)
+
+    def make_python_discord(base_url: str) -> APIBase:
+        return python_discord.APIPythonDiscord(base_url=base_url, canvas_max_age=CANVAS_MAX_AGE_SECONDS)
+
+    def cmpc_server() -> MockServer:
+        return MockServer(mock_server.get_app(protocol='cmpc', latency=args.latency))
+
+    def python_discord_server() -> MockServer:
+        return MockServer(mock_server.get_app(protocol='python_discord', latency=args.latency, ratelimit=ratelimit))
+
+    results = {
+        'version': __version__,
+        'parameters': {
+            'latency': args.latency,
+            'ratelimit': ratelimit,
+            'requests': args.requests,
+            'zone': z.name,
+            'zone_pixels': z.area_opaque,
+        },
+        'scenarios': {},
+    }
+    scenarios = results['scenarios']
+
+    server = cmpc_server()
+    scenarios['cmpc_fetch'] = run_scenario(
+        loop, server, make_cmpc, lambda api_instance: bench_fetch(api_instance, args.requests, server.app['canvas'])
+    )
+    scenarios['cmpc_fetch_unchanged'] = run_scenario(
+        loop, cmpc_server(), make_cmpc, lambda api_instance: bench_fetch(api_instance, args.requests)
+    )
+    scenarios['cmpc_set_pixel'] = run_scenario(
+        loop, cmpc_server(), make_cmpc, lambda api_instance: bench_set_pixel(api_instance, args.requests)
+    )
+    server = cmpc_server()
+    scenarios['cmpc_reverts'] = run_scenario(
+        loop, server, make_cmpc, lambda api_instance: bench_reverts(api_instance, args.requests, server.app['canvas'])
+    )
+    scenarios['python_discord_fetch'] = run_scenario(
+        loop, python_discord_server(), make_python_discord,
+        lambda api_instance: bench_fetch(api_instance, args.requests)
+    )
+    scenarios['python_discord_set_pixel'] = run_scenario(
+        loop, python_discord_server(), make_python_discord,
+        lambda api_instance: bench_set_pixel(api_instance, args.requests)
+    )
+
+    server = cmpc_server()
+    scenarios['run_for_zone'] = run_scenario(
+        loop, server, make_cmpc,
+        lambda api_instance: bench_convergence(
+            run_for_zone(z, api_instance), server.app['canvas'], z, args.timeout
+        )
+    )
+    server = cmpc_server()
+    scenarios['run_protections'] = run_scenario(
+        loop, server, make_cmpc,
+        lambda api_instance: bench_convergence(
+            run_protections([z], api_instance), server.app['canvas'], z, args.timeout
+        )
+    )
+
+    server = cmpc_server()
+    webhook = MockServer(mock_server.get_webhook_app(), port=PORT + 1)
+    loop.run_until_complete(webhook.start())
+    scenarios['discord_mirror'] = run_scenario(
+        loop, server, make_cmpc,
+        lambda api_instance: bench_mirror(api_instance, server.app['canvas'], webhook)
+    )
+    loop.run_until_complete(webhook.stop())
+
+    results['metrics'] = metrics.registry.to_dict()
+    output = json.dumps(results, indent=4)
+    if args.output is None:
+        print(output)
+    else:
+        args.output.write_text(output)
+        print(f'Wrote results to "{args.output}".', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
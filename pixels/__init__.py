@@ -1,19 +1,37 @@
+import asyncio
+import concurrent.futures
+import functools
 import json
 import sys
 import argparse
 import logging
+import os
 from pathlib import Path
-from typing import Union
+from typing import Optional, Union
 
+from . import checkpoint
+from . import coordinator
+from . import diff
 from . import discord_mirror
+from . import hotspots
+from . import history
+from . import logs
+from . import metrics
+from . import noise_manipulation
+from . import palette
+from . import scheduler
+from . import supervisor
 from . import util
+from . import verification
 from . import zone
-from .api import APIBase
+from .api import APIBase, LiveCanvas
+from .api._cache import CANVAS_MAX_AGE_SECONDS
 from .api import cmpc
+from .api import pool
+from .api import python_discord
 
 
 # todo: support multiple webhooks at once, and easier webhook creation
-# todo: script to mockup placing zone on canvas
 # todo: script to make json file
 # todo: subparsers for scripts
 # todo: legacy r/place support for kicks
@@ -51,6 +69,7 @@ logging.basicConfig(
 for logger_name in ('asyncio', 'urllib3', 'PIL',):
     logging.getLogger(logger_name).setLevel(logging.ERROR)
 log = logging.getLogger(__name__)
+detail_log = logs.get_detail_logger(__name__)
 
 
 def get_parser() -> argparse.ArgumentParser:
@@ -84,77 +103,162 @@ def pad_coords_str(x: int, y: int, max_x: int, max_y: int, template: str = '({x}
     return coords_str_padded
 
 
-async def run_for_zone(z: zone.Zone, api_instance: APIBase):
-    """Given an img and the location of its top-left corner on the canvas, draw/repair that image."""
+async def run_for_zone(
+        z: zone.Zone,
+        api_instance: APIBase,
+        hotspot_tracker: Optional[hotspots.HotspotTracker] = None,
+        policy: Optional[verification.VerificationPolicy] = None,
+):
+    """Given an img and the location of its top-left corner on the canvas, draw/repair that image.
+
+    Pixels are checked before they're set when the policy expects the check to save more than it costs.
+    """
+    if policy is None:
+        policy = verification.VerificationPolicy(api_instance, hotspot_tracker)
+
     log.info('Getting current canvas status')
     canvas = await api_instance.get_pixels()
+    snapshot_at = policy.get_snapshot_time()
     log.info('Got current canvas status')
 
-    for index_y in range(z.image.height):
-        hit_incorrect_pixel = False
-
-        for index_x in range(z.image.width):
-            pix_x = z.coords[0] + index_x
-            pix_y = z.coords[1] + index_y
-            pix_coords_str = pad_coords_str(pix_x, pix_y, canvas.width, canvas.height)
+    repairs = diff.get_incorrect_pixels(z, canvas)
+    log.info('%s pixels of zone %s need changing', len(repairs), z.name)
+
+    pixels = canvas.load()
+    placed = 0
+    failed = 0
+    verified = 0
+    skipped = 0
+    for pix_x, pix_y, colour in repairs:
+        pix_coords_str = logs.Lazy(pad_coords_str, pix_x, pix_y, canvas.width, canvas.height)
+
+        if policy.should_verify(pix_x, pix_y, snapshot_at):
+            detail_log.info('Getting status of pixel at %s', pix_coords_str)
+            pix_status = await policy.verify(pix_x, pix_y, z, pixels[pix_x, pix_y], colour, snapshot_at)
+            verified += 1
+            detail_log.info('Got status of pixel at %s, %s', pix_coords_str, pix_status)
+            if diff.is_correct(z, pix_status, colour):
+                detail_log.info('Pixel at %s is %s as intended', pix_coords_str, colour)
+                metrics.inc('pixels_skipped_total')
+                skipped += 1
+                continue
 
-            colour = z.image.getpixel((index_x, index_y))
+        detail_log.info('Pixel at %s will be made %s', pix_coords_str, colour)
+        if await policy.write(pix_x, pix_y, colour):
+            placed += 1
+        else:
+            failed += 1
 
-            if not colour[3]:
-                log.info(f'Pixel at {pix_coords_str} is intended to be transparent, skipping')
-                continue
+    log.info(
+        'Zone %s: placed %s pixels, %s failed, verified %s, %s were already right',
+        z.name, placed, failed, verified, skipped,
+    )
 
-            try:
-                canvas.getpixel((pix_x, pix_y))
-            except IndexError:
-                log.error(f'Pixel at {pix_coords_str} is outside of the canvas')
-            # get canvas every other time
-            # getting it more often means better collaboration
-            # but too often is too often
-            # also only do it if we've hit a zone that needs changing, to further prevent get_pixel rate limiting
-            if hit_incorrect_pixel and index_x % 1 == 0:
-                log.info(f'Getting status of pixel at {pix_coords_str}')
-                pix_status = await api_instance.get_pixel(pix_x, pix_y)
-                log.info(f'Got status of pixel at {pix_coords_str}, {pix_status}')
-                canvas.putpixel((pix_x, pix_y), pix_status)
-            if canvas.getpixel((pix_x, pix_y)) == colour:
-                log.info(f'Pixel at {pix_coords_str} is {colour} as intended')
-            else:
-                hit_incorrect_pixel = True
-                log.info(f'Pixel at {pix_coords_str} will be made {colour}')
-                await api_instance.set_pixel(x=pix_x, y=pix_y, colour=colour)
-
-
-async def run_protections(zones_to_do: list[zone.Zone], api_instance: APIBase):
-    while True:
-        try:
-            for z in zones_to_do:
-                log.info(' working on next img '.center(100, '='))
-                log.info(f"img name: {z.name}")
-                log.info(f'img dimension x: {z.width}')
-                log.info(f'img dimension y: {z.height}')
-                log.info(f'img pixels: {z.area_opaque}')
-                await run_for_zone(z, api_instance)
-        except Exception as error:
-            log.exception(error)
-
-
-async def run(api_instance: APIBase):
-    log.info('Getting canvas size')
-    canvas_size = await api_instance.get_size()
-    log.info(f'Canvas size: {canvas_size}')
 
+async def run_protections(
+        zones_to_do: list[zone.Zone],
+        api_instance: APIBase,
+        updates: Optional[asyncio.Queue] = None,
+        checkpoint_path: Optional[Union[str, Path]] = None,
+        checkpoint_interval: float = checkpoint.CHECKPOINT_INTERVAL_SECONDS,
+        **scheduler_options,
+):
+    """Keep the zones repaired, forever.
+
+    Live updates come from the updates queue if there is one,
+    or from a connection of its own if the api has a live endpoint.
+    With a checkpoint path, the repair queue picks up where the last run left it, and is saved there as it goes.
+    Failures aren't caught here, so whatever runs this can decide when to restart it.
+    """
+    for z in zones_to_do:
+        log.info(f"img name: {z.name}")
+        log.info(f'img dimension x: {z.width}')
+        log.info(f'img dimension y: {z.height}')
+        log.info(f'img pixels: {z.area_opaque}')
+        log.info(f'img weight: {z.weight}')
+        log.info(f'img priority: {z.priority}')
+
+    repair_scheduler = scheduler.RepairScheduler(zones_to_do, api_instance, **scheduler_options)
+    jobs = [repair_scheduler.run()]
+    if checkpoint_path is not None:
+        saved = checkpoint.Checkpoint.load(checkpoint_path)
+        if saved is not None:
+            saved.restore(repair_scheduler)
+        jobs.append(checkpoint.run(repair_scheduler, checkpoint_path, checkpoint_interval))
+    if updates is None and api_instance.endpoint_live:
+        live_canvas = LiveCanvas(api_instance)
+        updates = live_canvas.subscribe()
+        jobs.append(live_canvas.run())
+        log.info(f'Listening for live pixel updates from {api_instance.endpoint_live}')
+    if updates is not None:
+        jobs.append(repair_scheduler.watch(updates))
+    await supervisor.run_together(*jobs)
+
+
+async def get_palette(config: dict, api_instance: APIBase) -> Optional[palette.Palette]:
+    """Get the palette from the config, a list of hex colours or "canvas" for the colours already on the canvas."""
+    config_palette = config.get('palette')
+    if not config_palette:
+        return None
+    if config_palette == 'canvas':
+        return palette.Palette.from_image(await api_instance.get_pixels())
+    return palette.Palette.from_hex(config_palette)
+
+
+async def run(
+        api_instance: APIBase,
+        zone_palette: Optional[palette.Palette] = None,
+        dither: bool = False,
+        updates: Optional[asyncio.Queue] = None,
+        checkpoint_path: Optional[Union[str, Path]] = None,
+        checkpoint_interval: float = checkpoint.CHECKPOINT_INTERVAL_SECONDS,
+):
     log.info(f'Loading zones to do from {IMAGES_FOLDER}')
-    zones_to_do = zone.load_zones(IMAGES_FOLDER)
+    if zone_palette is not None:
+        log.info(f'Mapping zones onto a palette of {len(zone_palette.colours)} colours')
+    zones_to_do = zone.load_zones(IMAGES_FOLDER, zone_palette, dither)
     total_area = sum(z.area_opaque for z in zones_to_do)
     log.info(f'Total area: {total_area}')
-    canvas_area = canvas_size['width'] * canvas_size['height']
-    total_area_percent = round(((total_area / canvas_area) * 100), 2)
-    log.info(f'Total area: {total_area_percent}% of canvas')
 
+    # after loading the zones, so this download is fresh enough for the repair queue to share it
     log.info(f'Saving current canvas as png to {CANVAS_IMAGE_PATH}')
     await save_canvas_as_png(api_instance)
-    await run_protections(zones_to_do, api_instance)
+    canvas = await api_instance.get_pixels()
+    log.info(f'Canvas size: {canvas.size}')
+    total_area_percent = round(((total_area / (canvas.width * canvas.height)) * 100), 2)
+    log.info(f'Total area: {total_area_percent}% of canvas')
+
+    await run_protections(zones_to_do, api_instance, updates, checkpoint_path, checkpoint_interval)
+
+
+def get_api_instance(config: dict) -> APIBase:
+    """Create an api instance for every account in the config, pooled together if there's more than one."""
+    accounts = config.get('accounts') or [{'username': config.get('username', ''), 'token': config['token']}]
+    canvas_max_age = config.get('canvas_max_age', CANVAS_MAX_AGE_SECONDS)
+
+    instances = []
+    for account in accounts:
+        # empty means the api's own address, an account's own overrides the config's
+        base_url = account.get('base_url') or config.get('base_url') or None
+        if config.get('api', 'cmpc') == 'python_discord':
+            instances.append(python_discord.APIPythonDiscord(
+                token=account['token'], base_url=base_url, canvas_max_age=canvas_max_age
+            ))
+        else:
+            instances.append(cmpc.APICMPC(
+                token=account['token'], username=account['username'], base_url=base_url, canvas_max_age=canvas_max_age
+            ))
+    log.info(f'Logged in {len(instances)} accounts.')
+
+    if len(instances) == 1:
+        api_instance = instances[0]
+    else:
+        api_instance = pool.APIPool(instances, canvas_max_age=canvas_max_age)
+
+    if config.get('live_url'):
+        for instance in (api_instance, *instances):
+            instance.endpoint_live = config['live_url']
+    return api_instance
 
 
 def main():
@@ -164,24 +268,110 @@ def main():
     with open(CONFIG_FILE_PATH) as config_file:
         config = json.load(config_file)
     log.info('Loaded config.')
-    api_instance = cmpc.APICMPC(token=config['token'], username=config['username'])
+    log_mode = config.get('log_mode', 'verbose')
+    if log_mode not in logs.LOG_MODES:
+        raise ValueError(f'log_mode should be one of {", ".join(logs.LOG_MODES)}, not "{log_mode}".')
+    if log_mode == 'summary':
+        logs.use_summary_mode(config.get('log_detail_rate', logs.DETAIL_RATE_PER_SECOND))
+    api_instance = get_api_instance(config)
 
     config_disc = config['discord_mirror']
-    # if config_disc['webhook_url'] and config_disc['message_id']:
-    #     api_instance.loop.create_task(discord_mirror.run(
-    #         config_disc['message_id'], config_disc['webhook_url'], api_instance
-    #     ))
+    config_metrics = config.get('metrics', {})
+    config_history = config.get('history', {})
+    config_noise = config.get('noise', {})
+    config_checkpoint = config.get('checkpoint', {})
+    config_coordinator = config.get('coordinator', {})
+    loop = api_instance.loop
+    jobs = supervisor.Supervisor()
+
+    if config_metrics.get('port'):
+        loop.run_until_complete(metrics.serve(config_metrics['port'], config_metrics.get('host', metrics.HOST)))
+    if config_metrics.get('snapshot_path'):
+        jobs.add('metrics', lambda: metrics.write_snapshots(
+            config_metrics['snapshot_path'], config_metrics.get('snapshot_interval', metrics.SNAPSHOT_INTERVAL_SECONDS)
+        ))
+
+    # one connection keeps the shared canvas fresh for every job
+    live_canvas = None
+    if api_instance.endpoint_live:
+        live_canvas = LiveCanvas(api_instance)
+        jobs.add('live', live_canvas.run)
+
+    if config.get('protect', False):
+        # bounded, the protector does a full refresh if it falls behind
+        updates = live_canvas.subscribe() if live_canvas is not None else None
+        zone_palette = loop.run_until_complete(get_palette(config, api_instance))
+        checkpoint_path = None
+        if config_checkpoint.get('enabled', False):
+            checkpoint_path = config_checkpoint.get('path', checkpoint.CHECKPOINT_PATH)
+
+        if config_coordinator.get('enabled', False):
+            # the zones are split between worker processes, which place pixels through this one
+            host = config_coordinator.get('host', coordinator.HOST)
+            port = config_coordinator.get('port', coordinator.PORT)
+            shards = config_coordinator.get('shards') or os.cpu_count()
+            local_shards = config_coordinator.get('local_shards')
+            if local_shards is None:
+                local_shards = shards
+            coordinator_instance = coordinator.Coordinator(
+                api_instance, zone_palette, config.get('dither', False), updates
+            )
+            jobs.add('coordinator', lambda: coordinator_instance.run(host, port))
+            for shard in range(local_shards):
+                shard_checkpoint_path = f'{checkpoint_path}.{shard}' if checkpoint_path is not None else None
+                jobs.add(f'worker {shard}', functools.partial(
+                    coordinator.run_local_worker, host, port, shard, shards, shard_checkpoint_path
+                ))
+        else:
+            jobs.add('protector', lambda: run(
+                api_instance, zone_palette, config.get('dither', False), updates,
+                checkpoint_path, config_checkpoint.get('interval', checkpoint.CHECKPOINT_INTERVAL_SECONDS),
+            ))
 
+    if config_history.get('enabled', False):
+        recorder = history.HistoryRecorder(
+            config_history.get('path', CANVAS_LOG_PATH),
+            keyframe_interval=config_history.get('keyframe_interval', history.KEYFRAME_INTERVAL),
+        )
+        jobs.add('history', lambda: history.run(
+            api_instance, recorder, config_history.get('interval', history.RECORD_INTERVAL_SECONDS)
+        ))
+
+    if config_noise.get('enabled', False):
+        # only their shapes matter here, so no palette
+        noise_zones = zone.load_zones(IMAGES_FOLDER)
+        jobs.add('noise', lambda: noise_manipulation.run(
+            api_instance,
+            same_neighbour_threshold=config_noise.get('threshold', noise_manipulation.SAME_NEIGHBOUR_THRESHOLD),
+            batch_size=config_noise.get('batch_size', noise_manipulation.BATCH_SIZE),
+            interval=config_noise.get('interval', noise_manipulation.NOISE_INTERVAL_SECONDS),
+            zones=noise_zones,
+        ))
+
+    executor = None
+    if config_disc['webhook_url'] and config_disc['message_id']:
+        if config_disc.get('encode_in_process', False):
+            executor = concurrent.futures.ProcessPoolExecutor(max_workers=1)
+        jobs.add('mirror', lambda: discord_mirror.run(
+            config_disc['message_id'], config_disc['webhook_url'], api_instance,
+            interval=config_disc['update_interval'],
+            change_threshold=config_disc.get('change_threshold', discord_mirror.CHANGE_THRESHOLD_PIXELS),
+            max_poll_interval=config_disc.get('max_poll_interval', discord_mirror.POLL_INTERVAL_MAX_SECONDS),
+            executor=executor,
+            scale=config_disc.get('image_scale', discord_mirror.IMAGE_SCALE),
+            compress_level=config_disc.get('compress_level', discord_mirror.COMPRESS_LEVEL),
+        ))
+
+    jobs.stop_on_signals(loop)
     try:
-        if config_disc['webhook_url'] and config_disc['message_id']:
-            api_instance.loop.run_until_complete(discord_mirror.run(
-                config_disc['message_id'], config_disc['webhook_url'], api_instance,
-                interval=config_disc['update_interval']
-            ))
-        # api_instance.loop.run_until_complete(run(api_instance))
+        loop.run_until_complete(jobs.run())
     except KeyboardInterrupt:
-        log.info('Stopping.')
-        api_instance.loop.run_until_complete(api_instance.close())
+        jobs.stop()
+        loop.run_until_complete(jobs.wait())
+    finally:
+        loop.run_until_complete(api_instance.close())
+        if executor is not None:
+            executor.shutdown()
 
 
 if __name__ == '__main__':
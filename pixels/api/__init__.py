@@ -1 +1,3 @@
 from ._base import APIBase
+from ._cache import CanvasCache
+from ._live import LiveCanvas
@@ -1,11 +1,18 @@
 import asyncio
+import contextlib
 import logging
 import time
-from typing import Optional
+import urllib.parse
+from typing import AsyncIterator, Optional
 
 import aiohttp
 from PIL import Image
 
+from .. import util
+from .. import metrics
+from ._cache import CANVAS_MAX_AGE_SECONDS, CanvasCache
+from ._ratelimit import RateLimit
+
 
 # todo: docstrings
 
@@ -18,8 +25,17 @@ class APIBase:
         'width': 0,
         'height': 0,
     }
-
-    def __init__(self, token: str = ''):
+    # connections are kept alive and reused, up to this many at once
+    connection_limit = 8
+    keepalive_timeout = 60
+    # how many requests it's worth having in flight at once
+    concurrency = 1
+    # websocket that pushes pixel updates, if the api has one
+    endpoint_live: Optional[str] = None
+    # whether get_pixel asks the api, instead of reading the cached canvas
+    direct_pixel_reads = False
+
+    def __init__(self, token: str = '', canvas_max_age: float = CANVAS_MAX_AGE_SECONDS):
         self.token = token
         self.headers = {
             "Authorization": 'Bearer ' + self.token,
@@ -29,10 +45,13 @@ class APIBase:
 
         self.log = logging.getLogger(__name__)
         self.session: Optional[aiohttp.ClientSession] = None
+        self.ratelimits: dict[str, RateLimit] = {}
+        self.canvas_cache = CanvasCache(self.fetch_pixels, max_age=canvas_max_age)
         self.loop.run_until_complete(self.open())
 
     async def open(self):
-        self.session = aiohttp.ClientSession()
+        connector = aiohttp.TCPConnector(limit=self.connection_limit, keepalive_timeout=self.keepalive_timeout)
+        self.session = aiohttp.ClientSession(connector=connector)
 
     async def close(self):
         await self.session.close()
@@ -49,15 +68,79 @@ class APIBase:
         sleep_finish_time = time.asctime(sleep_finish_time_struct)
         self.log.info(finish_msg.format(sleep_finish_time=sleep_finish_time))
 
-    async def set_pixel(self, x: int, y: int, colour: Pixel):
+    def get_ratelimit(self, url: str) -> RateLimit:
+        if url not in self.ratelimits:
+            self.ratelimits[url] = RateLimit(url)
+        return self.ratelimits[url]
+
+    @contextlib.asynccontextmanager
+    async def request(self, method: str, url: str, **kwargs) -> AsyncIterator[aiohttp.ClientResponse]:
+        """Make a request once the endpoint's rate limit allows it, and learn the new limit from the response."""
+        endpoint = urllib.parse.urlsplit(url).path
+        ratelimit = self.get_ratelimit(url)
+        delay = ratelimit.reserve()
+        if delay > 0:
+            self.print_sleep_time(delay)
+            metrics.inc('pixels_ratelimit_sleep_seconds_total', delay, endpoint=endpoint)
+            await asyncio.sleep(delay)
+
+        headers = {**self.headers, **kwargs.pop('headers', {})}
+        started_at = time.perf_counter()
+        async with self.session.request(method, url, headers=headers, **kwargs) as response:
+            metrics.observe('pixels_request_seconds', time.perf_counter() - started_at, endpoint=endpoint)
+            ratelimit.update(response.headers)
+            try:
+                yield response
+            finally:
+                metrics.inc('pixels_response_bytes_total', response.content.total_bytes, endpoint=endpoint)
+
+    async def connect_live(self) -> aiohttp.ClientWebSocketResponse:
+        return await self.session.ws_connect(self.endpoint_live, headers=self.headers)
+
+    def parse_live_update(self, message) -> list[tuple[int, int, Pixel]]:
+        """Turn a message from the live websocket into a list of (x, y, colour)."""
+        if isinstance(message, dict):
+            message = [message]
+        return [(update['x'], update['y'], util.hex_to_rgb(update['rgb'])) for update in message]
+
+    async def send_pixel(self, x: int, y: int, colour: Pixel) -> bool:
+        """Ask the api to set a pixel, and return whether it worked."""
         raise NotImplementedError
 
+    async def set_pixel(self, x: int, y: int, colour: Pixel, priority: float = 0) -> bool:
+        """Set a pixel, and return whether it worked.
+
+        The priority only matters to apis that share a rate budget between callers, where higher goes first,
+        so it shouldn't depend on anything local to this process, like the loop's clock.
+        """
+        success = await self.send_pixel(x=x, y=y, colour=colour)
+        if success:
+            metrics.inc('pixels_placed_total')
+            self.canvas_cache.put_pixel(x, y, colour)
+        else:
+            metrics.inc('pixels_failed_total')
+        return success
+
     async def get_pixel(self, x: int, y: int) -> Pixel:
-        canvas = await self.get_pixels()
+        canvas = await self.canvas_cache.get()
         return canvas.getpixel((x, y))
 
-    async def get_pixels(self) -> Image.Image:
+    async def get_pixel_many(self, coords: list[tuple[int, int]]) -> list[Pixel]:
+        canvas = await self.canvas_cache.get()
+        pixels = canvas.load()
+        return [pixels[xy] for xy in coords]
+
+    async def fetch_pixels(self) -> Optional[Image.Image]:
+        """Download the whole canvas from the api, or return None if it hasn't changed since the last download."""
         raise NotImplementedError
 
+    def forget_canvas(self):
+        """Forget the last download, so the next fetch returns the canvas even if it hasn't changed."""
+
+    async def get_pixels(self, max_age: Optional[float] = None) -> Image.Image:
+        """Get a copy of the canvas, no more than max_age seconds old, sharing fetches with other callers."""
+        canvas = await self.canvas_cache.get(max_age)
+        return canvas.copy()
+
     async def get_size(self) -> dict[str, int]:
         return self.canvas_size_assumed
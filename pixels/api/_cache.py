@@ -0,0 +1,94 @@
+import asyncio
+import logging
+import math
+from typing import Awaitable, Callable, Optional
+
+from PIL import Image
+
+from .. import metrics
+
+
+CANVAS_MAX_AGE_SECONDS = 5
+
+
+log = logging.getLogger(__name__)
+
+
+class CanvasCache:
+    """The last decoded canvas, shared between everything that wants to look at it.
+
+    Callers asking at the same time share one fetch,
+    and anything asking again within max_age seconds gets the same snapshot.
+    Fetches are decoded into the same image each time, so the snapshot is updated in place.
+    The snapshot also gets the pixels we know changed since, so the last download is kept as it was as well,
+    for when a fetch finds the canvas unchanged since then and any of those changes have been undone.
+    """
+
+    def __init__(self, fetch: Callable[[], Awaitable[Optional[Image.Image]]], max_age: float = CANVAS_MAX_AGE_SECONDS):
+        self.fetch = fetch
+        self.max_age = max_age
+
+        self.canvas: Optional[Image.Image] = None
+        self.downloaded: Optional[Image.Image] = None
+        self.fetched_at = -math.inf
+        self.fetch_count = 0
+        # set while live updates are keeping the snapshot up to date
+        self.live = False
+        self.pending: Optional[asyncio.Future] = None
+
+    @staticmethod
+    def time() -> float:
+        return asyncio.get_event_loop().time()
+
+    @property
+    def age(self) -> float:
+        return self.time() - self.fetched_at
+
+    async def get(self, max_age: Optional[float] = None) -> Image.Image:
+        """Get the snapshot, fetching a new one if it's older than max_age. Don't modify it or hold on to it."""
+        if max_age is None:
+            max_age = self.max_age
+        if self.canvas is not None and (self.live or self.age <= max_age):
+            return self.canvas
+        return await self.refresh()
+
+    async def refresh(self) -> Image.Image:
+        """Fetch a new snapshot, or wait for the one already being fetched."""
+        if self.pending is None:
+            self.pending = asyncio.ensure_future(self._refresh())
+        # one caller giving up shouldn't cancel the fetch for everyone else
+        return await asyncio.shield(self.pending)
+
+    async def _refresh(self) -> Image.Image:
+        started_at = self.time()
+        try:
+            canvas = await self.fetch()
+        finally:
+            self.pending = None
+        self.fetched_at = started_at
+        self.fetch_count += 1
+        if canvas is None:
+            if self.downloaded is None:
+                raise RuntimeError('The canvas was unchanged, but it was never fetched.')
+            # the server still has what we last downloaded, whatever we've heard or done since
+            self.canvas.paste(self.downloaded)
+            metrics.inc('pixels_canvas_unchanged_total')
+            log.debug(f'Fetched canvas #{self.fetch_count}, unchanged')
+            return self.canvas
+
+        # in a mode that set pixels can be written into
+        self.downloaded = canvas if canvas.mode == 'RGB' else canvas.convert('RGB')
+        if self.canvas is not None and self.canvas.size == canvas.size:
+            # into the snapshot, instead of into a new image every time
+            self.canvas.paste(self.downloaded)
+        else:
+            self.canvas = self.downloaded.copy()
+        log.debug(f'Fetched canvas #{self.fetch_count}')
+        return self.canvas
+
+    def put_pixel(self, x: int, y: int, colour: list[int]):
+        """Record a pixel we know the colour of in the snapshot."""
+        if self.canvas is None:
+            return
+        if 0 <= x < self.canvas.width and 0 <= y < self.canvas.height:
+            self.canvas.putpixel((x, y), tuple(colour[:3]))
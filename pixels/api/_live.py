@@ -0,0 +1,71 @@
+import asyncio
+import json
+import logging
+
+import aiohttp
+
+from ._base import APIBase, Pixel
+
+
+RECONNECT_DELAY_SECONDS = 1
+RECONNECT_DELAY_MAX_SECONDS = 60
+SUBSCRIBER_QUEUE_SIZE = 10000
+
+
+log = logging.getLogger(__name__)
+
+
+class LiveCanvas:
+    """Keeps the api's cached canvas up to date from pixel updates pushed over a websocket.
+
+    Each update is written into the cached snapshot and passed on to every subscriber's queue.
+    While connected, the snapshot counts as fresh, so nothing needs to download the whole canvas.
+    """
+
+    def __init__(self, api_instance: APIBase):
+        self.api_instance = api_instance
+        self.subscribers: list[asyncio.Queue] = []
+
+    def subscribe(self, maxsize: int = SUBSCRIBER_QUEUE_SIZE) -> asyncio.Queue:
+        """Get a queue that every future update will be put in, as (x, y, colour)."""
+        queue = asyncio.Queue(maxsize=maxsize)
+        self.subscribers.append(queue)
+        return queue
+
+    def publish(self, x: int, y: int, colour: Pixel):
+        self.api_instance.canvas_cache.put_pixel(x, y, colour)
+        for queue in self.subscribers:
+            try:
+                queue.put_nowait((x, y, colour))
+            except asyncio.QueueFull:
+                # the next full refresh will catch whatever the subscriber missed
+                log.warning('Live update subscriber is falling behind, dropping update')
+
+    async def listen(self):
+        """Connect once and publish updates until the connection closes."""
+        async with await self.api_instance.connect_live() as websocket:
+            log.info('Connected to live pixel updates')
+            # catch up on anything that changed before we were listening
+            await self.api_instance.canvas_cache.refresh()
+            self.api_instance.canvas_cache.live = True
+            try:
+                async for message in websocket:
+                    if message.type != aiohttp.WSMsgType.TEXT:
+                        continue
+                    for x, y, colour in self.api_instance.parse_live_update(json.loads(message.data)):
+                        self.publish(x, y, colour)
+            finally:
+                self.api_instance.canvas_cache.live = False
+
+    async def run(self):
+        """Stay connected to live pixel updates, reconnecting with backoff when the connection drops."""
+        delay = RECONNECT_DELAY_SECONDS
+        while True:
+            try:
+                await self.listen()
+                delay = RECONNECT_DELAY_SECONDS
+            except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+                log.error(f'Live pixel updates failed: {error!r}')
+            log.info(f'Reconnecting to live pixel updates in {delay} seconds')
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, RECONNECT_DELAY_MAX_SECONDS)
@@ -0,0 +1,85 @@
+import asyncio
+import logging
+from typing import Optional
+
+from multidict import CIMultiDictProxy
+
+
+log = logging.getLogger(__name__)
+
+
+class RateLimit:
+    """Token bucket for one endpoint, learned from the rate limit headers the server sends back.
+
+    Requests claim a slot with reserve() before they're sent.
+    Once the budget is known, the remaining requests are spread evenly over what's left of the window,
+    so we run out right as it resets instead of running into a cooldown.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.limit: Optional[int] = None
+        self.remaining: Optional[int] = None
+        self.period = 0.0
+        self.reset_at = 0.0
+        self.next_at = 0.0
+
+    @staticmethod
+    def time() -> float:
+        return asyncio.get_event_loop().time()
+
+    def get_next_start(self, now: float) -> float:
+        start = max(now, self.next_at)
+        if self.remaining is not None and self.remaining <= 0:
+            start = max(start, self.reset_at)
+        return start
+
+    def get_delay(self) -> float:
+        """How many seconds until the next request slot, without claiming it."""
+        now = self.time()
+        return self.get_next_start(now) - now
+
+    def reserve(self) -> float:
+        """Claim the next request slot and return how many seconds to wait before using it."""
+        now = self.time()
+        start = self.get_next_start(now)
+
+        if self.remaining is None:
+            self.next_at = start
+            return start - now
+
+        if start >= self.reset_at:
+            # the bucket will have refilled by the time this slot comes around
+            self.remaining = self.limit if self.limit is not None else 1
+            self.reset_at = start + self.period
+
+        self.remaining -= 1
+        if self.remaining > 0:
+            self.next_at = start + (self.reset_at - start) / (self.remaining + 1)
+        else:
+            self.next_at = self.reset_at
+        return start - now
+
+    def update(self, headers: CIMultiDictProxy):
+        """Learn the current budget from a response's headers."""
+        now = self.time()
+        if 'requests-remaining' in headers:
+            self.remaining = int(headers['requests-remaining'])
+            requests_reset = float(headers['requests-reset'])
+            self.reset_at = now + requests_reset
+            self.period = max(self.period, requests_reset)
+            if 'requests-limit' in headers:
+                self.limit = int(headers['requests-limit'])
+            else:
+                self.limit = max(self.limit or 0, self.remaining + 1)
+            log.debug('%s: %s requests remaining', self.name, self.remaining)
+        elif 'cooldown-reset' in headers:
+            cooldown_reset = float(headers['cooldown-reset'])
+            log.warning(f'{self.name}: on cooldown for {cooldown_reset} seconds')
+            self.remaining = 0
+            self.reset_at = now + cooldown_reset
+        else:
+            return
+
+        if not self.remaining:
+            self.next_at = max(self.next_at, self.reset_at)
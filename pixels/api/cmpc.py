@@ -1,22 +1,24 @@
-import base64
+import binascii
+import hashlib
 import io
+import json
+from typing import Optional
 
+import aiohttp
 from PIL import Image
 
 from .. import util
 from ._base import APIBase, Pixel
 
 
-# todo: rate limits
-# todo: figure out live receive pixel endpoint
+# todo: figure out live receive pixel endpoint, until then it has to be set in the config
+
+
+DATAURL_PREFIX = b'data:image/png;base64,'
 
 
 class APICMPC(APIBase):
     base_url = 'https://pixels.cmpc.live/'
-    endpoint_set_pixel = base_url + 'set'
-    endpoint_get_pixels = base_url + 'fetch'
-    endpoint_auth = base_url + 'auth'
-    endpoint_stayalive = base_url + 'stayalive'
 
     stayalive_interval_ms = 10000
     stayalive_interval_seconds = stayalive_interval_ms // 1000
@@ -25,13 +27,21 @@ class APICMPC(APIBase):
         'height': 540,
     }
 
-    def __init__(self, username: str, *args, **kwargs):
+    def __init__(self, username: str, *args, base_url: str = None, **kwargs):
+        if base_url is not None:
+            self.base_url = base_url
         super().__init__(*args, **kwargs)
 
         self.username = username
         self.subscriber = False
         self.moderator = False
 
+        # reused for every fetch, only growing if the canvas does
+        self.fetch_buffer = bytearray()
+        # what the last canvas fetched looked like, to tell when it hasn't changed
+        self.canvas_etag: Optional[str] = None
+        self.canvas_digest: Optional[bytes] = None
+
         self.headers.update(
             {
                 'Origin': 'https://yp16mcc6rrm08z5aq7weu0fyp81quy.ext-twitch.tv',
@@ -39,38 +49,97 @@ class APICMPC(APIBase):
             }
         )
 
+    @property
+    def endpoint_set_pixel(self) -> str:
+        return self.base_url + 'set'
+
+    @property
+    def endpoint_get_pixels(self) -> str:
+        return self.base_url + 'fetch'
+
+    @property
+    def endpoint_auth(self) -> str:
+        return self.base_url + 'auth'
+
+    @property
+    def endpoint_stayalive(self) -> str:
+        return self.base_url + 'stayalive'
+
     async def open(self):
         await super().open()
-        await self.session.post(self.endpoint_auth, headers=self.headers)
-
-    async def get_pixels(self) -> Image.Image:
-        async with self.session.get(
-            url=self.endpoint_get_pixels,
-            headers=self.headers
-        ) as response:
-            response_json = await response.json()
-            dataurl = response_json['DataURL']
-
-        image_b64 = dataurl.removeprefix('data:image/png;base64,')
-        image_bytes = base64.b64decode(image_b64, validate=True)
-        stream = io.BytesIO(image_bytes)
-        image = Image.open(stream)
+        async with self.request('POST', self.endpoint_auth):
+            pass
+
+    async def read_into_buffer(self, response: aiohttp.ClientResponse) -> int:
+        """Stream a response body into the fetch buffer, and return its length."""
+        if response.content_length is not None and response.content_length > len(self.fetch_buffer):
+            self.fetch_buffer = bytearray(response.content_length)
+        length = 0
+        async for chunk in response.content.iter_any():
+            end = length + len(chunk)
+            if end > len(self.fetch_buffer):
+                grown = bytearray(max(end, len(self.fetch_buffer) * 2))
+                grown[:length] = memoryview(self.fetch_buffer)[:length]
+                self.fetch_buffer = grown
+            self.fetch_buffer[length:end] = chunk
+            length = end
+        return length
+
+    def find_image_b64(self, length: int) -> memoryview:
+        """Find the base64 png in the fetched json without parsing or copying it."""
+        buffer = self.fetch_buffer
+        start = buffer.find(DATAURL_PREFIX, 0, length)
+        end = buffer.find(b'"', start + len(DATAURL_PREFIX), length)
+        if start == -1 or end == -1 or buffer.find(b'\\', start, end) != -1:
+            # not laid out how we expect, so let the json parser deal with it
+            dataurl = json.loads(buffer[:length])['DataURL'].encode()
+            return memoryview(dataurl.removeprefix(DATAURL_PREFIX))
+        return memoryview(buffer)[start + len(DATAURL_PREFIX):end]
+
+    def forget_canvas(self):
+        self.canvas_etag = None
+        self.canvas_digest = None
+
+    async def fetch_pixels(self) -> Optional[Image.Image]:
+        headers = {}
+        if self.canvas_etag is not None:
+            headers['If-None-Match'] = self.canvas_etag
+        async with self.request('GET', self.endpoint_get_pixels, headers=headers) as response:
+            if response.status == 304:
+                return None
+            length = await self.read_into_buffer(response)
+            etag = response.headers.get('ETag')
+
+        with self.find_image_b64(length) as image_b64:
+            # servers that don't send an etag still send the same bytes for the same canvas
+            digest = hashlib.sha1(image_b64).digest()
+            if digest == self.canvas_digest:
+                self.canvas_etag = etag
+                return None
+            image_bytes = binascii.a2b_base64(image_b64)
+        image = Image.open(io.BytesIO(image_bytes))
+        image.load()
+        # only once it's decoded, so a bad download isn't mistaken for the canvas next time
+        self.canvas_etag = etag
+        self.canvas_digest = digest
         return image
 
-    async def set_pixel(self, x: int, y: int, colour: Pixel):
+    async def send_pixel(self, x: int, y: int, colour: Pixel) -> bool:
         payload = {
             'Username': self.username,
             'Substatus': self.subscriber,
             'X': x,
-            'Y': x,
+            'Y': y,
             'Color': util.rgb_to_hex(colour),
         }
-        response = await self.session.post(
-            self.endpoint_set_pixel,
-            headers=self.headers,
-            json=payload
-        )
-        return response
+        async with self.request('POST', self.endpoint_set_pixel, json=payload) as response:
+            return response.ok
+
+    def parse_live_update(self, message) -> list[tuple[int, int, Pixel]]:
+        # assume updates look like what we send to the set endpoint
+        if isinstance(message, dict):
+            message = [message]
+        return [(update['X'], update['Y'], util.hex_to_rgb(update['Color'])) for update in message]
 
     async def get_size(self) -> dict[str, int]:
         canvas = await self.get_pixels()
@@ -0,0 +1,179 @@
+import asyncio
+import itertools
+import json
+import logging
+import struct
+from typing import Optional
+
+from PIL import Image
+
+from .. import metrics
+from ._base import APIBase, Pixel
+from ._live import SUBSCRIBER_QUEUE_SIZE
+
+
+# every message is a json header and a binary payload, usually empty, each preceded by its length
+FRAME_HEADER = struct.Struct('<II')
+MAX_HEADER_BYTES = 1 << 24
+MAX_PAYLOAD_BYTES = 1 << 28
+REPORT_INTERVAL_SECONDS = 10
+
+Message = dict
+
+
+log = logging.getLogger(__name__)
+
+
+async def read_message(reader: asyncio.StreamReader) -> tuple[Message, bytes]:
+    """Read the next message. Raises asyncio.IncompleteReadError when the other end hangs up."""
+    header_length, payload_length = FRAME_HEADER.unpack(await reader.readexactly(FRAME_HEADER.size))
+    if header_length > MAX_HEADER_BYTES or payload_length > MAX_PAYLOAD_BYTES:
+        raise ValueError(f'Message of {header_length} + {payload_length} bytes is too big.')
+    message = json.loads(await reader.readexactly(header_length))
+    payload = await reader.readexactly(payload_length) if payload_length else b''
+    return message, payload
+
+
+def write_message(writer: asyncio.StreamWriter, message: Message, payload: bytes = b''):
+    header = json.dumps(message).encode()
+    writer.write(FRAME_HEADER.pack(len(header), len(payload)) + header)
+    if payload:
+        writer.write(payload)
+
+
+def parse_address(address: str) -> tuple[str, int]:
+    host, _, port = address.rpartition(':')
+    return host or 'localhost', int(port)
+
+
+class APICoordinated(APIBase):
+    """The api as a worker process sees it, with every request going through a coordinator over a socket.
+
+    The coordinator owns the real api, its canvas and its rate limits,
+    and pushes every pixel it hears about to every worker, which end up in updates.
+    """
+
+    def __init__(self, host: str, port: int, name: str, *args, **kwargs):
+        self.host = host
+        self.port = port
+        self.name = name
+        self.reader: Optional[asyncio.StreamReader] = None
+        self.writer: Optional[asyncio.StreamWriter] = None
+        self.requests: dict[int, asyncio.Future] = {}
+        self.counter = itertools.count()
+        # what the coordinator said about itself when we connected
+        self.hello: Message = {}
+        self.canvas_digest: Optional[str] = None
+        self.updates = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        super().__init__(*args, **kwargs)
+
+    @property
+    def concurrency(self) -> int:
+        # enough writes waiting at the coordinator for it to pick the best across every worker
+        return self.hello.get('concurrency', 1)
+
+    @property
+    def palette(self) -> Optional[list[Pixel]]:
+        return self.hello.get('palette')
+
+    @property
+    def dither(self) -> bool:
+        return self.hello.get('dither', False)
+
+    async def open(self):
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        write_message(self.writer, {'type': 'hello', 'name': self.name})
+        # nothing else is listening yet, so read the reply here
+        self.hello, _ = await read_message(self.reader)
+        log.info(f'Connected to the coordinator at {self.host}:{self.port} as {self.name}')
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            await self.writer.wait_closed()
+
+    async def listen(self):
+        """Handle replies and pushed updates until the coordinator hangs up, then raise ConnectionError."""
+        try:
+            while True:
+                message, payload = await read_message(self.reader)
+                if 'id' in message:
+                    future = self.requests.pop(message['id'], None)
+                    if future is not None and not future.done():
+                        future.set_result((message, payload))
+                elif message['type'] == 'update':
+                    self.publish(message['x'], message['y'], message['colour'])
+        except (asyncio.IncompleteReadError, ConnectionError) as error:
+            raise ConnectionError('Lost the connection to the coordinator.') from error
+        finally:
+            for future in self.requests.values():
+                if not future.done():
+                    future.set_exception(ConnectionError('Lost the connection to the coordinator.'))
+            self.requests.clear()
+
+    def publish(self, x: int, y: int, colour: Pixel):
+        self.canvas_cache.put_pixel(x, y, colour)
+        try:
+            self.updates.put_nowait((x, y, colour))
+        except asyncio.QueueFull:
+            # the next full refresh will catch whatever was missed
+            log.warning('Falling behind on updates from the coordinator, dropping update')
+
+    async def call(self, message_type: str, **fields) -> tuple[Message, bytes]:
+        """Send a request and wait for its reply. Raises RuntimeError if the coordinator couldn't do it."""
+        request_id = next(self.counter)
+        future = asyncio.get_event_loop().create_future()
+        self.requests[request_id] = future
+        write_message(self.writer, {'type': message_type, 'id': request_id, **fields})
+        try:
+            reply, payload = await future
+        finally:
+            self.requests.pop(request_id, None)
+        if 'error' in reply:
+            raise RuntimeError(f'The coordinator failed to {message_type}: {reply["error"]}')
+        return reply, payload
+
+    async def report(self, zone_names: list[str], interval: float = REPORT_INTERVAL_SECONDS):
+        """Tell the coordinator how much repairing is left every interval seconds."""
+        while True:
+            await asyncio.sleep(interval)
+            write_message(self.writer, {
+                'type': 'report',
+                'queue': metrics.registry.get('pixels_queue_depth'),
+                'zones': {name: metrics.registry.get('pixels_zone_correct_ratio', zone=name) for name in zone_names},
+            })
+
+    async def set_pixel(self, x: int, y: int, colour: Pixel, priority: float = 0) -> bool:
+        reply, _ = await self.call('set', x=x, y=y, colour=list(colour[:3]), priority=priority)
+        if reply['ok']:
+            metrics.inc('pixels_placed_total')
+            self.canvas_cache.put_pixel(x, y, colour)
+        else:
+            metrics.inc('pixels_failed_total')
+        return reply['ok']
+
+    async def get_pixel(self, x: int, y: int) -> Pixel:
+        return (await self.get_pixel_many([(x, y)]))[0]
+
+    async def get_pixel_many(self, coords: list[tuple[int, int]]) -> list[Pixel]:
+        reply, _ = await self.call('get_many', coords=coords)
+        for (x, y), colour in zip(coords, reply['colours']):
+            self.canvas_cache.put_pixel(x, y, colour)
+        return reply['colours']
+
+    def forget_canvas(self):
+        self.canvas_digest = None
+
+    async def fetch_pixels(self) -> Optional[Image.Image]:
+        reply, payload = await self.call('fetch', digest=self.canvas_digest)
+        if reply['unchanged']:
+            return None
+        self.canvas_digest = reply['digest']
+        return Image.frombytes('RGB', (reply['width'], reply['height']), payload)
+
+    async def get_size(self) -> dict[str, int]:
+        canvas = await self.get_pixels()
+        return {
+            'width': canvas.width,
+            'height': canvas.height,
+        }
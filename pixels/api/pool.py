@@ -0,0 +1,99 @@
+import asyncio
+import contextlib
+from typing import Iterator, Optional
+
+import aiohttp
+from PIL import Image
+
+from ._base import APIBase, Pixel
+
+
+class APIPool(APIBase):
+    """Several accounts behind one api, each with its own session and rate limits.
+
+    Every request goes to whichever account can send it soonest,
+    so with one worker per account the throughput scales with the number of accounts.
+    """
+
+    def __init__(self, instances: list[APIBase], *args, **kwargs):
+        if not instances:
+            raise ValueError('An api pool needs at least one account.')
+        self.instances = instances
+        # how many writes each account is in the middle of
+        self.busy = {id(instance): 0 for instance in instances}
+        # the account whose download is in the shared canvas cache
+        self.fetched_by: Optional[APIBase] = None
+        super().__init__(*args, **kwargs)
+
+    @property
+    def concurrency(self) -> int:
+        return sum(instance.concurrency for instance in self.instances)
+
+    @property
+    def direct_pixel_reads(self) -> bool:
+        return all(instance.direct_pixel_reads for instance in self.instances)
+
+    async def open(self):
+        # each account opened its own session when it was created
+        pass
+
+    async def close(self):
+        await asyncio.gather(*(instance.close() for instance in self.instances))
+
+    def pick(self, endpoint_attr: str, prefer_idle: bool = False) -> APIBase:
+        """Get the account whose rate limit for an endpoint allows a request soonest."""
+        def get_delay(instance: APIBase) -> tuple[float, int]:
+            url = getattr(instance, endpoint_attr)
+            # spread requests out between accounts that are equally ready
+            return instance.get_ratelimit(url).get_delay(), self.busy[id(instance)]
+
+        candidates = self.instances
+        if prefer_idle:
+            least_busy = min(self.busy.values())
+            candidates = [i for i in candidates if self.busy[id(i)] == least_busy]
+        return min(candidates, key=get_delay)
+
+    @contextlib.contextmanager
+    def writing(self, instance: APIBase) -> Iterator[None]:
+        self.busy[id(instance)] += 1
+        try:
+            yield
+        finally:
+            self.busy[id(instance)] -= 1
+
+    async def connect_live(self) -> aiohttp.ClientWebSocketResponse:
+        return await self.instances[0].connect_live()
+
+    def parse_live_update(self, message) -> list[tuple[int, int, Pixel]]:
+        return self.instances[0].parse_live_update(message)
+
+    async def send_pixel(self, x: int, y: int, colour: Pixel) -> bool:
+        instance = self.pick('endpoint_set_pixel')
+        with self.writing(instance):
+            return await instance.send_pixel(x=x, y=y, colour=colour)
+
+    async def get_pixel(self, x: int, y: int) -> Pixel:
+        # accounts without a single pixel endpoint would each download the whole canvas,
+        # so read from the pool's shared one instead
+        if not self.direct_pixel_reads:
+            return await super().get_pixel(x, y)
+        pixel = await self.pick('endpoint_get_pixel', prefer_idle=True).get_pixel(x, y)
+        self.canvas_cache.put_pixel(x, y, pixel)
+        return pixel
+
+    async def get_pixel_many(self, coords: list[tuple[int, int]]) -> list[Pixel]:
+        if not self.direct_pixel_reads:
+            return await super().get_pixel_many(coords)
+        return await asyncio.gather(*(self.get_pixel(x, y) for x, y in coords))
+
+    async def fetch_pixels(self) -> Optional[Image.Image]:
+        instance = self.pick('endpoint_get_pixels')
+        if instance is not self.fetched_by:
+            # unchanged to it only means since its own last download, which may not be what the cache has
+            instance.forget_canvas()
+        canvas = await instance.fetch_pixels()
+        self.fetched_by = instance
+        return canvas
+
+    async def get_size(self) -> dict[str, int]:
+        return await self.instances[0].get_size()
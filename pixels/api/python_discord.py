@@ -1,119 +1,80 @@
 import asyncio
-import logging
-import time
+from typing import Optional
 
-import aiohttp
-from multidict import CIMultiDictProxy
+from PIL import Image
 
+from .. import util
+from ._base import APIBase, Pixel
 
-# todo: fix
 
+class APIPythonDiscord(APIBase):
+    base_url = 'https://pixels.pythondiscord.com/'
 
-log = logging.getLogger(__name__)
-
-
-BASE_URL = 'https://pixels.pythondiscord.com'
-SET_PIXEL_URL = f'{BASE_URL}/set_pixel'
-GET_SIZE_URL = f'{BASE_URL}/get_size'
-GET_PIXELS_URL = f'{BASE_URL}/get_pixels'
-GET_PIXEL_URL = f'{BASE_URL}/get_pixel'
-
-
-def print_sleep_time(
-        duration: float,
-        duration_msg: str = 'sleeping for {duration} seconds',
-        finish_msg: str = 'finish sleeping at {sleep_finish_time}'
-):
-    log.info(duration_msg.format(duration=duration))
-    sleep_finish_time_posix = time.time() + duration
-    sleep_finish_time_struct = time.localtime(sleep_finish_time_posix)
-    sleep_finish_time = time.asctime(sleep_finish_time_struct)
-    log.info(finish_msg.format(sleep_finish_time=sleep_finish_time))
-
-
-async def ratelimit(headers: CIMultiDictProxy):
-    """Given headers from a response, print info and sleep if needed."""
-    if 'requests-remaining' in headers:
-        requests_remaining = int(headers['requests-remaining'])
-        log.info(f'{requests_remaining} requests remaining')
-        if not requests_remaining:
-            requests_reset = float(headers['requests-reset'])
-            print_sleep_time(requests_reset)
-            await asyncio.sleep(requests_reset)
-    else:
-        cooldown_reset = float(headers['cooldown-reset'])
-        log.info('on cooldown')
-        print_sleep_time(cooldown_reset)
-        await asyncio.sleep(cooldown_reset)
-
-
-async def head_request(url: str, headers: dict):
-    async with aiohttp.ClientSession() as session:
-        async with session.head(url, headers=headers) as r:
-            if r.ok:
-                await ratelimit(r.headers)
-
-
-async def set_pixel(x: int, y: int, rgb: str, headers: dict):
-    """set_pixel endpoint wrapper."""
-    await head_request(SET_PIXEL_URL, headers)
-    payload = {
-        'x': x,
-        'y': y,
-        'rgb': rgb,
+    canvas_size_assumed = {
+        'width': 272,
+        'height': 153,
     }
-    async with aiohttp.ClientSession() as session:
-        async with session.post(
-            SET_PIXEL_URL,
-            json=payload,
-            headers=headers
-        ) as r:
-            r_json = await r.json()
-            log.info(r_json['message'])
-            if r.status == 503:
-                log.error('Failed to write pixel')
-            else:
-                await ratelimit(r.headers)
-
-
-async def get_pixels(headers: dict) -> bytes:
-    """get_pixels endpoint wrapper."""
-    await head_request(GET_PIXELS_URL, headers)
-    async with aiohttp.ClientSession() as session:
-        async with session.get(
-            GET_PIXELS_URL,
-            headers=headers
-        ) as r:
-            await ratelimit(r.headers)
-            pixels_bytes = await r.read()
-
-    return pixels_bytes
-
-
-async def get_pixel(x: int, y: int, headers: dict) -> str:
-    """get_pixel endpoint wrapper."""
-    await head_request(GET_PIXEL_URL, headers)
-    params = {
-        'x': x,
-        'y': y
-    }
-    async with aiohttp.ClientSession() as session:
-        async with session.get(
-            GET_PIXEL_URL,
-            params=params,
-            headers=headers
-        ) as r:
-            await ratelimit(r.headers)
-            r_json = await r.json()
-
-    return r_json['rgb']
-
-
-async def get_size(headers: dict) -> dict[str, int]:
-    """get_size endpoint wrapper."""
-    async with aiohttp.ClientSession() as session:
-        async with session.get(
-            GET_SIZE_URL,
-            headers=headers
-        ) as r:
-            return await r.json()
+    direct_pixel_reads = True
+
+    def __init__(self, *args, base_url: str = None, **kwargs):
+        if base_url is not None:
+            self.base_url = base_url
+        self.canvas_size: Optional[dict[str, int]] = None
+        super().__init__(*args, **kwargs)
+
+    @property
+    def endpoint_set_pixel(self) -> str:
+        return self.base_url + 'set_pixel'
+
+    @property
+    def endpoint_get_size(self) -> str:
+        return self.base_url + 'get_size'
+
+    @property
+    def endpoint_get_pixels(self) -> str:
+        return self.base_url + 'get_pixels'
+
+    @property
+    def endpoint_get_pixel(self) -> str:
+        return self.base_url + 'get_pixel'
+
+    async def send_pixel(self, x: int, y: int, colour: Pixel) -> bool:
+        payload = {
+            'x': x,
+            'y': y,
+            'rgb': util.rgb_to_hex(colour, prefix=''),
+        }
+        async with self.request('POST', self.endpoint_set_pixel, json=payload) as response:
+            response_json = await response.json()
+            self.log.info(response_json['message'])
+            if response.status == 503:
+                self.log.error('Failed to write pixel')
+            return response.ok
+
+    async def get_pixel(self, x: int, y: int) -> Pixel:
+        params = {
+            'x': x,
+            'y': y,
+        }
+        async with self.request('GET', self.endpoint_get_pixel, params=params) as response:
+            response_json = await response.json()
+        pixel = util.hex_to_rgb(response_json['rgb'])
+        self.canvas_cache.put_pixel(x, y, pixel)
+        return pixel
+
+    async def get_pixel_many(self, coords: list[tuple[int, int]]) -> list[Pixel]:
+        # the requests share the session's pooled connections, and the rate limit spaces them out
+        return await asyncio.gather(*(self.get_pixel(x, y) for x, y in coords))
+
+    async def fetch_pixels(self) -> Image.Image:
+        canvas_size = await self.get_size()
+        async with self.request('GET', self.endpoint_get_pixels) as response:
+            pixels_bytes = await response.read()
+        return util.bytes_to_image(pixels_bytes, **canvas_size)
+
+    async def get_size(self) -> dict[str, int]:
+        # the size doesn't change during an event, so only ask once
+        if self.canvas_size is None:
+            async with self.request('GET', self.endpoint_get_size) as response:
+                self.canvas_size = await response.json()
+        return self.canvas_size
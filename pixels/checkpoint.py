@@ -0,0 +1,212 @@
+import array
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Optional, Union
+
+from PIL import Image
+
+from . import hotspots
+from . import spatial
+from .scheduler import PendingRepair, RepairScheduler
+
+
+CHECKPOINT_PATH = Path('images') / 'ignore' / 'checkpoint'
+CHECKPOINT_INTERVAL_SECONDS = 60
+CHECKPOINT_MAGIC = b'PIXCKPT1\n'
+
+
+log = logging.getLogger(__name__)
+
+
+class Checkpoint:
+    """What the repair scheduler knew at one moment: the canvas, the queue, the hot tiles and each zone's progress.
+
+    Times are stored as ages when it was saved, since loop time means nothing to the next process.
+    """
+
+    def __init__(
+            self,
+            canvas: Image.Image,
+            coords: array.array,
+            ages: array.array,
+            zones: dict[str, dict[str, int]],
+            tiles: list[list[float]],
+            saved_at: float,
+    ):
+        self.canvas = canvas
+        # x, y pairs of the queued pixels, and how long ago each was damaged
+        self.coords = coords
+        self.ages = ages
+        self.zones = zones
+        # tile x, tile y, heat and damage count of each hot tile
+        self.tiles = tiles
+        # wall clock time
+        self.saved_at = saved_at
+
+    def __len__(self) -> int:
+        return len(self.ages)
+
+    @classmethod
+    def capture(cls, repair_scheduler: RepairScheduler) -> Optional['Checkpoint']:
+        """Copy what needs saving out of the scheduler, or None if it hasn't seen the canvas yet."""
+        canvas = repair_scheduler.api_instance.canvas_cache.canvas
+        if canvas is None or not repair_scheduler.refreshed:
+            return None
+        now = asyncio.get_event_loop().time()
+
+        coords = array.array('H')
+        ages = array.array('d')
+        queued = {z.name: 0 for z in repair_scheduler.zones}
+        for repair in repair_scheduler.pending.values():
+            coords.extend((repair.x, repair.y))
+            ages.append(now - repair.damaged_at)
+            queued[repair.zone.name] += 1
+        zones = {
+            name: {'placed': repair_scheduler.placed[name], 'queued': count}
+            for name, count in queued.items()
+        }
+
+        tracker = repair_scheduler.hotspots
+        tiles = [
+            [tile[0], tile[1], tracker.decayed(stats, now), stats.count]
+            for tile, stats in tracker.tiles.items()
+        ]
+        return cls(canvas.copy(), coords, ages, zones, tiles, time.time())
+
+    def save(self, path: Union[str, Path]):
+        """Write the checkpoint, replacing the old one in one go so a crash never leaves half of one."""
+        path = Path(path)
+        canvas_bytes = self.canvas.tobytes()
+        coords_bytes = self.coords.tobytes()
+        ages_bytes = self.ages.tobytes()
+        header = {
+            'saved_at': self.saved_at,
+            'width': self.canvas.width,
+            'height': self.canvas.height,
+            'canvas_length': len(canvas_bytes),
+            'coords_length': len(coords_bytes),
+            'ages_length': len(ages_bytes),
+            'zones': self.zones,
+            'tiles': self.tiles,
+        }
+
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # named for the thread, so a save on shutdown can't collide with one still running in the executor
+        temp_path = path.with_name(f'{path.name}.{threading.get_ident()}.tmp')
+        with open(temp_path, 'wb') as checkpoint_file:
+            checkpoint_file.write(CHECKPOINT_MAGIC)
+            checkpoint_file.write(json.dumps(header).encode() + b'\n')
+            checkpoint_file.write(canvas_bytes)
+            checkpoint_file.write(coords_bytes)
+            checkpoint_file.write(ages_bytes)
+            checkpoint_file.flush()
+            os.fsync(checkpoint_file.fileno())
+        os.replace(temp_path, path)
+        log.debug(f'Saved checkpoint of {len(self)} queued pixels to {path}')
+
+    @classmethod
+    def load(cls, path: Union[str, Path]) -> Optional['Checkpoint']:
+        """Read a checkpoint, or None if there isn't a usable one."""
+        try:
+            data = Path(path).read_bytes()
+        except FileNotFoundError:
+            return None
+
+        header_end = data.find(b'\n', len(CHECKPOINT_MAGIC))
+        if data[:len(CHECKPOINT_MAGIC)] != CHECKPOINT_MAGIC or header_end == -1:
+            log.warning(f'Ignoring {path}, it isn\'t a checkpoint')
+            return None
+        header = json.loads(data[len(CHECKPOINT_MAGIC):header_end])
+        canvas_start = header_end + 1
+        coords_start = canvas_start + header['canvas_length']
+        ages_start = coords_start + header['coords_length']
+        ages_end = ages_start + header['ages_length']
+        if len(data) < ages_end:
+            log.warning(f'Ignoring {path}, it\'s cut short')
+            return None
+
+        size = (header['width'], header['height'])
+        canvas = Image.frombytes('RGB', size, data[canvas_start:coords_start])
+        coords = array.array('H', data[coords_start:ages_start])
+        ages = array.array('d', data[ages_start:ages_end])
+        return cls(canvas, coords, ages, header['zones'], header['tiles'], header['saved_at'])
+
+    def restore(self, repair_scheduler: RepairScheduler):
+        """Put the queue, hot tiles and progress back into a scheduler that hasn't run yet,
+        and the canvas into its api's cache if nothing has been fetched yet.
+
+        Its first refresh then only has to reconcile the queue with the canvas as it is now,
+        and anything that changed while nothing was running counts as damage.
+        The canvas is dated from when it was saved, so unless that was within max_age the first refresh still fetches.
+        """
+        now = asyncio.get_event_loop().time()
+        # time that passed while nothing was running still ages everything
+        downtime = max(time.time() - self.saved_at, 0)
+
+        # before the queue, since hot tiles go first
+        tracker = repair_scheduler.hotspots
+        for tile_x, tile_y, heat, count in self.tiles:
+            stats = tracker.tiles[(int(tile_x), int(tile_y))] = hotspots.TileStats()
+            stats.heat = heat
+            stats.updated_at = stats.last_damaged_at = now - downtime
+            stats.count = count
+
+        index = spatial.ZoneIndex(repair_scheduler.zones, self.canvas.size)
+        canvas_bytes = self.canvas.tobytes()
+        pending = {}
+        for position, age in enumerate(self.ages):
+            x = self.coords[position * 2]
+            y = self.coords[position * 2 + 1]
+            # zones may have changed since, so ask the index what's wanted here now
+            target = index.get_target(x, y)
+            if target is None:
+                continue
+            z, colour = target
+            offset = (y * self.canvas.width + x) * 3
+            current = tuple(canvas_bytes[offset:offset + 3])
+            repair = PendingRepair(x, y, colour, z, now - downtime - age, current, now - downtime)
+            repair.key = repair_scheduler.get_key(repair, current)
+            pending[(x, y)] = repair
+
+        for z in repair_scheduler.zones:
+            progress = self.zones.get(z.name)
+            if progress is not None:
+                repair_scheduler.placed[z.name] = progress['placed']
+                log.info(f'Zone {z.name}: resuming with {progress["queued"]} queued and {progress["placed"]} placed')
+
+        cache = repair_scheduler.api_instance.canvas_cache
+        if cache.canvas is None:
+            cache.canvas = self.canvas.copy()
+            cache.downloaded = self.canvas.copy()
+            cache.fetched_at = now - downtime
+
+        repair_scheduler.index = index
+        repair_scheduler.refreshed = True
+        repair_scheduler.set_pending(pending)
+        log.info(f'Resumed {len(pending)} queued pixels from a checkpoint {round(downtime)} seconds old')
+
+
+async def save(repair_scheduler: RepairScheduler, path: Union[str, Path]):
+    """Checkpoint the scheduler, writing it out on another thread."""
+    checkpoint = Checkpoint.capture(repair_scheduler)
+    if checkpoint is not None:
+        await asyncio.get_event_loop().run_in_executor(None, checkpoint.save, path)
+
+
+async def run(repair_scheduler: RepairScheduler, path: Union[str, Path], interval: float = CHECKPOINT_INTERVAL_SECONDS):
+    """Checkpoint the scheduler every interval seconds, and once more when cancelled."""
+    try:
+        while True:
+            await asyncio.sleep(interval)
+            await save(repair_scheduler, path)
+    finally:
+        # synchronously, since there's no waiting on anything once cancelled
+        checkpoint = Checkpoint.capture(repair_scheduler)
+        if checkpoint is not None:
+            checkpoint.save(path)
+            log.info(f'Saved checkpoint to {path}')
@@ -0,0 +1,248 @@
+import asyncio
+import hashlib
+import itertools
+import logging
+import sys
+from pathlib import Path
+from typing import Optional, Union
+
+from . import metrics
+from . import palette
+from . import supervisor
+from . import zone
+from .api import APIBase
+from .api._base import Pixel
+from .api.coordinated import Message, read_message, write_message
+
+
+HOST = 'localhost'
+PORT = 8765
+# past this much unsent to a worker, updates for it get dropped instead of piling up
+MAX_WRITE_BUFFER_BYTES = 1 << 22
+# how long a worker gets to save its checkpoint when stopped before it's killed
+WORKER_STOP_TIMEOUT_SECONDS = 10
+
+
+log = logging.getLogger(__name__)
+
+
+def shard_zones(zones: list[zone.Zone], shards: int) -> list[list[zone.Zone]]:
+    """Split zones between shards by area, keeping zones that overlap together so one shard decides who wins.
+
+    Every worker splits the same zones the same way, however they were loaded.
+    """
+    zones = sorted(zones, key=lambda z: z.name)
+    # zones whose boxes overlap, transitively, as groups
+    groups: list[list[zone.Zone]] = []
+    for z in zones:
+        box = get_box(z)
+        touching = [group for group in groups if any(overlaps(box, get_box(other)) for other in group)]
+        merged = [z]
+        for group in touching:
+            groups.remove(group)
+            merged.extend(group)
+        groups.append(merged)
+
+    shard_lists: list[list[zone.Zone]] = [[] for _ in range(shards)]
+    areas = [0] * shards
+    # biggest first, each into whichever shard has the least so far
+    for group in sorted(groups, key=lambda group: (-sum(z.area_opaque for z in group), min(z.name for z in group))):
+        smallest = areas.index(min(areas))
+        shard_lists[smallest].extend(sorted(group, key=lambda z: z.name))
+        areas[smallest] += sum(z.area_opaque for z in group)
+    return shard_lists
+
+
+def get_box(z: zone.Zone) -> tuple[int, int, int, int]:
+    left, top = z.coords
+    return left, top, left + z.width, top + z.height
+
+
+def overlaps(box: tuple[int, int, int, int], other: tuple[int, int, int, int]) -> bool:
+    return box[0] < other[2] and other[0] < box[2] and box[1] < other[3] and other[1] < box[3]
+
+
+class Coordinator:
+    """Owns the api, the canvas and the rate budget, and shares them with worker processes over a socket.
+
+    Workers diff their own zones against the canvas, and send the pixels they want placed here.
+    The writes wait in one queue across every worker, most valuable first, for as many writers as the api allows,
+    so the rate budget goes to the best repairs wherever they are.
+    Every pixel placed or heard about over live updates is pushed to every worker.
+    """
+
+    def __init__(
+            self,
+            api_instance: APIBase,
+            zone_palette: Optional[palette.Palette] = None,
+            dither: bool = False,
+            updates: Optional[asyncio.Queue] = None,
+    ):
+        self.api_instance = api_instance
+        self.palette = zone_palette
+        self.dither = dither
+        self.updates = updates
+        self.workers: dict[asyncio.StreamWriter, str] = {}
+        self.writes = asyncio.PriorityQueue()
+        self.counter = itertools.count()
+        self.handlers = {
+            'fetch': self.handle_fetch,
+            'set': self.handle_set,
+            'get_many': self.handle_get_many,
+        }
+
+    def get_hello(self) -> Message:
+        return {
+            'type': 'hello',
+            'concurrency': self.api_instance.concurrency,
+            'palette': self.palette.colours if self.palette is not None else None,
+            'dither': self.dither,
+        }
+
+    def broadcast(self, x: int, y: int, colour: Pixel, exclude: Optional[asyncio.StreamWriter] = None):
+        message = {'type': 'update', 'x': x, 'y': y, 'colour': list(colour[:3])}
+        for writer, name in self.workers.items():
+            if writer is exclude:
+                continue
+            if writer.transport.get_write_buffer_size() > MAX_WRITE_BUFFER_BYTES:
+                # its next full refresh will catch whatever it missed
+                log.warning(f'Worker {name} is falling behind, dropping update')
+                continue
+            write_message(writer, message)
+
+    async def handle_fetch(self, writer: asyncio.StreamWriter, message: Message) -> tuple[Message, bytes]:
+        canvas = await self.api_instance.canvas_cache.get()
+        canvas_bytes = canvas.tobytes()
+        digest = hashlib.sha1(canvas_bytes).hexdigest()
+        if digest == message.get('digest'):
+            return {'unchanged': True}, b''
+        return {'unchanged': False, 'digest': digest, 'width': canvas.width, 'height': canvas.height}, canvas_bytes
+
+    async def handle_set(self, writer: asyncio.StreamWriter, message: Message) -> tuple[Message, bytes]:
+        future = asyncio.get_event_loop().create_future()
+        x, y, colour = message['x'], message['y'], message['colour']
+        # negated because the queue gives the lowest first
+        self.writes.put_nowait((-message['priority'], next(self.counter), x, y, colour, future))
+        ok = await future
+        if ok:
+            self.broadcast(x, y, colour, exclude=writer)
+        return {'ok': ok}, b''
+
+    async def handle_get_many(self, writer: asyncio.StreamWriter, message: Message) -> tuple[Message, bytes]:
+        colours = await self.api_instance.get_pixel_many([tuple(coords) for coords in message['coords']])
+        return {'colours': [list(colour[:3]) for colour in colours]}, b''
+
+    def handle_report(self, writer: asyncio.StreamWriter, message: Message):
+        name = self.workers[writer]
+        metrics.set_gauge('pixels_worker_queue_depth', message['queue'], worker=name)
+        for zone_name, ratio in message['zones'].items():
+            metrics.set_gauge('pixels_zone_correct_ratio', ratio, zone=zone_name)
+        log.debug(f'Worker {name} has {message["queue"]} pixels in its repair queue')
+
+    async def respond(self, writer: asyncio.StreamWriter, message: Message):
+        handler = self.handlers.get(message['type'])
+        try:
+            if handler is None:
+                raise ValueError(f'Unknown request type "{message["type"]}".')
+            reply, payload = await handler(writer, message)
+        except Exception as error:
+            log.exception(f'Failed to handle a {message["type"]} request from worker {self.workers.get(writer)}')
+            reply, payload = {'error': repr(error)}, b''
+        if not writer.is_closing():
+            write_message(writer, {'id': message['id'], **reply}, payload)
+
+    async def serve_worker(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Serve one worker's requests until it hangs up."""
+        tasks: set[asyncio.Task] = set()
+        try:
+            message, _ = await read_message(reader)
+            if message.get('type') != 'hello':
+                raise ValueError(f'Expected hello, got {message.get("type")}.')
+            name = str(message['name'])
+            self.workers[writer] = name
+            metrics.set_gauge('pixels_workers_connected', len(self.workers))
+            write_message(writer, self.get_hello())
+            log.info(f'Worker {name} connected')
+
+            while True:
+                message, _ = await read_message(reader)
+                if message['type'] == 'report':
+                    self.handle_report(writer, message)
+                    continue
+                # answered as they finish, so a write waiting its turn doesn't hold up a fetch
+                task = asyncio.ensure_future(self.respond(writer, message))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except Exception:
+            log.exception('Dropping a worker that sent something unexpected')
+        finally:
+            for task in tasks:
+                task.cancel()
+            name = self.workers.pop(writer, None)
+            metrics.set_gauge('pixels_workers_connected', len(self.workers))
+            if name is not None:
+                log.info(f'Worker {name} disconnected')
+            writer.close()
+
+    async def write(self):
+        """Place the most valuable pixel any worker wants, forever."""
+        while True:
+            _, _, x, y, colour, future = await self.writes.get()
+            if future.done():
+                # the worker that wanted it has gone
+                continue
+            try:
+                ok = await self.api_instance.set_pixel(x=x, y=y, colour=colour)
+            except Exception as error:
+                if not future.done():
+                    future.set_exception(error)
+            else:
+                if not future.done():
+                    future.set_result(ok)
+
+    async def forward(self):
+        """Pass live updates on to every worker."""
+        while True:
+            x, y, colour = await self.updates.get()
+            self.broadcast(x, y, colour)
+
+    async def run(self, host: str = HOST, port: int = PORT):
+        """Serve workers until cancelled."""
+        server = await asyncio.start_server(self.serve_worker, host, port)
+        log.info(f'Coordinating workers at {host}:{port}')
+        jobs = [self.write() for _ in range(self.api_instance.concurrency)]
+        if self.updates is not None:
+            jobs.append(self.forward())
+        async with server:
+            await supervisor.run_together(server.serve_forever(), *jobs)
+
+
+async def run_local_worker(
+        host: str,
+        port: int,
+        shard: int,
+        shards: int,
+        checkpoint_path: Optional[Union[str, Path]] = None,
+):
+    """Run a worker process for one shard until it exits, and raise RuntimeError if it failed."""
+    command = [
+        sys.executable, '-m', 'pixels.worker', f'{host}:{port}',
+        '--shard', str(shard), '--shards', str(shards),
+    ]
+    if checkpoint_path is not None:
+        command.extend(('--checkpoint', str(checkpoint_path)))
+    process = await asyncio.create_subprocess_exec(*command)
+    try:
+        returncode = await process.wait()
+    finally:
+        if process.returncode is None:
+            process.terminate()
+            try:
+                await asyncio.wait_for(process.wait(), WORKER_STOP_TIMEOUT_SECONDS)
+            except asyncio.TimeoutError:
+                process.kill()
+                await process.wait()
+    if returncode:
+        raise RuntimeError(f'Worker for shard {shard} exited with {returncode}')
@@ -0,0 +1,94 @@
+import logging
+
+from PIL import Image, ImageChops
+
+from . import util
+from . import zone
+
+
+# a pixel that needs fixing, as (x, y, (r, g, b)) in canvas coordinates
+Repair = tuple[int, int, tuple[int, int, int]]
+
+
+log = logging.getLogger(__name__)
+
+
+def difference_mask(first: Image.Image, second: Image.Image) -> Image.Image:
+    """Get a mask of the pixels whose RGB differs between two images of the same size."""
+    # convert() copies even when the mode is already right
+    if first.mode != 'RGB':
+        first = first.convert('RGB')
+    if second.mode != 'RGB':
+        second = second.convert('RGB')
+    difference = ImageChops.difference(first, second)
+    red, green, blue = difference.split()
+    channel_max = ImageChops.lighter(ImageChops.lighter(red, green), blue)
+    return util.binary_mask(channel_max)
+
+
+def count_different_pixels(first: Image.Image, second: Image.Image) -> int:
+    return difference_mask(first, second).histogram()[255]
+
+
+def mismatch_mask(target: Image.Image, current: Image.Image) -> Image.Image:
+    """Get a mask of the opaque pixels in an RGBA target that differ from an RGB image of the same size."""
+    opaque = util.binary_mask(target.getchannel('A'))
+    return ImageChops.multiply(difference_mask(target, current), opaque)
+
+
+def is_correct(z: zone.Zone, colour: tuple[int, ...], target: tuple[int, int, int]) -> bool:
+    """Whether a pixel on the canvas is what a zone wants there, compared the same way the diff compares them."""
+    if z.palette is not None:
+        return z.palette.index_of(colour) == z.palette.index_of(target)
+    return tuple(colour[:3]) == tuple(target)
+
+
+def get_incorrect_indices(z: zone.Zone, current: Image.Image, box: tuple[int, int, int, int]) -> list[Repair]:
+    """Compare a zone mapped onto a palette against the canvas, by palette index instead of RGB."""
+    left, top, right, bottom = box
+    zone_x, zone_y = z.coords
+    zone_box = (left - zone_x, top - zone_y, right - zone_x, bottom - zone_y)
+    target_indices = z.indices.crop(zone_box)
+    opaque = util.binary_mask(z.image.getchannel('A').crop(zone_box))
+    current_indices = z.palette.to_indices(current)
+    mismatched = ImageChops.multiply(util.binary_mask(ImageChops.difference(target_indices, current_indices)), opaque)
+
+    target_bytes = target_indices.tobytes()
+    width = right - left
+    repairs = []
+    for index in util.mask_indices(mismatched):
+        index_y, index_x = divmod(index, width)
+        repairs.append((left + index_x, top + index_y, z.palette.colours[target_bytes[index]]))
+
+    return repairs
+
+
+def get_incorrect_pixels(z: zone.Zone, canvas: Image.Image) -> list[Repair]:
+    """Compare a zone against the canvas in one pass and return the pixels that need fixing, in row order."""
+    zone_x, zone_y = z.coords
+    left = max(zone_x, 0)
+    top = max(zone_y, 0)
+    right = min(zone_x + z.width, canvas.width)
+    bottom = min(zone_y + z.height, canvas.height)
+    if left >= right or top >= bottom:
+        log.error(f'Zone {z.name} is entirely outside of the canvas')
+        return []
+
+    target = z.image.crop((left - zone_x, top - zone_y, right - zone_x, bottom - zone_y))
+    if target.size != z.image.size:
+        log.error(f'Zone {z.name} is partly outside of the canvas, skipping the pixels outside')
+    current = canvas.crop((left, top, right, bottom))
+
+    if z.indices is not None:
+        return get_incorrect_indices(z, current, (left, top, right, bottom))
+
+    target_bytes = target.tobytes()
+    width = right - left
+    repairs = []
+    for index in util.mask_indices(mismatch_mask(target, current)):
+        index_y, index_x = divmod(index, width)
+        offset = index * 4
+        colour = tuple(target_bytes[offset:offset + 3])
+        repairs.append((left + index_x, top + index_y, colour))
+
+    return repairs
@@ -1,12 +1,17 @@
 import asyncio
+import functools
+import hashlib
 import io
 import json
 import logging
+from concurrent.futures import Executor
 from datetime import datetime, timezone
+from typing import Optional
 
 import aiohttp
 from PIL import Image
 
+from . import diff
 from . import util
 from .api import APIBase
 
@@ -14,9 +19,6 @@ from .api import APIBase
 __version__ = '3.0.0'
 
 
-# todo: image scale in config
-
-
 EMBED_TITLE = 'Pixels State'
 EMBED_FOOTER = 'Last updated'
 WEBHOOK_USERNAME = 'Pixels-mirror'
@@ -24,7 +26,15 @@ WEBHOOK_AVATAR_URL = 'https://cdn.discordapp.com/attachments/' \
                      '925454123808194661/929059288683544606/controlmypc_logo_concept_v4.png'
 FILE_NAME_FORMAT = 'pixels_mirror_{timestamp}.png'
 IMAGE_SCALE = 2
+# zlib level for the png, 9 is smallest and slowest
+COMPRESS_LEVEL = 9
+PALETTE_MAX_COLOURS = 256
 UPDATE_INTERVAL_SECONDS = 60
+# how often to look for changes, backing off up to the max while nothing changes
+POLL_INTERVAL_SECONDS = 10
+POLL_INTERVAL_MAX_SECONDS = 300
+# upload straight away once this many pixels have changed
+CHANGE_THRESHOLD_PIXELS = 500
 
 
 # https://discord.com/developers/docs/resources/webhook
@@ -58,7 +68,7 @@ async def create_mirror(webhook_url: str) -> aiohttp.ClientResponse:
     return response
 
 
-async def edit_webhook(stream: io.BytesIO, message_id: int, webhook_url: str) -> aiohttp.ClientResponse:
+async def edit_webhook(image_bytes: bytes, message_id: int, webhook_url: str) -> aiohttp.ClientResponse:
     edit_url = f'{webhook_url}/messages/{message_id}'
     now = datetime.now(timezone.utc)
     embed = get_embed(now)
@@ -83,7 +93,7 @@ async def edit_webhook(stream: io.BytesIO, message_id: int, webhook_url: str) ->
     )
     form_data.add_field(
         name='files[0]',
-        value=stream.getvalue(),
+        value=image_bytes,
         content_type='image/png',
         filename=file_name
     )
@@ -93,22 +103,94 @@ async def edit_webhook(stream: io.BytesIO, message_id: int, webhook_url: str) ->
     return response
 
 
-async def update_mirror(canvas: Image.Image, message_id: int, webhook_url: str):
-    canvas_scaled = util.scale_image(canvas, IMAGE_SCALE, down=False)
+def encode_canvas(canvas: Image.Image, scale: int = IMAGE_SCALE, compress_level: int = COMPRESS_LEVEL) -> bytes:
+    """Encode the canvas as a png, as small as possible.
+
+    Canvases with few enough colours are stored with a palette, a byte per pixel instead of three.
+    A scale of 1 sends the canvas as is and leaves scaling it up to the embed.
+    """
+    colours = canvas.getcolors(PALETTE_MAX_COLOURS)
+    if colours is not None:
+        palette = Image.new('P', (1, 1))
+        palette.putpalette([channel for _, colour in colours for channel in colour[:3]])
+        # every colour is in the palette, so nothing gets changed
+        canvas = canvas.convert('RGB').quantize(palette=palette, dither=Image.NONE)
+    if scale != 1:
+        canvas = util.scale_image(canvas, scale, down=False)
+
     with io.BytesIO() as stream:
-        canvas_scaled.save(stream, format='PNG')
-        stream.seek(0)
+        canvas.save(stream, format='PNG', compress_level=compress_level)
+        return stream.getvalue()
 
-        return await edit_webhook(stream, message_id, webhook_url)
+
+async def update_mirror(
+        canvas: Image.Image, message_id: int, webhook_url: str, executor: Optional[Executor] = None,
+        scale: int = IMAGE_SCALE, compress_level: int = COMPRESS_LEVEL,
+):
+    loop = asyncio.get_event_loop()
+    # encoding is slow enough to hold up everything else on the loop
+    image_bytes = await loop.run_in_executor(executor, functools.partial(
+        encode_canvas, canvas, scale=scale, compress_level=compress_level
+    ))
+    log.debug(f'Encoded mirror image in {len(image_bytes)} bytes.')
+    return await edit_webhook(image_bytes, message_id, webhook_url)
+
+
+def hash_canvas(canvas: Image.Image) -> bytes:
+    return hashlib.blake2b(canvas.tobytes(), digest_size=16).digest()
 
 
 async def run(
-        message_id: int, webhook_url: str, api_instance: APIBase, interval: int = UPDATE_INTERVAL_SECONDS
+        message_id: int, webhook_url: str, api_instance: APIBase, interval: int = UPDATE_INTERVAL_SECONDS,
+        change_threshold: int = CHANGE_THRESHOLD_PIXELS, max_poll_interval: int = POLL_INTERVAL_MAX_SECONDS,
+        executor: Optional[Executor] = None, scale: int = IMAGE_SCALE, compress_level: int = COMPRESS_LEVEL,
 ):
+    """Keep the mirror up to date, only uploading when the canvas has changed.
+
+    Changes are uploaded at most every interval seconds,
+    or straight away once change_threshold pixels are different from the last upload.
+    All the work on the image itself happens in the executor, to keep the loop free.
+    """
+    loop = asyncio.get_event_loop()
+    poll_interval = min(POLL_INTERVAL_SECONDS, interval)
+    uploaded_canvas = None
+    uploaded_hash = None
+    uploaded_at = -interval
+    previous_hash = None
+
     while True:
-        log.info('Fetching canvas for mirror.')
+        log.debug('Fetching canvas for mirror.')
         canvas = await api_instance.get_pixels()
-        log.info('Updating mirror.')
-        await update_mirror(canvas, message_id, webhook_url)
-        log.info('Waiting %s seconds.', interval)
-        await asyncio.sleep(interval)
+        canvas_hash = await loop.run_in_executor(executor, hash_canvas, canvas)
+
+        if canvas_hash == previous_hash:
+            poll_interval = min(poll_interval * 2, max_poll_interval)
+        else:
+            poll_interval = min(POLL_INTERVAL_SECONDS, interval)
+        previous_hash = canvas_hash
+
+        if canvas_hash == uploaded_hash:
+            log.debug('Canvas unchanged, not updating mirror.')
+        else:
+            if uploaded_canvas is None:
+                changed_pixels = canvas.width * canvas.height
+            else:
+                changed_pixels = await loop.run_in_executor(
+                    executor, diff.count_different_pixels, canvas, uploaded_canvas
+                )
+            due = loop.time() - uploaded_at >= interval
+            if due or changed_pixels >= change_threshold:
+                log.info(f'Updating mirror, {changed_pixels} pixels changed.')
+                await update_mirror(
+                    canvas, message_id, webhook_url, executor=executor, scale=scale, compress_level=compress_level
+                )
+                uploaded_canvas = canvas
+                uploaded_hash = canvas_hash
+                uploaded_at = loop.time()
+
+        wait = poll_interval
+        if canvas_hash != uploaded_hash:
+            # don't back off past when the waiting changes are due
+            wait = min(wait, max(uploaded_at + interval - loop.time(), 0))
+        log.debug('Waiting %s seconds.', wait)
+        await asyncio.sleep(wait)
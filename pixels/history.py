@@ -0,0 +1,249 @@
+import asyncio
+import bisect
+import logging
+import mmap
+import struct
+import time
+import zlib
+from pathlib import Path
+from typing import Iterator, Optional, Union
+
+from PIL import Image
+
+from . import diff
+from . import util
+from .api import APIBase
+
+
+RECORD_INTERVAL_SECONDS = 60
+# write a whole frame at least this often, so rebuilding never replays too many deltas
+KEYFRAME_INTERVAL = 60
+# and whenever this much of the canvas changed, when a delta would be nearly as big anyway
+KEYFRAME_CHANGED_RATIO = 0.25
+COMPRESS_LEVEL = 6
+
+KIND_KEYFRAME = 1
+KIND_DELTA = 2
+# kind, timestamp, width, height, payload length
+RECORD_HEADER = struct.Struct('<BdHHI')
+# x, y, r, g, b
+DELTA_ENTRY = struct.Struct('<HHBBB')
+# timestamp, offset of the record, offset of the keyframe it builds on
+INDEX_ENTRY = struct.Struct('<dQQ')
+
+
+log = logging.getLogger(__name__)
+
+
+def get_index_path(path: Path) -> Path:
+    return path.with_name(path.name + '.idx')
+
+
+class MappedFile:
+    """A read only memory map of a file that is being appended to, remapped when it grows."""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.mmap: Optional[mmap.mmap] = None
+        self.size = 0
+
+    def refresh(self):
+        size = self.path.stat().st_size if self.path.exists() else 0
+        if size == self.size:
+            return
+        if self.mmap is not None:
+            self.mmap.close()
+            self.mmap = None
+        self.size = size
+        if size:
+            with open(self.path, 'rb') as file:
+                self.mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def close(self):
+        if self.mmap is not None:
+            self.mmap.close()
+            self.mmap = None
+        self.size = 0
+
+
+class IndexTimestamps:
+    """The timestamps in an index file, as a sequence that bisect can search without reading the rest."""
+
+    def __init__(self, index: MappedFile):
+        self.index = index
+
+    def __len__(self) -> int:
+        return self.index.size // INDEX_ENTRY.size
+
+    def __getitem__(self, position: int) -> float:
+        return INDEX_ENTRY.unpack_from(self.index.mmap, position * INDEX_ENTRY.size)[0]
+
+
+class CanvasHistory:
+    """Random access to a recorded history, by memory mapping the log and its index."""
+
+    def __init__(self, path: Union[str, Path]):
+        self.path = Path(path)
+        self.data = MappedFile(self.path)
+        self.index = MappedFile(get_index_path(self.path))
+        self.timestamps = IndexTimestamps(self.index)
+        self.refresh()
+
+    def refresh(self):
+        """Pick up anything recorded since the history was opened."""
+        self.data.refresh()
+        self.index.refresh()
+
+    def close(self):
+        self.data.close()
+        self.index.close()
+
+    def __len__(self) -> int:
+        return len(self.timestamps)
+
+    def get_entry(self, position: int) -> tuple[float, int, int]:
+        return INDEX_ENTRY.unpack_from(self.index.mmap, position * INDEX_ENTRY.size)
+
+    def find(self, timestamp: float) -> int:
+        """Get the position of the last record at or before timestamp. Raises ValueError if there isn't one."""
+        position = bisect.bisect_right(self.timestamps, timestamp) - 1
+        if position < 0:
+            raise ValueError(f'Nothing was recorded before {timestamp}.')
+        return position
+
+    def read_record(self, offset: int) -> tuple[int, float, int, int, bytes, int]:
+        """Read the record at offset and return its kind, timestamp, size, payload and where the next one starts."""
+        kind, timestamp, width, height, length = RECORD_HEADER.unpack_from(self.data.mmap, offset)
+        start = offset + RECORD_HEADER.size
+        payload = zlib.decompress(self.data.mmap[start:start + length])
+        return kind, timestamp, width, height, payload, start + length
+
+    @staticmethod
+    def apply_record(canvas: Optional[Image.Image], kind: int, width: int, height: int, payload: bytes) -> Image.Image:
+        if kind == KIND_KEYFRAME:
+            return util.bytes_to_image(payload, width, height)
+        for x, y, red, green, blue in DELTA_ENTRY.iter_unpack(payload):
+            canvas.putpixel((x, y), (red, green, blue))
+        return canvas
+
+    def get_canvas_at_position(self, position: int) -> Image.Image:
+        """Rebuild the canvas as of a record, starting from the keyframe before it."""
+        _, end_offset, offset = self.get_entry(position)
+        canvas = None
+        while offset <= end_offset:
+            kind, _, width, height, payload, offset = self.read_record(offset)
+            canvas = self.apply_record(canvas, kind, width, height, payload)
+        return canvas
+
+    def get_canvas(self, timestamp: float) -> Image.Image:
+        """Rebuild the canvas as it was at timestamp."""
+        return self.get_canvas_at_position(self.find(timestamp))
+
+    def iter_canvases(self, start: Optional[float] = None) -> Iterator[tuple[float, Image.Image]]:
+        """Replay the history from start, yielding the timestamp and canvas after each record.
+
+        The same canvas is updated in place and yielded each time, so copy it to keep it.
+        """
+        if not len(self):
+            return
+        first = 0
+        if start is not None and start >= self.timestamps[0]:
+            first = self.find(start)
+
+        canvas = self.get_canvas_at_position(first)
+        yield self.timestamps[first], canvas
+        # only go as far as the index, a record past it might not be all there yet
+        for position in range(first + 1, len(self)):
+            timestamp, offset, _ = self.get_entry(position)
+            kind, _, width, height, payload, _ = self.read_record(offset)
+            canvas = self.apply_record(canvas, kind, width, height, payload)
+            yield timestamp, canvas
+
+
+class HistoryRecorder:
+    """Appends canvases to a log as keyframes and deltas of the pixels that changed, with an index for lookups."""
+
+    def __init__(
+            self,
+            path: Union[str, Path],
+            keyframe_interval: int = KEYFRAME_INTERVAL,
+            keyframe_changed_ratio: float = KEYFRAME_CHANGED_RATIO,
+    ):
+        self.path = Path(path)
+        self.index_path = get_index_path(self.path)
+        self.keyframe_interval = keyframe_interval
+        self.keyframe_changed_ratio = keyframe_changed_ratio
+
+        self.previous: Optional[Image.Image] = None
+        self.keyframe_offset = 0
+        self.deltas_since_keyframe = 0
+
+        # carry on from the end of an existing log
+        history = CanvasHistory(self.path)
+        if len(history):
+            _, _, self.keyframe_offset = history.get_entry(len(history) - 1)
+            self.deltas_since_keyframe = self.keyframe_interval
+            self.previous = history.get_canvas_at_position(len(history) - 1)
+        history.close()
+
+    def get_delta(self, canvas: Image.Image) -> Optional[bytes]:
+        """Pack the pixels that changed since the last record, or None if a keyframe would be better."""
+        if self.previous is None or self.previous.size != canvas.size:
+            return None
+        if self.deltas_since_keyframe >= self.keyframe_interval:
+            return None
+
+        indices = util.mask_indices(diff.difference_mask(self.previous, canvas))
+        if len(indices) > self.keyframe_changed_ratio * canvas.width * canvas.height:
+            return None
+
+        canvas_bytes = canvas.tobytes()
+        entries = bytearray()
+        for index in indices:
+            index_y, index_x = divmod(index, canvas.width)
+            offset = index * 3
+            entries += DELTA_ENTRY.pack(index_x, index_y, *canvas_bytes[offset:offset + 3])
+        return bytes(entries)
+
+    def record(self, canvas: Image.Image, timestamp: Optional[float] = None) -> bool:
+        """Append a canvas to the log, and return whether anything had changed and was written."""
+        if timestamp is None:
+            timestamp = time.time()
+        canvas = canvas.convert('RGB')
+
+        delta = self.get_delta(canvas)
+        if delta == b'':
+            return False
+        if delta is None:
+            kind = KIND_KEYFRAME
+            payload = canvas.tobytes()
+        else:
+            kind = KIND_DELTA
+            payload = delta
+        payload = zlib.compress(payload, COMPRESS_LEVEL)
+
+        with open(self.path, 'ab') as data_file:
+            offset = data_file.tell()
+            data_file.write(RECORD_HEADER.pack(kind, timestamp, canvas.width, canvas.height, len(payload)))
+            data_file.write(payload)
+        if kind == KIND_KEYFRAME:
+            self.keyframe_offset = offset
+            self.deltas_since_keyframe = 0
+        else:
+            self.deltas_since_keyframe += 1
+        # the index is written last, so readers never find a record that isn't all there yet
+        with open(self.index_path, 'ab') as index_file:
+            index_file.write(INDEX_ENTRY.pack(timestamp, offset, self.keyframe_offset))
+
+        self.previous = canvas
+        return True
+
+
+async def run(api_instance: APIBase, recorder: HistoryRecorder, interval: float = RECORD_INTERVAL_SECONDS):
+    """Record the canvas every interval seconds."""
+    loop = asyncio.get_event_loop()
+    while True:
+        canvas = await api_instance.get_pixels()
+        recorded = await loop.run_in_executor(None, recorder.record, canvas)
+        log.debug('Recorded canvas history.' if recorded else 'Canvas unchanged, nothing to record.')
+        await asyncio.sleep(interval)
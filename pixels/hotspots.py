@@ -0,0 +1,109 @@
+import asyncio
+import collections
+import logging
+import math
+from typing import Optional
+
+
+TILE_SIZE = 8
+# damage this much older counts for half as much
+HEAT_HALF_LIFE_SECONDS = 600
+# tiles cooler than this aren't worth spending requests on
+MIN_PROBE_HEAT = 0.5
+# how many of the colours used against each tile to remember
+TOP_COLOURS = 4
+
+Tile = tuple[int, int]
+
+
+log = logging.getLogger(__name__)
+
+
+class TileStats:
+    """How much and how recently a tile has been damaged."""
+
+    __slots__ = ('heat', 'updated_at', 'count', 'last_damaged_at', 'colours')
+
+    def __init__(self):
+        self.heat = 0.0
+        self.updated_at = 0.0
+        self.count = 0
+        self.last_damaged_at = 0.0
+        self.colours: collections.Counter = collections.Counter()
+
+
+class HotspotTracker:
+    """Decaying heat per tile of the canvas, from how often its pixels were overwritten with the wrong colour.
+
+    Each piece of damage adds 1 to its tile's heat, which halves every half_life seconds,
+    so the heat is roughly the recent rate of damage.
+    Decay is worked out when a tile is read or written, never for every tile at once.
+    """
+
+    def __init__(self, tile_size: int = TILE_SIZE, half_life: float = HEAT_HALF_LIFE_SECONDS):
+        self.tile_size = tile_size
+        self.half_life = half_life
+        self.tiles: dict[Tile, TileStats] = {}
+
+    @staticmethod
+    def time() -> float:
+        return asyncio.get_event_loop().time()
+
+    def get_tile(self, x: int, y: int) -> Tile:
+        return x // self.tile_size, y // self.tile_size
+
+    def get_tile_box(self, tile: Tile) -> tuple[int, int, int, int]:
+        left = tile[0] * self.tile_size
+        top = tile[1] * self.tile_size
+        return left, top, left + self.tile_size, top + self.tile_size
+
+    def decayed(self, stats: TileStats, now: float) -> float:
+        return stats.heat * 2 ** (-(now - stats.updated_at) / self.half_life)
+
+    def record_damage(self, x: int, y: int, colour: tuple[int, ...], now: Optional[float] = None):
+        """Note that a pixel was found overwritten with colour."""
+        if now is None:
+            now = self.time()
+        tile = self.get_tile(x, y)
+        stats = self.tiles.get(tile)
+        if stats is None:
+            stats = self.tiles[tile] = TileStats()
+
+        stats.heat = self.decayed(stats, now) + 1
+        stats.updated_at = now
+        stats.count += 1
+        stats.last_damaged_at = now
+        stats.colours[tuple(colour[:3])] += 1
+        if len(stats.colours) > TOP_COLOURS * 2:
+            # keep it bounded, most_common is stable so older favourites win ties
+            stats.colours = collections.Counter(dict(stats.colours.most_common(TOP_COLOURS)))
+
+    def get_heat(self, x: int, y: int, now: Optional[float] = None) -> float:
+        stats = self.tiles.get(self.get_tile(x, y))
+        if stats is None:
+            return 0.0
+        return self.decayed(stats, self.time() if now is None else now)
+
+    def get_priority(self, x: int, y: int, now: Optional[float] = None) -> float:
+        """How much more a repair here is worth than one in a quiet tile, as a log2 to add to a heap key."""
+        return math.log2(1 + self.get_heat(x, y, now))
+
+    def get_hottest(self, count: int, min_heat: float = MIN_PROBE_HEAT) -> list[tuple[Tile, float]]:
+        """Get up to count of the hottest tiles and their heat, hottest first, forgetting any that have gone cold."""
+        now = self.time()
+        heats = []
+        for tile, stats in list(self.tiles.items()):
+            heat = self.decayed(stats, now)
+            if heat < min_heat / 100:
+                del self.tiles[tile]
+            elif heat >= min_heat:
+                heats.append((tile, heat))
+        heats.sort(key=lambda tile_heat: tile_heat[1], reverse=True)
+        return heats[:count]
+
+    def get_colours(self, tile: Tile) -> list[tuple[int, ...]]:
+        """Get the colours most often used against a tile, most often first."""
+        stats = self.tiles.get(tile)
+        if stats is None:
+            return []
+        return [colour for colour, _ in stats.colours.most_common(TOP_COLOURS)]
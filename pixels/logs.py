@@ -0,0 +1,93 @@
+import atexit
+import logging
+import logging.handlers
+import queue
+import time
+from typing import Callable
+
+
+# loggers for a line per pixel are named like this, so they can be sampled separately
+DETAIL_SUFFIX = '.detail'
+DETAIL_RATE_PER_SECOND = 1.0
+LOG_MODES = ('verbose', 'summary')
+
+
+def get_detail_logger(name: str) -> logging.Logger:
+    """Get the logger a module should use for its lines about individual pixels."""
+    return logging.getLogger(name + DETAIL_SUFFIX)
+
+
+class Lazy:
+    """Put off building a log argument until the record is actually formatted."""
+
+    def __init__(self, function: Callable[..., str], *args):
+        self.function = function
+        self.args = args
+
+    def __str__(self) -> str:
+        return self.function(*self.args)
+
+
+class DetailRateFilter(logging.Filter):
+    """Let through at most rate detail records a second, and every other record.
+
+    The next detail record let through says how many were dropped since the last one.
+    """
+
+    def __init__(self, rate: float = DETAIL_RATE_PER_SECOND):
+        super().__init__()
+        self.rate = rate
+        # room for at least one record, or a rate below 1 a second would never let any through
+        self.burst = max(rate, 1)
+        self.allowance = self.burst
+        self.last_checked = time.monotonic()
+        self.suppressed = 0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if not record.name.endswith(DETAIL_SUFFIX):
+            return True
+
+        now = time.monotonic()
+        self.allowance = min(self.allowance + (now - self.last_checked) * self.rate, self.burst)
+        self.last_checked = now
+        if self.allowance < 1:
+            self.suppressed += 1
+            return False
+        self.allowance -= 1
+        if self.suppressed:
+            # formatted here, but only for the few records that get through
+            record.msg = f'{record.getMessage()} ({self.suppressed} similar lines suppressed)'
+            record.args = None
+            self.suppressed = 0
+        return True
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """Queue records as they are, so they're only formatted on the listener's thread.
+
+    The default prepare() formats the message before queueing it,
+    which is the work we're trying to get off the hot path.
+    Records never leave this process, so there's nothing to make picklable.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+def use_summary_mode(detail_rate: float = DETAIL_RATE_PER_SECOND) -> logging.handlers.QueueListener:
+    """Sample the per pixel lines, and move formatting and writing the logs onto a background thread."""
+    root = logging.getLogger()
+    handlers = root.handlers[:]
+    for handler in handlers:
+        root.removeHandler(handler)
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = DeferredQueueHandler(log_queue)
+    queue_handler.addFilter(DetailRateFilter(detail_rate))
+    root.addHandler(queue_handler)
+
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    # flush whatever's left when the process exits
+    atexit.register(listener.stop)
+    return listener
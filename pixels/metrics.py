@@ -0,0 +1,202 @@
+import asyncio
+import bisect
+import json
+import logging
+import math
+import os
+from pathlib import Path
+from typing import Union
+
+from aiohttp import web
+
+
+HOST = 'localhost'
+SNAPSHOT_INTERVAL_SECONDS = 60
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, math.inf)
+
+Labels = tuple[tuple[str, str], ...]
+
+
+log = logging.getLogger(__name__)
+
+
+def get_labels(labels: dict) -> Labels:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def escape_label_value(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(labels: Labels, extra: Labels = ()) -> str:
+    labels = labels + extra
+    if not labels:
+        return ''
+    pairs = ','.join(f'{key}="{escape_label_value(value)}"' for key, value in labels)
+    return '{' + pairs + '}'
+
+
+def format_bucket(bucket: float) -> str:
+    return '+Inf' if bucket == math.inf else str(bucket)
+
+
+class Histogram:
+    def __init__(self, buckets: tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative_counts(self) -> list[int]:
+        cumulative = []
+        total = 0
+        for count in self.counts:
+            total += count
+            cumulative.append(total)
+        return cumulative
+
+
+class Metrics:
+    """Counters, gauges and histograms, each split by labels, in the shape prometheus expects."""
+
+    def __init__(self):
+        self.counters: dict[str, dict[Labels, float]] = {}
+        self.gauges: dict[str, dict[Labels, float]] = {}
+        self.histograms: dict[str, dict[Labels, Histogram]] = {}
+        self.descriptions: dict[str, str] = {}
+
+    def describe(self, name: str, description: str):
+        self.descriptions[name] = description
+
+    def inc(self, name: str, value: float = 1, **labels):
+        series = self.counters.setdefault(name, {})
+        key = get_labels(labels)
+        series[key] = series.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels):
+        self.gauges.setdefault(name, {})[get_labels(labels)] = value
+
+    def observe(self, name: str, value: float, buckets: tuple[float, ...] = LATENCY_BUCKETS, **labels):
+        series = self.histograms.setdefault(name, {})
+        key = get_labels(labels)
+        if key not in series:
+            series[key] = Histogram(buckets)
+        series[key].observe(value)
+
+    def get(self, name: str, **labels) -> float:
+        """Get the value of a counter or gauge, or 0 if it hasn't been touched yet."""
+        key = get_labels(labels)
+        series = self.counters.get(name) or self.gauges.get(name) or {}
+        return series.get(key, 0)
+
+    def to_prometheus(self) -> str:
+        """Format every metric in the prometheus text exposition format."""
+        lines = []
+        for metric_type, metrics in (('counter', self.counters), ('gauge', self.gauges)):
+            for name, series in metrics.items():
+                if name in self.descriptions:
+                    lines.append(f'# HELP {name} {self.descriptions[name]}')
+                lines.append(f'# TYPE {name} {metric_type}')
+                for labels, value in series.items():
+                    lines.append(f'{name}{format_labels(labels)} {value}')
+
+        for name, series in self.histograms.items():
+            if name in self.descriptions:
+                lines.append(f'# HELP {name} {self.descriptions[name]}')
+            lines.append(f'# TYPE {name} histogram')
+            for labels, histogram in series.items():
+                for bucket, count in zip(histogram.buckets, histogram.cumulative_counts()):
+                    bucket_label = (('le', format_bucket(bucket)),)
+                    lines.append(f'{name}_bucket{format_labels(labels, bucket_label)} {count}')
+                lines.append(f'{name}_sum{format_labels(labels)} {histogram.sum}')
+                lines.append(f'{name}_count{format_labels(labels)} {histogram.count}')
+
+        return '\n'.join(lines) + '\n'
+
+    def to_dict(self) -> dict:
+        """Get every metric as plain data, for a json snapshot."""
+        def series_list(series: dict[Labels, float]) -> list[dict]:
+            return [{'labels': dict(labels), 'value': value} for labels, value in series.items()]
+
+        histograms = {}
+        for name, series in self.histograms.items():
+            histograms[name] = [
+                {
+                    'labels': dict(labels),
+                    'buckets': dict(zip(map(format_bucket, h.buckets), h.cumulative_counts())),
+                    'sum': h.sum,
+                    'count': h.count,
+                }
+                for labels, h in series.items()
+            ]
+
+        return {
+            'counters': {name: series_list(series) for name, series in self.counters.items()},
+            'gauges': {name: series_list(series) for name, series in self.gauges.items()},
+            'histograms': histograms,
+        }
+
+
+# the one everything records to, through the functions below, like the root logger
+registry = Metrics()
+inc = registry.inc
+set_gauge = registry.set
+observe = registry.observe
+registry.describe('pixels_request_seconds', 'Time from sending a request to getting the response headers.')
+registry.describe('pixels_response_bytes_total', 'Bytes of response bodies received.')
+registry.describe('pixels_ratelimit_sleep_seconds_total', 'Time spent waiting for rate limits before requests.')
+registry.describe('pixels_canvas_unchanged_total', 'Canvas downloads skipped because it hadn\'t changed.')
+registry.describe('pixels_placed_total', 'Pixels the api accepted.')
+registry.describe('pixels_failed_total', 'Pixels the api refused.')
+registry.describe('pixels_verified_total', 'Pixels checked with a read before writing them.')
+registry.describe('pixels_skipped_total', 'Pixels that turned out to be right already and were not written.')
+registry.describe('pixels_damaged_total', 'Zone pixels seen overwritten with the wrong colour.')
+registry.describe('pixels_probed_total', 'Pixels in hot tiles checked between refreshes.')
+registry.describe('pixels_queue_depth', 'Incorrect pixels waiting to be repaired.')
+registry.describe('pixels_zone_correct_ratio', 'Fraction of each zone\'s opaque pixels that are right.')
+registry.describe('pixels_workers_connected', 'Worker processes connected to the coordinator.')
+registry.describe('pixels_worker_queue_depth', 'Incorrect pixels waiting in each worker\'s repair queue.')
+registry.describe('pixels_job_up', 'Whether each supervised job is running, 1 or 0.')
+registry.describe('pixels_job_restarts_total', 'Times each supervised job failed and was restarted.')
+
+
+async def handle_metrics(request: web.Request) -> web.Response:
+    return web.Response(text=registry.to_prometheus(), content_type='text/plain', charset='utf-8')
+
+
+async def handle_metrics_json(request: web.Request) -> web.Response:
+    return web.json_response(registry.to_dict())
+
+
+async def serve(port: int, host: str = HOST) -> web.AppRunner:
+    """Serve the metrics at /metrics for prometheus and /metrics.json, in the background."""
+    app = web.Application()
+    app.add_routes([
+        web.get('/metrics', handle_metrics),
+        web.get('/metrics.json', handle_metrics_json),
+    ])
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    log.info(f'Serving metrics at http://{host}:{port}/metrics')
+    return runner
+
+
+def write_snapshot(path: Union[str, Path]):
+    path = Path(path)
+    temp_path = path.with_suffix('.tmp')
+    temp_path.write_text(json.dumps(registry.to_dict()))
+    os.replace(temp_path, path)
+
+
+async def write_snapshots(path: Union[str, Path], interval: float = SNAPSHOT_INTERVAL_SECONDS):
+    """Write the metrics to a json file every interval seconds."""
+    while True:
+        await asyncio.sleep(interval)
+        write_snapshot(path)
+
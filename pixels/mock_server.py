@@ -0,0 +1,283 @@
+import argparse
+import asyncio
+import base64
+import io
+import json
+import logging
+import weakref
+from typing import Optional
+
+from aiohttp import web
+from PIL import Image
+
+from . import util
+
+
+__version__ = '1.0.0'
+
+
+HOST = 'localhost'
+PORT = 8080
+CANVAS_WIDTH = 960
+CANVAS_HEIGHT = 540
+CANVAS_COLOUR = (255, 255, 255)
+PROTOCOLS = ('cmpc', 'python_discord')
+
+
+log = logging.getLogger(__name__)
+
+
+class MockCanvas:
+    """The canvas and the websockets listening to it."""
+
+    def __init__(self, width: int = CANVAS_WIDTH, height: int = CANVAS_HEIGHT):
+        self.image = Image.new('RGB', (width, height), CANVAS_COLOUR)
+        self.websockets = weakref.WeakSet()
+        # bumped on every change, for etags
+        self.version = 0
+        self.dataurl: Optional[tuple[int, str]] = None
+
+    @property
+    def etag(self) -> str:
+        return f'"{self.version}"'
+
+    def set_pixel(self, x: int, y: int, colour: list[int]):
+        self.image.putpixel((x, y), tuple(colour))
+        self.version += 1
+        message = json.dumps({'X': x, 'Y': y, 'Color': util.rgb_to_hex(colour)})
+        for websocket in self.websockets:
+            asyncio.ensure_future(websocket.send_str(message))
+
+    def get_dataurl(self) -> str:
+        # only encode it again if it changed
+        if self.dataurl is not None and self.dataurl[0] == self.version:
+            return self.dataurl[1]
+        with io.BytesIO() as stream:
+            self.image.save(stream, format='PNG')
+            image_b64 = base64.b64encode(stream.getvalue()).decode()
+        self.dataurl = (self.version, 'data:image/png;base64,' + image_b64)
+        return self.dataurl[1]
+
+
+class MockRateLimit:
+    """Allows limit requests per period seconds, and puts anything over that on cooldown, like python discord."""
+
+    def __init__(self, limit: int, period: float, cooldown: float):
+        self.limit = limit
+        self.period = period
+        self.cooldown = cooldown
+        self.remaining = limit
+        self.reset_at = 0.0
+        self.cooldown_until = 0.0
+
+    def check(self) -> dict[str, str]:
+        """Count a request, and return the headers to send with it. Raises HTTPTooManyRequests if over the limit."""
+        now = asyncio.get_event_loop().time()
+        if now < self.cooldown_until:
+            raise web.HTTPTooManyRequests(headers={'cooldown-reset': str(self.cooldown_until - now)})
+        if now >= self.reset_at:
+            self.remaining = self.limit
+            self.reset_at = now + self.period
+        if self.remaining <= 0:
+            self.cooldown_until = now + self.cooldown
+            raise web.HTTPTooManyRequests(headers={'cooldown-reset': str(self.cooldown)})
+
+        self.remaining -= 1
+        return {
+            'requests-limit': str(self.limit),
+            'requests-remaining': str(self.remaining),
+            'requests-reset': str(self.reset_at - now),
+        }
+
+
+class MockStats:
+    """What the server has been asked to do, for benchmarks."""
+
+    def __init__(self):
+        self.requests: dict[str, int] = {}
+        self.rejected = 0
+        self.bytes_sent = 0
+
+    def to_dict(self) -> dict:
+        return {
+            'requests': self.requests,
+            'rejected': self.rejected,
+            'bytes_sent': self.bytes_sent,
+        }
+
+
+@web.middleware
+async def simulate_network(request: web.Request, handler) -> web.StreamResponse:
+    """Add latency, rate limits and request counting to every endpoint."""
+    app = request.app
+    stats = app['stats']
+    stats.requests[request.path] = stats.requests.get(request.path, 0) + 1
+    if app['latency']:
+        await asyncio.sleep(app['latency'])
+
+    headers = {}
+    if app['ratelimit'] is not None and request.path not in ('/live', '/auth'):
+        ratelimits = app['ratelimits']
+        if request.path not in ratelimits:
+            ratelimits[request.path] = MockRateLimit(*app['ratelimit'])
+        try:
+            headers = ratelimits[request.path].check()
+        except web.HTTPTooManyRequests:
+            stats.rejected += 1
+            raise
+
+    response = await handler(request)
+    response.headers.update(headers)
+    if isinstance(response, web.Response) and response.body is not None:
+        stats.bytes_sent += len(response.body)
+    return response
+
+
+async def auth(request: web.Request) -> web.Response:
+    return web.Response()
+
+
+async def fetch(request: web.Request) -> web.Response:
+    canvas = request.app['canvas']
+    headers = {'ETag': canvas.etag}
+    if request.headers.get('If-None-Match') == canvas.etag:
+        return web.Response(status=304, headers=headers)
+    return web.json_response({'DataURL': canvas.get_dataurl()}, headers=headers)
+
+
+async def set_pixel(request: web.Request) -> web.Response:
+    canvas = request.app['canvas']
+    payload = await request.json()
+    x = payload['X']
+    y = payload['Y']
+    if not (0 <= x < canvas.image.width and 0 <= y < canvas.image.height):
+        raise web.HTTPBadRequest(text='pixel is outside of the canvas')
+    canvas.set_pixel(x, y, util.hex_to_rgb(payload['Color']))
+    return web.Response()
+
+
+async def live(request: web.Request) -> web.WebSocketResponse:
+    websocket = web.WebSocketResponse()
+    await websocket.prepare(request)
+    request.app['canvas'].websockets.add(websocket)
+    async for _ in websocket:
+        pass
+    return websocket
+
+
+async def pd_get_size(request: web.Request) -> web.Response:
+    image = request.app['canvas'].image
+    return web.json_response({'width': image.width, 'height': image.height})
+
+
+async def pd_get_pixels(request: web.Request) -> web.Response:
+    return web.Response(body=request.app['canvas'].image.tobytes(), content_type='application/octet-stream')
+
+
+async def pd_get_pixel(request: web.Request) -> web.Response:
+    image = request.app['canvas'].image
+    x = int(request.query['x'])
+    y = int(request.query['y'])
+    if not (0 <= x < image.width and 0 <= y < image.height):
+        raise web.HTTPBadRequest(text='pixel is outside of the canvas')
+    return web.json_response({'x': x, 'y': y, 'rgb': util.rgb_to_hex(image.getpixel((x, y)), prefix='')})
+
+
+async def pd_set_pixel(request: web.Request) -> web.Response:
+    canvas = request.app['canvas']
+    payload = await request.json()
+    x = payload['x']
+    y = payload['y']
+    if not (0 <= x < canvas.image.width and 0 <= y < canvas.image.height):
+        raise web.HTTPBadRequest(text='pixel is outside of the canvas')
+    canvas.set_pixel(x, y, util.hex_to_rgb(payload['rgb']))
+    return web.json_response({'message': f'added pixel at x={x},y={y} of color {payload["rgb"]}'})
+
+
+def get_app(
+        canvas: MockCanvas = None,
+        protocol: str = 'cmpc',
+        latency: float = 0,
+        ratelimit: Optional[tuple[int, float, float]] = None,
+) -> web.Application:
+    """Get an app serving the endpoints of one of the apis, plus a /live websocket of pixel updates.
+
+    latency is added to every response,
+    and ratelimit is (limit, period, cooldown) for each endpoint, or None for no rate limits.
+    """
+    app = web.Application(middlewares=[simulate_network])
+    app['canvas'] = canvas if canvas is not None else MockCanvas()
+    app['latency'] = latency
+    app['ratelimit'] = ratelimit
+    app['ratelimits'] = {}
+    app['stats'] = MockStats()
+
+    if protocol == 'cmpc':
+        app.add_routes([
+            web.post('/auth', auth),
+            web.get('/fetch', fetch),
+            web.post('/set', set_pixel),
+        ])
+    elif protocol == 'python_discord':
+        app.add_routes([
+            web.get('/get_size', pd_get_size),
+            web.get('/get_pixels', pd_get_pixels),
+            web.get('/get_pixel', pd_get_pixel),
+            web.post('/set_pixel', pd_set_pixel),
+        ])
+    else:
+        raise ValueError(f'Unknown protocol "{protocol}", expected one of {PROTOCOLS}.')
+    app.add_routes([web.get('/live', live)])
+    return app
+
+
+async def webhook_message(request: web.Request) -> web.Response:
+    uploads = request.app['uploads']
+    body = await request.read()
+    uploads.append(len(body))
+    return web.json_response({'id': request.match_info.get('message_id', '0')})
+
+
+def get_webhook_app() -> web.Application:
+    """Get an app that accepts discord webhook messages and edits, and records the size of each."""
+    app = web.Application()
+    app['uploads'] = []
+    app.add_routes([
+        web.post('/webhook', webhook_message),
+        web.patch('/webhook/messages/{message_id}', webhook_message),
+    ])
+    return app
+
+
+def get_parser() -> argparse.ArgumentParser:
+    """Get this script's parser."""
+    parser = argparse.ArgumentParser(description='run a local stand-in for the pixels api')
+
+    parser.add_argument('--version', action='version', version=__version__)
+    parser.add_argument('--host', default=HOST, help='default %(default)s')
+    parser.add_argument('--port', type=int, default=PORT, help='default %(default)s')
+    parser.add_argument('--width', type=int, default=CANVAS_WIDTH, help='default %(default)s')
+    parser.add_argument('--height', type=int, default=CANVAS_HEIGHT, help='default %(default)s')
+    parser.add_argument('--protocol', choices=PROTOCOLS, default='cmpc', help='default %(default)s')
+    parser.add_argument('--latency', type=float, default=0, help='seconds added to each response')
+    parser.add_argument(
+        '--ratelimit', type=float, nargs=3, metavar=('LIMIT', 'PERIOD', 'COOLDOWN'),
+        help='allow LIMIT requests to each endpoint per PERIOD seconds, with a COOLDOWN for going over'
+    )
+
+    return parser
+
+
+def main():
+    parser = get_parser()
+    args = parser.parse_args()
+    ratelimit = None
+    if args.ratelimit is not None:
+        limit, period, cooldown = args.ratelimit
+        ratelimit = (int(limit), period, cooldown)
+    app = get_app(MockCanvas(args.width, args.height), args.protocol, args.latency, ratelimit)
+    web.run_app(app, host=args.host, port=args.port)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,64 +1,168 @@
+import asyncio
+import logging
 from random import choices, randint
+from typing import Optional
 
-from PIL import Image
-import api
+from PIL import Image, ImageChops
 
+from . import diff
+from . import scheduler
+from . import util
+from . import zone
+from .api import APIBase
 
-# todo: fix
 
-
-__version__ = '0.1.0'
+__version__ = '1.0.0'
 
 HEX_CHARS = '0123456789abcdef'
+SAME_NEIGHBOUR_THRESHOLD = 7
+BATCH_SIZE = 100
+NOISE_INTERVAL_SECONDS = 60
+# offsets of the eight neighbours, in the order candidates for the most common colour are tried
+NEIGHBOUR_OFFSETS = ((-1, -1), (0, -1), (1, -1), (-1, 0), (1, 0), (-1, 1), (0, 1), (1, 1))
+
+# a pixel to recolour, as (x, y, (r, g, b)), how many neighbours agree on the colour, and its priority
+NoiseFix = tuple[int, int, tuple[int, int, int], int, float]
+
+
+log = logging.getLogger(__name__)
 
 
-def add_noise(canvas_size: dict, headers: dict):
+async def add_noise(api_instance: APIBase):
     """Do not use."""
-    x_coord = randint(0, canvas_size['width'])
-    y_coord = randint(0, canvas_size['height'])
+    canvas_size = await api_instance.get_size()
+    x_coord = randint(0, canvas_size['width'] - 1)
+    y_coord = randint(0, canvas_size['height'] - 1)
     colour = ''.join(choices(HEX_CHARS, k=6))
-    api.set_pixel(x_coord, y_coord, colour, headers)
+    await api_instance.set_pixel(x_coord, y_coord, util.hex_to_rgb(colour))
 
 
-def get_neighbour_pixels(x: int, y: int, image: Image.Image) -> list[str]:
-    """Return the eight pixels that neighbour the given co-ordinates.
+def equal_mask(first: Image.Image, second: Image.Image) -> Image.Image:
+    """Get a mask that is 1 where two images of the same size have the same colour, to be summed."""
+    return diff.difference_mask(first, second).point(lambda v: 0 if v else 1)
 
-    Raises IndexError if the pixel is a corner pixel and thus has less than eight neighbours.
-    """
-    neighbours = []
-    for y_neighbour_coord in [y-1, y, y+1]:
-        x_neighbour_range = [x-1, x, x+1]
-        if y_neighbour_coord == y:
-            x_neighbour_range.remove(x)
-
-        for x_neighbour_coord in x_neighbour_range:
-            if x_neighbour_coord < 0 or y_neighbour_coord < 0:
-                raise IndexError('pixel is edge pixel')
 
-            try:
-                neighbours.append(image.getpixel((x_neighbour_coord, y_neighbour_coord)))
-            except IndexError as error:
-                raise IndexError('pixel is edge pixel') from error
+def get_zone_mask(zones: list[zone.Zone], size: tuple[int, int]) -> Image.Image:
+    """Get a canvas sized mask that is 255 wherever a zone wants a pixel."""
+    mask = Image.new('L', size, 0)
+    for z in zones:
+        mask.paste(255, z.coords, mask=util.binary_mask(z.image.getchannel('A')))
+    return mask
 
-    return neighbours
 
+def find_noise(
+        canvas: Image.Image,
+        same_neighbour_threshold: int = SAME_NEIGHBOUR_THRESHOLD,
+        exclude: Optional[Image.Image] = None,
+) -> list[NoiseFix]:
+    """Find pixels surrounded by at least same_neighbour_threshold neighbours of one other colour.
 
-def remove_noise(image: Image.Image, headers: dict, same_neighbour_threshold: int = 7):
+    Works on the whole canvas at once by comparing shifted copies of it, one per neighbour.
+    The most common neighbour colour has to be one of any 9 - threshold neighbours,
+    so only that many are tried as candidates, each counted against all eight.
+    Edge pixels don't have eight neighbours and are left alone, as is anywhere exclude, a canvas sized mask, is set.
+    Returns the fixes ranked by priority, the most agreed on and most noticeable first.
+    """
+    if not 1 <= same_neighbour_threshold <= 8:
+        raise ValueError('The same neighbour threshold must be between 1 and 8.')
+    if canvas.mode != 'RGB':
+        canvas = canvas.convert('RGB')
+    width, height = canvas.width - 2, canvas.height - 2
+    if width <= 0 or height <= 0:
+        return []
+
+    centre = canvas.crop((1, 1, width + 1, height + 1))
+    neighbours = [
+        canvas.crop((1 + offset_x, 1 + offset_y, width + 1 + offset_x, height + 1 + offset_y))
+        for offset_x, offset_y in NEIGHBOUR_OFFSETS
+    ]
+    equal_masks: dict[tuple[int, int], Image.Image] = {}
+
+    def get_equal_mask(first: int, second: int) -> Image.Image:
+        key = (min(first, second), max(first, second))
+        if key not in equal_masks:
+            equal_masks[key] = equal_mask(neighbours[first], neighbours[second])
+        return equal_masks[key]
+
+    best_count = Image.new('L', centre.size, 0)
+    best_colour = centre.copy()
+    for candidate in range(9 - same_neighbour_threshold):
+        count = Image.new('L', centre.size, 1)
+        for other in range(len(neighbours)):
+            if other != candidate:
+                count = ImageChops.add(count, get_equal_mask(candidate, other))
+        better = util.binary_mask(ImageChops.subtract(count, best_count))
+        best_count = ImageChops.lighter(best_count, count)
+        best_colour.paste(neighbours[candidate], mask=better)
+
+    enough = best_count.point(lambda v: 255 if v >= same_neighbour_threshold else 0)
+    fix_mask = ImageChops.multiply(enough, diff.difference_mask(best_colour, centre))
+    if exclude is not None:
+        fix_mask = ImageChops.multiply(fix_mask, ImageChops.invert(exclude.crop((1, 1, width + 1, height + 1))))
+
+    centre_bytes = centre.tobytes()
+    colour_bytes = best_colour.tobytes()
+    count_bytes = best_count.tobytes()
+    fixes = []
+    for index in util.mask_indices(fix_mask):
+        index_y, index_x = divmod(index, width)
+        offset = index * 3
+        colour = tuple(colour_bytes[offset:offset + 3])
+        count = count_bytes[index]
+        priority = count * scheduler.get_visibility(tuple(centre_bytes[offset:offset + 3]), colour)
+        fixes.append((index_x + 1, index_y + 1, colour, count, priority))
+
+    fixes.sort(key=lambda fix: fix[4], reverse=True)
+    return fixes
+
+
+async def send_fixes(api_instance: APIBase, fixes: list[NoiseFix]) -> int:
+    """Send a batch of fixes, as many at once as the api allows, and return how many were placed."""
+    semaphore = asyncio.Semaphore(api_instance.concurrency)
+
+    async def send(x: int, y: int, colour: tuple[int, int, int]) -> bool:
+        async with semaphore:
+            return await api_instance.set_pixel(x, y, list(colour))
+
+    results = await asyncio.gather(*(send(x, y, colour) for x, y, colour, _, _ in fixes))
+    return sum(results)
+
+
+async def remove_noise(
+        api_instance: APIBase,
+        same_neighbour_threshold: int = SAME_NEIGHBOUR_THRESHOLD,
+        batch_size: Optional[int] = BATCH_SIZE,
+        zones: Optional[list[zone.Zone]] = None,
+) -> int:
     """Try to remove some noise.
 
-    If any pixel in img is surrounded by at least same_neighbour_threshold (default 7) of the same colour,
+    If any pixel on the canvas is surrounded by at least same_neighbour_threshold (default 7) of the same colour,
     and pixel is not that colour, set pixel to that colour.
+    Only the batch_size highest priority pixels are sent, or all of them if it's None.
+    Pixels any of the zones want are left to whatever protects them, so the two don't fight over fine detail.
+    Returns how many were placed.
     """
-    for y in range(image.height):
-        for x in range(image.width):
-            try:
-                pixel_neighbours = get_neighbour_pixels(x, y, image)
-            except IndexError:
-                continue
-
-            unique_pixel_neighbours = list(set(pixel_neighbours))
-            unique_pixel_neighbours.sort(key=lambda p: pixel_neighbours.count(p), reverse=True)
-            highest_incidence_neighbour = unique_pixel_neighbours[0]
-            if pixel_neighbours.count(highest_incidence_neighbour) >= same_neighbour_threshold:
-                image.putpixel((x, y), highest_incidence_neighbour)
-                api.set_pixel(x, y, highest_incidence_neighbour, headers)
+    canvas = await api_instance.get_pixels()
+    exclude = get_zone_mask(zones, canvas.size) if zones else None
+    loop = asyncio.get_event_loop()
+    fixes = await loop.run_in_executor(None, find_noise, canvas, same_neighbour_threshold, exclude)
+    if not fixes:
+        return 0
+
+    batch = fixes if batch_size is None else fixes[:batch_size]
+    placed = await send_fixes(api_instance, batch)
+    log.info(f'Removed {placed} of {len(fixes)} noisy pixels, sent the {len(batch)} most noticeable.')
+    return placed
+
+
+async def run(
+        api_instance: APIBase,
+        same_neighbour_threshold: int = SAME_NEIGHBOUR_THRESHOLD,
+        batch_size: Optional[int] = BATCH_SIZE,
+        interval: float = NOISE_INTERVAL_SECONDS,
+        zones: Optional[list[zone.Zone]] = None,
+):
+    """Remove a batch of noise every interval seconds, outside of the zones."""
+    while True:
+        await remove_noise(api_instance, same_neighbour_threshold, batch_size, zones)
+        await asyncio.sleep(interval)
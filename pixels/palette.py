@@ -0,0 +1,214 @@
+import hashlib
+import logging
+import os
+from pathlib import Path
+from typing import Optional, Union
+
+from PIL import Image, ImageChops
+
+from . import util
+
+
+PALETTE_CACHE_FOLDER = Path('images') / 'ignore' / 'palette_cache'
+PALETTE_MAX_COLOURS = 256
+# the lookup table is indexed by the top bits of each channel
+LUT_BITS = 5
+LUT_SHIFT = 8 - LUT_BITS
+LUT_SIZE = 1 << (LUT_BITS * 3)
+# cells and the bits below them are worked out as 16 bit values, split over a high and a low byte image
+POINT_TABLE_SIZE = 1 << 16
+LOW_BITS = LUT_SHIFT * 3
+LOW_MASK = (1 << LUT_SHIFT) - 1
+# ids for the cells with more than one palette colour in, above the low bits, and 0 for every other cell
+MAX_AMBIGUOUS_CELLS = (POINT_TABLE_SIZE >> LOW_BITS) - 1
+
+# per channel byte tables, to build a cell (rrrrrggg ggbbbbb) or the low bits below it (.......r rrgggbbb)
+CELL_HIGH_RED = [(value >> LUT_SHIFT) << (LUT_BITS * 2 - 8) for value in range(256)]
+CELL_HIGH_GREEN = [value >> (LUT_SHIFT + 8 - LUT_BITS) for value in range(256)]
+CELL_LOW_GREEN = [((value >> LUT_SHIFT) << LUT_BITS) & 0xff for value in range(256)]
+CELL_LOW_BLUE = [value >> LUT_SHIFT for value in range(256)]
+LOW_HIGH_RED = [(value & LOW_MASK) >> (8 - LUT_SHIFT * 2) for value in range(256)]
+LOW_LOW_RED = [((value & LOW_MASK) << (LUT_SHIFT * 2)) & 0xff for value in range(256)]
+LOW_GREEN = [(value & LOW_MASK) << LUT_SHIFT for value in range(256)]
+LOW_BLUE = [value & LOW_MASK for value in range(256)]
+AMBIGUOUS_ID_HIGH = [(value << (LOW_BITS - 8)) & 0xff for value in range(256)]
+NONZERO = [0] + [255] * 255
+
+Colour = tuple[int, int, int]
+
+
+log = logging.getLogger(__name__)
+
+
+def get_cell(colour: Colour) -> int:
+    red, green, blue = colour[:3]
+    return (red >> LUT_SHIFT) << (LUT_BITS * 2) | (green >> LUT_SHIFT) << LUT_BITS | blue >> LUT_SHIFT
+
+
+def get_low_bits(colour: Colour) -> int:
+    red, green, blue = colour[:3]
+    return (red & LOW_MASK) << (LUT_SHIFT * 2) | (green & LOW_MASK) << LUT_SHIFT | blue & LOW_MASK
+
+
+def pack_16(low: Image.Image, high: Image.Image) -> Image.Image:
+    """Combine two single band images into one of high * 256 + low, that point() can look up in a 16 bit table."""
+    return Image.frombytes('I;16', low.size, Image.merge('LA', (low, high)).tobytes()).convert('I')
+
+
+def build_lut(colours: list[Colour]) -> bytes:
+    """Work out the nearest colour to the middle of every cell of the lookup table. Slow, so it gets cached."""
+    steps = [(step << LUT_SHIFT) + (1 << LUT_SHIFT) // 2 for step in range(1 << LUT_BITS)]
+    # squared distance along each channel from each step to each colour
+    distances = [
+        [[(step - colour[channel]) ** 2 for colour in colours] for step in steps]
+        for channel in range(3)
+    ]
+    indices = range(len(colours))
+
+    lut = bytearray(LUT_SIZE)
+    cell = 0
+    for red_distances in distances[0]:
+        for green_distances in distances[1]:
+            red_green = [red_distances[i] + green_distances[i] for i in indices]
+            for blue_distances in distances[2]:
+                lut[cell] = min(indices, key=lambda i: red_green[i] + blue_distances[i])
+                cell += 1
+    return bytes(lut)
+
+
+class Palette:
+    """The colours the canvas allows, and a lookup table from any RGB colour to the nearest one's index."""
+
+    def __init__(self, colours: list[Colour], cache_folder: Optional[Union[str, Path]] = PALETTE_CACHE_FOLDER):
+        if not 0 < len(colours) <= PALETTE_MAX_COLOURS:
+            raise ValueError(f'A palette needs between 1 and {PALETTE_MAX_COLOURS} colours.')
+        self.colours = [tuple(colour[:3]) for colour in colours]
+        self.exact = {colour: index for index, colour in reversed(list(enumerate(self.colours)))}
+        self.key = hashlib.sha256(bytes(channel for colour in self.colours for channel in colour)).hexdigest()
+
+        # cells with more than one palette colour in can't be looked up by cell alone
+        cells = [get_cell(colour) for colour in self.exact]
+        self.ambiguous = len(set(cells)) != len(cells)
+
+        self.image = Image.new('P', (1, 1))
+        self.image.putpalette([channel for colour in self.colours for channel in colour])
+
+        cache_path = None
+        if cache_folder is not None:
+            cache_path = Path(cache_folder) / f'{self.key}.lut'
+        lut = self.load_cache(cache_path) if cache_path is not None else None
+        if lut is None:
+            lut = build_lut(self.colours)
+            if cache_path is not None:
+                self.save_cache(cache_path, lut)
+        # exact colours win over whatever is nearest the middle of their cell
+        lut = bytearray(lut)
+        for colour, index in self.exact.items():
+            lut[get_cell(colour)] = index
+        self.lut = bytes(lut)
+        self.build_point_tables()
+
+    def build_point_tables(self):
+        """Turn the lookup table into tables that point() can map whole images through."""
+        self.cell_table = list(self.lut) + [0] * (POINT_TABLE_SIZE - LUT_SIZE)
+        self.ambiguous_ids = None
+        self.low_bits_table = None
+        if not self.ambiguous:
+            return
+
+        colours_by_cell: dict[int, list[Colour]] = {}
+        for colour in self.exact:
+            colours_by_cell.setdefault(get_cell(colour), []).append(colour)
+        ambiguous_cells = [cell for cell, colours in colours_by_cell.items() if len(colours) > 1]
+        if len(ambiguous_cells) > MAX_AMBIGUOUS_CELLS:
+            log.warning('The palette has too many colours too close together, mapping images onto it will be slow')
+            return
+
+        # for a colour in a cell shared with others, its id and low bits say which colour it is, if any
+        self.ambiguous_ids = [0] * POINT_TABLE_SIZE
+        self.low_bits_table = [0] * POINT_TABLE_SIZE
+        for ambiguous_id, cell in enumerate(ambiguous_cells, start=1):
+            self.ambiguous_ids[cell] = ambiguous_id
+            start = ambiguous_id << LOW_BITS
+            self.low_bits_table[start:start + (1 << LOW_BITS)] = [self.lut[cell]] * (1 << LOW_BITS)
+            for colour in colours_by_cell[cell]:
+                self.low_bits_table[start + get_low_bits(colour)] = self.exact[colour]
+
+    @classmethod
+    def from_hex(cls, hex_colours: list[str], **kwargs) -> 'Palette':
+        return cls([tuple(util.hex_to_rgb(hex_colour)) for hex_colour in hex_colours], **kwargs)
+
+    @classmethod
+    def from_image(cls, image: Image.Image, **kwargs) -> 'Palette':
+        """Get the palette an image already uses, like the canvas. Raises ValueError if it has too many colours."""
+        colours = image.convert('RGB').getcolors(PALETTE_MAX_COLOURS)
+        if colours is None:
+            raise ValueError(f'The image has more than {PALETTE_MAX_COLOURS} colours.')
+        # most used first, so it doesn't depend on the order getcolors happens to return them in
+        return cls([colour for _, colour in sorted(colours, reverse=True)], **kwargs)
+
+    @staticmethod
+    def load_cache(cache_path: Path) -> Optional[bytes]:
+        try:
+            lut = cache_path.read_bytes()
+        except FileNotFoundError:
+            return None
+        if len(lut) != LUT_SIZE:
+            return None
+        return lut
+
+    @staticmethod
+    def save_cache(cache_path: Path, lut: bytes):
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = cache_path.with_suffix('.tmp')
+        temp_path.write_bytes(lut)
+        os.replace(temp_path, cache_path)
+        log.debug(f'Cached palette lookup table to {cache_path}')
+
+    def index_of(self, colour: Colour) -> int:
+        index = self.exact.get(tuple(colour[:3]))
+        if index is None:
+            index = self.lut[get_cell(colour)]
+        return index
+
+    def to_indices(self, image: Image.Image, dither: bool = False) -> Image.Image:
+        """Map an image onto the palette, and return the index of each pixel's colour as a single band image."""
+        image = image.convert('RGB')
+        if dither:
+            dithered = image.quantize(palette=self.image, dither=Image.FLOYDSTEINBERG)
+            return Image.frombytes('L', image.size, dithered.tobytes())
+
+        if self.ambiguous and self.ambiguous_ids is None:
+            return self.to_indices_exact(image)
+        # all in C, through lookup tables, as it's done to the whole canvas every refresh
+        red, green, blue = image.split()
+        cells = pack_16(
+            ImageChops.add(green.point(CELL_LOW_GREEN), blue.point(CELL_LOW_BLUE)),
+            ImageChops.add(red.point(CELL_HIGH_RED), green.point(CELL_HIGH_GREEN)),
+        )
+        indices = cells.point(self.cell_table, 'L')
+        if not self.ambiguous:
+            return indices
+
+        # the cells with more than one palette colour in are told apart by the bits below the cell
+        ambiguous_ids = cells.point(self.ambiguous_ids, 'L')
+        low_bits = pack_16(
+            ImageChops.add(ImageChops.add(red.point(LOW_LOW_RED), green.point(LOW_GREEN)), blue.point(LOW_BLUE)),
+            ImageChops.add(ambiguous_ids.point(AMBIGUOUS_ID_HIGH), red.point(LOW_HIGH_RED)),
+        )
+        exact_indices = low_bits.point(self.low_bits_table, 'L')
+        return Image.composite(exact_indices, indices, ambiguous_ids.point(NONZERO))
+
+    def to_indices_exact(self, image: Image.Image) -> Image.Image:
+        """Map an image onto the palette a colour at a time, for palettes with too many colours too close together."""
+        indices = {colour: self.index_of(colour) for _, colour in image.getcolors(image.width * image.height)}
+        image_bytes = image.tobytes()
+        return Image.frombytes('L', image.size, bytes(
+            indices[tuple(image_bytes[offset:offset + 3])] for offset in range(0, len(image_bytes), 3)
+        ))
+
+    def to_rgb(self, indices: Image.Image) -> Image.Image:
+        """Turn an image of indices back into the palette's colours."""
+        image = Image.frombytes('P', indices.size, indices.tobytes())
+        image.putpalette(self.image.getpalette())
+        return image.convert('RGB')
@@ -0,0 +1,337 @@
+import asyncio
+import collections
+import heapq
+import itertools
+import logging
+import math
+import random
+import time
+from typing import Optional
+
+import aiohttp
+from PIL import Image
+
+from . import diff
+from . import hotspots
+from . import logs
+from . import spatial
+from . import verification
+from . import zone
+from .api import APIBase
+from .api._base import Pixel
+from . import metrics
+
+
+REFRESH_INTERVAL_SECONDS = 30
+# damage this much older counts for half as much
+RECENCY_HALF_LIFE_SECONDS = 300
+# even a barely different colour is worth fixing eventually
+MIN_VISIBILITY = 0.05
+MAX_COLOUR_DISTANCE = math.dist((0, 0, 0), (255, 255, 255))
+# while idle, check the hottest tiles this often between refreshes
+PROBE_INTERVAL_SECONDS = 5
+PROBE_TILES = 16
+PROBE_PIXELS_PER_HEAT = 2
+PROBE_MAX_PIXELS_PER_TILE = 16
+# after a write, or the read before it, fails, a worker waits this long before its next one, so a cooldown isn't hammered
+FAILED_WRITE_DELAY_SECONDS = 1
+
+
+log = logging.getLogger(__name__)
+detail_log = logs.get_detail_logger(__name__)
+
+
+class PendingRepair:
+    """An incorrect pixel waiting in the queue, and what it was last seen as."""
+
+    def __init__(
+            self,
+            x: int,
+            y: int,
+            colour: tuple[int, int, int],
+            z: zone.Zone,
+            damaged_at: float,
+            seen: Pixel,
+            seen_at: float,
+    ):
+        self.x = x
+        self.y = y
+        self.colour = colour
+        self.zone = z
+        self.damaged_at = damaged_at
+        self.seen = seen
+        self.seen_at = seen_at
+        self.key = 0.0
+
+
+def get_visibility(current: tuple[int, ...], target: tuple[int, int, int]) -> float:
+    """How noticeable the wrong colour is, from 0 to 1, by its distance from the right one."""
+    distance = math.dist(current[:3], target) / MAX_COLOUR_DISTANCE
+    return max(distance, MIN_VISIBILITY)
+
+
+class RepairScheduler:
+    """A single queue of incorrect pixels across every zone, most valuable first.
+
+    A pixel's priority is weight * visibility * (1 + heat) * 2 ** (damaged_at / half_life),
+    so fresher damage, and damage where it keeps happening, goes first.
+    All pixels age at the same rate, so the order never changes while they wait
+    and the heap can be keyed on the log of the priority once.
+    Before a pixel is placed, the verification policy decides whether it's worth checking it wasn't fixed meanwhile.
+    """
+
+    def __init__(
+            self,
+            zones: list[zone.Zone],
+            api_instance: APIBase,
+            refresh_interval: float = REFRESH_INTERVAL_SECONDS,
+            recency_half_life: float = RECENCY_HALF_LIFE_SECONDS,
+            hotspot_tracker: Optional[hotspots.HotspotTracker] = None,
+            probe_interval: float = PROBE_INTERVAL_SECONDS,
+            policy: Optional[verification.VerificationPolicy] = None,
+    ):
+        self.zones = zones
+        self.api_instance = api_instance
+        self.refresh_interval = refresh_interval
+        self.recency_half_life = recency_half_life
+        self.hotspots = hotspot_tracker if hotspot_tracker is not None else hotspots.HotspotTracker()
+        self.probe_interval = probe_interval
+        # one for the scheduler's whole life, so what it learns about checking pixels first carries across refreshes
+        self.policy = policy if policy is not None else verification.VerificationPolicy(api_instance, self.hotspots)
+        # the first refresh finds what was wrong before we started, which isn't damage we saw happen
+        self.refreshed = False
+        # built once the canvas size is known, from the first refresh
+        self.index: Optional[spatial.ZoneIndex] = None
+
+        # pixels placed for each zone, kept across restarts by a checkpoint
+        self.placed = collections.Counter()
+
+        self.pending: dict[tuple[int, int], PendingRepair] = {}
+        self.heap: list[tuple[float, int, PendingRepair]] = []
+        self.counter = itertools.count()
+        # set when something new is pushed, so an idle run() can get back to draining
+        self.wakeup = asyncio.Event()
+
+    def __len__(self) -> int:
+        return len(self.pending)
+
+    def get_key(self, repair: PendingRepair, current: tuple[int, ...]) -> float:
+        visibility = get_visibility(current, repair.colour)
+        heat = self.hotspots.get_priority(repair.x, repair.y)
+        return math.log2(repair.zone.weight * visibility) + heat + repair.damaged_at / self.recency_half_life
+
+    def get_shared_priority(self, repair: PendingRepair) -> float:
+        """The repair's key with its damage dated by the wall clock instead of the loop's own clock,
+        so it compares with the priorities of other processes, even on other machines.
+        """
+        wall_clock_offset = time.time() - asyncio.get_event_loop().time()
+        return repair.key + wall_clock_offset / self.recency_half_life
+
+    def push(self, repair: PendingRepair):
+        self.pending[(repair.x, repair.y)] = repair
+        # negate the key because heapq is a min heap
+        heapq.heappush(self.heap, (-repair.key, next(self.counter), repair))
+        metrics.set_gauge('pixels_queue_depth', len(self.pending))
+        self.wakeup.set()
+
+    def pop(self) -> Optional[PendingRepair]:
+        """Take the most valuable repair off the queue, or None if there isn't one."""
+        while self.heap:
+            _, _, repair = heapq.heappop(self.heap)
+            # skip entries that were replaced or resolved since they were pushed
+            if self.pending.get((repair.x, repair.y)) is repair:
+                del self.pending[(repair.x, repair.y)]
+                metrics.set_gauge('pixels_queue_depth', len(self.pending))
+                return repair
+        return None
+
+    def update(self, canvas: Image.Image):
+        """Rebuild the queue from a fresh canvas, remembering when already known damage happened."""
+        now = asyncio.get_event_loop().time()
+        seen_at = self.policy.get_snapshot_time()
+        previous = self.pending
+        self.pending = {}
+        self.heap = []
+
+        if self.index is None or self.index.size != canvas.size:
+            self.index = spatial.ZoneIndex(self.zones, canvas.size)
+        counts = collections.Counter()
+        for x, y, colour, z in self.index.get_incorrect_pixels(canvas):
+            counts[z.name] += 1
+            current = canvas.getpixel((x, y))
+            known = previous.get((x, y))
+            if known is None and self.refreshed:
+                self.hotspots.record_damage(x, y, current, now)
+                metrics.inc('pixels_damaged_total', zone=z.name)
+            damaged_at = known.damaged_at if known is not None else now
+            repair = PendingRepair(x, y, colour, z, damaged_at, current, seen_at)
+            repair.key = self.get_key(repair, current)
+            self.pending[(x, y)] = repair
+        self.refreshed = True
+
+        for z in self.zones:
+            log.info('%s pixels of zone %s need changing', counts[z.name], z.name)
+            area = self.index.areas[z.name]
+            if area:
+                metrics.set_gauge('pixels_zone_correct_ratio', 1 - counts[z.name] / area, zone=z.name)
+
+        self.set_pending(self.pending)
+        log.info('%s pixels in the repair queue', len(self.pending))
+
+    def requeue(self, repair: PendingRepair):
+        """Put back a repair that couldn't be placed, unless something newer about that pixel has been queued."""
+        if (repair.x, repair.y) not in self.pending:
+            self.push(repair)
+
+    def set_pending(self, pending: dict[tuple[int, int], PendingRepair]):
+        """Replace the whole queue at once."""
+        self.pending = pending
+        self.heap = [(-r.key, next(self.counter), r) for r in pending.values()]
+        heapq.heapify(self.heap)
+        metrics.set_gauge('pixels_queue_depth', len(pending))
+        if pending:
+            self.wakeup.set()
+
+    def get_target(self, x: int, y: int) -> Optional[tuple[zone.Zone, tuple[int, int, int]]]:
+        """Find the zone that wants a pixel, and the colour it wants, or None if no zone does."""
+        if self.index is not None:
+            return self.index.get_target(x, y)
+        # before the first refresh, look through the zones the slow way
+        for z in sorted(reversed(self.zones), key=lambda z: z.priority, reverse=True):
+            index_x = x - z.coords[0]
+            index_y = y - z.coords[1]
+            if 0 <= index_x < z.width and 0 <= index_y < z.height:
+                colour = z.image.getpixel((index_x, index_y))
+                if colour[3]:
+                    return z, colour[:3]
+        return None
+
+    def handle_update(self, x: int, y: int, colour: list[int]):
+        """Queue or drop a pixel's repair after hearing it changed."""
+        target = self.get_target(x, y)
+        if target is None:
+            return
+        z, target_colour = target
+
+        if diff.is_correct(z, colour, target_colour):
+            # lazily dropped from the heap when it comes up
+            if self.pending.pop((x, y), None) is not None:
+                metrics.inc('pixels_skipped_total')
+                metrics.set_gauge('pixels_queue_depth', len(self.pending))
+            return
+
+        self.hotspots.record_damage(x, y, colour)
+        metrics.inc('pixels_damaged_total', zone=z.name)
+        now = asyncio.get_event_loop().time()
+        known = self.pending.get((x, y))
+        if known is None:
+            detail_log.info('Pixel at (%s, %s) in zone %s was damaged', x, y, z.name)
+            repair = PendingRepair(x, y, target_colour, z, now, colour, now)
+            repair.key = self.get_key(repair, colour)
+            self.push(repair)
+        else:
+            known.seen = colour
+            known.seen_at = now
+
+    async def watch(self, updates: asyncio.Queue):
+        """Keep the queue up to date from a queue of live (x, y, colour) updates."""
+        while True:
+            x, y, colour = await updates.get()
+            self.handle_update(x, y, colour)
+
+    def get_probe_coords(self) -> list[tuple[int, int]]:
+        """Pick pixels to check in the hottest tiles, more of them the hotter the tile."""
+        coords = []
+        for tile, heat in self.hotspots.get_hottest(PROBE_TILES):
+            left, top, right, bottom = self.hotspots.get_tile_box(tile)
+            candidates = [
+                (x, y)
+                for y in range(top, bottom)
+                for x in range(left, right)
+                if (x, y) not in self.pending and self.get_target(x, y) is not None
+            ]
+            count = min(len(candidates), math.ceil(heat * PROBE_PIXELS_PER_HEAT), PROBE_MAX_PIXELS_PER_TILE)
+            coords.extend(random.sample(candidates, count))
+        return coords
+
+    async def probe(self) -> int:
+        """Check pixels in the hottest tiles for damage between refreshes, and return how many were checked."""
+        coords = self.get_probe_coords()
+        if not coords:
+            return 0
+        colours = await self.api_instance.get_pixel_many(coords)
+        metrics.inc('pixels_probed_total', len(coords))
+        for (x, y), colour in zip(coords, colours):
+            self.handle_update(x, y, colour)
+        detail_log.info('Probed %s pixels in hot tiles', len(coords))
+        return len(coords)
+
+    async def drain_worker(self, deadline: float, placed: collections.Counter):
+        loop = asyncio.get_event_loop()
+        while loop.time() < deadline:
+            repair = self.pop()
+            if repair is None:
+                break
+            success = False
+            try:
+                if self.policy.should_verify(repair.x, repair.y, repair.seen_at):
+                    current = await self.policy.verify(
+                        repair.x, repair.y, repair.zone, repair.seen, repair.colour, repair.seen_at
+                    )
+                    if diff.is_correct(repair.zone, current, repair.colour):
+                        detail_log.info(
+                            'Pixel at (%s, %s) in zone %s was already fixed', repair.x, repair.y, repair.zone.name
+                        )
+                        metrics.inc('pixels_skipped_total')
+                        # nothing left to do for it, so it isn't requeued
+                        success = True
+                        continue
+                detail_log.info(
+                    'Pixel at (%s, %s) in zone %s will be made %s', repair.x, repair.y, repair.zone.name, repair.colour
+                )
+                success = await self.policy.write(
+                    repair.x, repair.y, repair.colour, priority=self.get_shared_priority(repair)
+                )
+            except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+                log.warning('Request for pixel at (%s, %s) failed: %r', repair.x, repair.y, error)
+            finally:
+                # whether the read or the write failed, the pixel still needs placing
+                if not success:
+                    self.requeue(repair)
+            if not success:
+                detail_log.info('Failed to set pixel at (%s, %s), it will be retried', repair.x, repair.y)
+                await asyncio.sleep(FAILED_WRITE_DELAY_SECONDS)
+                continue
+            placed[repair.zone.name] += 1
+            self.placed[repair.zone.name] += 1
+
+    async def drain(self, deadline: float):
+        """Place queued pixels as fast as the api allows until the deadline or the queue runs out."""
+        placed = collections.Counter()
+        workers = (self.drain_worker(deadline, placed) for _ in range(self.api_instance.concurrency))
+        await asyncio.gather(*workers)
+        for zone_name, count in placed.items():
+            log.info('Zone %s: placed %s pixels', zone_name, count)
+        if placed:
+            log.info('%s pixels left in the repair queue', len(self.pending))
+
+    async def run(self):
+        """Refresh the queue from the canvas and drain it, forever."""
+        loop = asyncio.get_event_loop()
+        while True:
+            log.info('Getting current canvas status')
+            canvas = await self.api_instance.get_pixels()
+            self.update(canvas)
+
+            deadline = loop.time() + self.refresh_interval
+            while loop.time() < deadline:
+                self.wakeup.clear()
+                await self.drain(deadline)
+                if not self.pending:
+                    # nothing to do until the next refresh, unless a live update comes in
+                    # or a probe of where damage keeps happening finds some
+                    try:
+                        await asyncio.wait_for(self.wakeup.wait(), min(self.probe_interval, deadline - loop.time()))
+                    except asyncio.TimeoutError:
+                        if loop.time() < deadline:
+                            await self.probe()
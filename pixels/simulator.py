@@ -0,0 +1,378 @@
+import argparse
+import asyncio
+import json
+import logging
+import random
+import selectors
+import sys
+from pathlib import Path
+from typing import Optional
+
+from aiohttp import web
+from PIL import Image
+
+from . import diff
+from . import metrics
+from . import mock_server
+from . import run_protections
+from . import scheduler
+from . import zone
+from .api import APIBase
+from .api._base import Pixel
+
+
+__version__ = '1.0.0'
+
+
+DURATION_SECONDS = 3600
+LATENCY_SECONDS = 0.05
+SAMPLE_INTERVAL_SECONDS = 10
+GRIEFER_TYPES = ('random', 'targeted', 'wipe')
+# how big a patch of a zone a targeted griefer goes after
+TARGET_SIZE = 8
+
+
+log = logging.getLogger(__name__)
+
+
+def get_parser() -> argparse.ArgumentParser:
+    """Get this script's parser."""
+    parser = argparse.ArgumentParser(
+        description='run the repair loop against an in memory canvas in virtual time, and report how it did as json'
+    )
+
+    parser.add_argument('--version', action='version', version=__version__)
+    parser.add_argument('zones', type=Path, nargs='+', help='zone jsons to protect')
+    parser.add_argument(
+        '-d', '--duration', type=float, default=DURATION_SECONDS, help='virtual seconds to run, default %(default)s'
+    )
+    parser.add_argument('--width', type=int, default=mock_server.CANVAS_WIDTH, help='default %(default)s')
+    parser.add_argument('--height', type=int, default=mock_server.CANVAS_HEIGHT, help='default %(default)s')
+    parser.add_argument('-l', '--latency', type=float, default=LATENCY_SECONDS, help='default %(default)s')
+    parser.add_argument(
+        '-r', '--ratelimit', type=float, nargs=3, default=[50, 1, 5], metavar=('LIMIT', 'PERIOD', 'COOLDOWN'),
+        help='rate limit per endpoint, default %(default)s'
+    )
+    parser.add_argument('-c', '--concurrency', type=int, default=1, help='requests in flight, default %(default)s')
+    parser.add_argument(
+        '-g', '--griefer', action='append', default=[], metavar='TYPE:RATE',
+        help=f'add a griefer placing RATE pixels a second, TYPE is one of {", ".join(GRIEFER_TYPES)}'
+    )
+    parser.add_argument(
+        '--refresh-interval', type=float, default=scheduler.REFRESH_INTERVAL_SECONDS, help='default %(default)s'
+    )
+    parser.add_argument(
+        '--half-life', type=float, default=scheduler.RECENCY_HALF_LIFE_SECONDS, help='default %(default)s'
+    )
+    parser.add_argument(
+        '--probe-interval', type=float, default=scheduler.PROBE_INTERVAL_SECONDS, help='default %(default)s'
+    )
+    parser.add_argument('--seed', type=int, default=0, help='default %(default)s')
+    parser.add_argument('-o', '--output', type=Path, help='write the results here instead of stdout')
+    parser.add_argument('-v', '--verbose', action='store_true', help='print the client\'s logs as well')
+
+    return parser
+
+
+class VirtualClockSelector(selectors.DefaultSelector):
+    """Skips the loop's clock ahead instead of sleeping, whenever there's nothing to do until a timer."""
+
+    def __init__(self):
+        super().__init__()
+        self.loop: Optional['VirtualTimeEventLoop'] = None
+
+    def select(self, timeout: Optional[float] = None):
+        # still pick up anything real, like executor jobs finishing
+        events = super().select(0)
+        if events or timeout is not None and timeout <= 0:
+            return events
+        if timeout is None:
+            # no timers left, only something real can wake the loop up
+            return super().select(None)
+        self.loop.advance(timeout)
+        return []
+
+
+class VirtualTimeEventLoop(asyncio.SelectorEventLoop):
+    """An event loop where sleeping takes no time, for running hours of simulation in seconds."""
+
+    def __init__(self):
+        selector = VirtualClockSelector()
+        super().__init__(selector)
+        selector.loop = self
+        self.virtual_time = 0.0
+
+    def time(self) -> float:
+        return self.virtual_time
+
+    def advance(self, seconds: float):
+        self.virtual_time += seconds
+
+
+class SimulatedAPI(APIBase):
+    """An api backed by a canvas in memory, with made up latency and rate limits per endpoint."""
+
+    def __init__(
+            self,
+            canvas: mock_server.MockCanvas,
+            latency: float = LATENCY_SECONDS,
+            ratelimit: Optional[tuple[int, float, float]] = None,
+            concurrency: int = 1,
+            **kwargs,
+    ):
+        self.canvas = canvas
+        self.latency = latency
+        self.ratelimit = ratelimit
+        self.concurrency = concurrency
+        self.server_ratelimits: dict[str, mock_server.MockRateLimit] = {}
+        self.stats = mock_server.MockStats()
+        self.placed = 0
+        super().__init__(**kwargs)
+
+    async def open(self):
+        pass
+
+    async def close(self):
+        pass
+
+    async def call(self, endpoint: str) -> bool:
+        """Go through what a request would, and return whether the server would have accepted it."""
+        ratelimit = self.get_ratelimit(endpoint)
+        delay = ratelimit.reserve()
+        if delay > 0:
+            metrics.inc('pixels_ratelimit_sleep_seconds_total', delay, endpoint=endpoint)
+            await asyncio.sleep(delay)
+
+        self.stats.requests[endpoint] = self.stats.requests.get(endpoint, 0) + 1
+        await asyncio.sleep(self.latency)
+        headers = {}
+        accepted = True
+        if self.ratelimit is not None:
+            if endpoint not in self.server_ratelimits:
+                self.server_ratelimits[endpoint] = mock_server.MockRateLimit(*self.ratelimit)
+            try:
+                headers = self.server_ratelimits[endpoint].check()
+            except web.HTTPTooManyRequests as error:
+                self.stats.rejected += 1
+                headers = error.headers
+                accepted = False
+        ratelimit.update(headers)
+        metrics.observe('pixels_request_seconds', self.latency, endpoint=endpoint)
+        return accepted
+
+    async def send_pixel(self, x: int, y: int, colour: Pixel) -> bool:
+        if not await self.call('/set_pixel'):
+            return False
+        self.canvas.image.putpixel((x, y), tuple(colour[:3]))
+        self.placed += 1
+        return True
+
+    async def fetch_pixels(self) -> Image.Image:
+        while not await self.call('/get_pixels'):
+            pass
+        return self.canvas.image.copy()
+
+    async def get_size(self) -> dict[str, int]:
+        return {'width': self.canvas.image.width, 'height': self.canvas.image.height}
+
+
+class Griefer:
+    """Something else drawing on the canvas. Subclasses choose where."""
+
+    def __init__(self, canvas: mock_server.MockCanvas, zones: list[zone.Zone], rate: float, rng: random.Random):
+        self.canvas = canvas
+        self.zones = zones
+        self.rate = rate
+        self.rng = rng
+        self.placed = 0
+
+    def get_coords(self) -> tuple[int, int]:
+        raise NotImplementedError
+
+    def get_colour(self) -> tuple[int, int, int]:
+        return self.rng.randrange(256), self.rng.randrange(256), self.rng.randrange(256)
+
+    async def run(self):
+        """Place pixels at random intervals averaging rate a second, forever."""
+        while True:
+            await asyncio.sleep(self.rng.expovariate(self.rate))
+            x, y = self.get_coords()
+            if 0 <= x < self.canvas.image.width and 0 <= y < self.canvas.image.height:
+                self.canvas.image.putpixel((x, y), self.get_colour())
+                self.placed += 1
+
+
+class RandomGriefer(Griefer):
+    """Scribbles anywhere on the zones."""
+
+    def get_coords(self) -> tuple[int, int]:
+        z = self.rng.choice(self.zones)
+        return z.coords[0] + self.rng.randrange(z.width), z.coords[1] + self.rng.randrange(z.height)
+
+
+class TargetedGriefer(Griefer):
+    """Keeps going after one small patch of one zone, in one colour."""
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        z = self.rng.choice(self.zones)
+        self.left = z.coords[0] + self.rng.randrange(max(z.width - TARGET_SIZE, 1))
+        self.top = z.coords[1] + self.rng.randrange(max(z.height - TARGET_SIZE, 1))
+        self.colour = super().get_colour()
+
+    def get_coords(self) -> tuple[int, int]:
+        return self.left + self.rng.randrange(TARGET_SIZE), self.top + self.rng.randrange(TARGET_SIZE)
+
+    def get_colour(self) -> tuple[int, int, int]:
+        return self.colour
+
+
+class WipeGriefer(Griefer):
+    """Paints over a zone row by row, like a bot would, then starts on the next one."""
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.zone_index = 0
+        self.index = 0
+        self.colour = super().get_colour()
+
+    def get_coords(self) -> tuple[int, int]:
+        z = self.zones[self.zone_index]
+        index_y, index_x = divmod(self.index, z.width)
+        self.index += 1
+        if self.index >= z.area:
+            self.zone_index = (self.zone_index + 1) % len(self.zones)
+            self.index = 0
+        return z.coords[0] + index_x, z.coords[1] + index_y
+
+    def get_colour(self) -> tuple[int, int, int]:
+        return self.colour
+
+
+GRIEFERS = {
+    'random': RandomGriefer,
+    'targeted': TargetedGriefer,
+    'wipe': WipeGriefer,
+}
+
+
+def get_correct_ratio(zones: list[zone.Zone], canvas: Image.Image) -> float:
+    total = sum(z.area_opaque for z in zones)
+    incorrect = sum(len(diff.get_incorrect_pixels(z, canvas)) for z in zones)
+    return 1 - incorrect / total if total else 1.0
+
+
+async def sample_correctness(
+        zones: list[zone.Zone],
+        canvas: mock_server.MockCanvas,
+        interval: float,
+        samples: list[tuple[float, float]],
+):
+    """Record how much of the zones is right every interval seconds."""
+    loop = asyncio.get_event_loop()
+    while True:
+        samples.append((loop.time(), get_correct_ratio(zones, canvas.image)))
+        await asyncio.sleep(interval)
+
+
+async def simulate(
+        zones: list[zone.Zone],
+        api_instance: SimulatedAPI,
+        griefers: list[Griefer],
+        duration: float = DURATION_SECONDS,
+        sample_interval: float = SAMPLE_INTERVAL_SECONDS,
+        **scheduler_options,
+) -> dict:
+    """Run the real repair loop and the griefers for duration virtual seconds, and report how it went."""
+    loop = asyncio.get_event_loop()
+    started_at = loop.time()
+    samples: list[tuple[float, float]] = []
+    tasks = [asyncio.ensure_future(griefer.run()) for griefer in griefers]
+    tasks.append(asyncio.ensure_future(sample_correctness(zones, api_instance.canvas, sample_interval, samples)))
+
+    completed_at = None
+    protector = asyncio.ensure_future(run_protections(zones, api_instance, **scheduler_options))
+    tasks.append(protector)
+    deadline = started_at + duration
+    while loop.time() < deadline:
+        await asyncio.sleep(min(sample_interval, deadline - loop.time()))
+        if completed_at is None and get_correct_ratio(zones, api_instance.canvas.image) == 1:
+            completed_at = loop.time()
+
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+    # steady state is after the zones were first finished, or the second half if they never were
+    steady_from = completed_at if completed_at is not None else started_at + duration / 2
+    steady = [ratio for sampled_at, ratio in samples if sampled_at >= steady_from] or [samples[-1][1]]
+    return {
+        'completed_seconds': None if completed_at is None else completed_at - started_at,
+        'steady_state': {
+            'mean_correct_ratio': sum(steady) / len(steady),
+            'min_correct_ratio': min(steady),
+            'samples': len(steady),
+        },
+        'final_correct_ratio': get_correct_ratio(zones, api_instance.canvas.image),
+        'requests': api_instance.stats.requests,
+        'rejected': api_instance.stats.rejected,
+        'placed': api_instance.placed,
+        'griefed': {type(griefer).__name__: griefer.placed for griefer in griefers},
+    }
+
+
+def parse_griefer(spec: str) -> tuple[str, float]:
+    griefer_type, _, rate = spec.partition(':')
+    if griefer_type not in GRIEFERS:
+        raise argparse.ArgumentTypeError(f'Unknown griefer "{griefer_type}", pick from {", ".join(GRIEFER_TYPES)}.')
+    try:
+        return griefer_type, float(rate or 1)
+    except ValueError as error:
+        raise argparse.ArgumentTypeError(f'Griefer rate "{rate}" should be a number.') from error
+
+
+def main():
+    """Run a simulation from the command line and print the results."""
+    parser = get_parser()
+    args = parser.parse_args()
+    try:
+        griefer_specs = [parse_griefer(spec) for spec in args.griefer]
+    except argparse.ArgumentTypeError as error:
+        parser.error(str(error))
+
+    if not args.verbose:
+        # hours of per pixel logs would take longer to write than the simulation takes to run
+        logging.getLogger('pixels').setLevel(logging.WARNING)
+
+    loop = VirtualTimeEventLoop()
+    asyncio.set_event_loop(loop)
+    rng = random.Random(args.seed)
+    zones = [zone.Zone(path) for path in args.zones]
+    canvas = mock_server.MockCanvas(args.width, args.height)
+    ratelimit = (int(args.ratelimit[0]), args.ratelimit[1], args.ratelimit[2])
+    api_instance = SimulatedAPI(canvas, args.latency, ratelimit, args.concurrency)
+    griefers = [GRIEFERS[griefer_type](canvas, zones, rate, rng) for griefer_type, rate in griefer_specs]
+
+    result = loop.run_until_complete(simulate(
+        zones, api_instance, griefers, args.duration,
+        refresh_interval=args.refresh_interval,
+        recency_half_life=args.half_life,
+        probe_interval=args.probe_interval,
+    ))
+    result = {
+        'version': __version__,
+        'parameters': {key: str(value) if isinstance(value, Path) else value for key, value in vars(args).items()},
+        **result,
+    }
+    result['parameters']['zones'] = [str(path) for path in args.zones]
+
+    output = json.dumps(result, indent=4)
+    if args.output is None:
+        print(output)
+    else:
+        args.output.write_text(output)
+        print(f'Wrote results to "{args.output}".', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+import array
+import collections
+import logging
+from typing import Optional
+
+from PIL import Image, ImageChops
+
+from . import diff
+from . import util
+from . import zone
+
+
+# a pixel that needs fixing, and the zone that wants it
+ZoneRepair = tuple[int, int, tuple[int, int, int], zone.Zone]
+
+
+log = logging.getLogger(__name__)
+
+
+class ZoneIndex:
+    """Which zone owns each pixel of the canvas, and the colour it wants there, as canvas sized images.
+
+    Where zones overlap, the one with the highest priority owns the pixel, and the later one in the list on a tie.
+    Looking up a pixel is a couple of array lookups however many zones there are,
+    and the whole canvas can be diffed against every zone at once.
+    """
+
+    def __init__(self, zones: list[zone.Zone], size: tuple[int, int]):
+        self.zones = zones
+        self.size = size
+        self.width, self.height = size
+
+        # 0 for no zone, otherwise 1 + the zone's position in the list, in 32 bits so there can be any number
+        self.owner = Image.new('I', size, 0)
+        owned = Image.new('L', size, 0)
+        # what every zone wants, with alpha 255 wherever a zone owns the pixel
+        self.target = Image.new('RGBA', size, (0, 0, 0, 0))
+        palettes = {id(z.palette) for z in zones}
+        self.palette = zones[0].palette if zones and len(palettes) == 1 else None
+        self.target_indices = Image.new('L', size, 0) if self.palette is not None else None
+
+        # painted lowest priority first, so higher ones end up on top
+        order = sorted(range(len(zones)), key=lambda position: zones[position].priority)
+        for position in order:
+            z = zones[position]
+            opaque = util.binary_mask(z.image.getchannel('A'))
+            self.owner.paste(position + 1, z.coords, mask=opaque)
+            owned.paste(255, z.coords, mask=opaque)
+            self.target.paste(z.image, z.coords, mask=opaque)
+            if self.target_indices is not None:
+                self.target_indices.paste(z.indices, z.coords, mask=opaque)
+        self.target.putalpha(owned)
+
+        self.owner_values = array.array('i', self.owner.tobytes())
+        self.target_bytes = self.target.tobytes()
+        # opaque pixels each zone ended up owning, after overlaps and the edges of the canvas
+        counts = collections.Counter(self.owner_values)
+        self.areas = {z.name: counts[position + 1] for position, z in enumerate(zones)}
+        for z in zones:
+            if self.areas[z.name] < z.area_opaque:
+                log.info(f'Zone {z.name} owns {self.areas[z.name]} of its {z.area_opaque} pixels')
+
+    def get_zone(self, x: int, y: int) -> Optional[zone.Zone]:
+        if not (0 <= x < self.width and 0 <= y < self.height):
+            return None
+        owner = self.owner_values[y * self.width + x]
+        return self.zones[owner - 1] if owner else None
+
+    def get_target(self, x: int, y: int) -> Optional[tuple[zone.Zone, tuple[int, int, int]]]:
+        """Find the zone that owns a pixel, and the colour it wants, or None if no zone does."""
+        if not (0 <= x < self.width and 0 <= y < self.height):
+            return None
+        index = y * self.width + x
+        owner = self.owner_values[index]
+        if not owner:
+            return None
+        offset = index * 4
+        return self.zones[owner - 1], tuple(self.target_bytes[offset:offset + 3])
+
+    def get_mismatch_mask(self, canvas: Image.Image) -> Image.Image:
+        if self.palette is not None:
+            different = util.binary_mask(ImageChops.difference(self.target_indices, self.palette.to_indices(canvas)))
+            return ImageChops.multiply(different, self.target.getchannel('A'))
+        return diff.mismatch_mask(self.target, canvas)
+
+    def get_incorrect_pixels(self, canvas: Image.Image) -> list[ZoneRepair]:
+        """Compare every zone against the canvas in one pass, and return the pixels that need fixing in row order."""
+        if canvas.size != self.size:
+            raise ValueError(f'The canvas is {canvas.size} but the index was built for {self.size}.')
+        repairs = []
+        for index in util.mask_indices(self.get_mismatch_mask(canvas)):
+            index_y, index_x = divmod(index, self.width)
+            offset = index * 4
+            colour = tuple(self.target_bytes[offset:offset + 3])
+            repairs.append((index_x, index_y, colour, self.zones[self.owner_values[index] - 1]))
+        return repairs
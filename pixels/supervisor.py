@@ -0,0 +1,127 @@
+import asyncio
+import logging
+import signal
+from typing import Awaitable, Callable
+
+from . import metrics
+
+
+RESTART_DELAY_SECONDS = 1
+RESTART_DELAY_MAX_SECONDS = 300
+# a job that ran this long before failing was working, so it starts again from the shortest delay
+HEALTHY_AFTER_SECONDS = 60
+
+JobFactory = Callable[[], Awaitable]
+
+
+log = logging.getLogger(__name__)
+
+
+async def run_together(*coroutines: Awaitable):
+    """Run coroutines until one of them fails or all of them finish, then cancel the rest.
+
+    Unlike gather, a failure doesn't leave the others running on their own.
+    """
+    tasks = [asyncio.ensure_future(coroutine) for coroutine in coroutines]
+    try:
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+        for task in done:
+            task.result()
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+class Supervisor:
+    """Runs long lived jobs together on one loop, restarting any that fail with backoff, until stopped."""
+
+    def __init__(
+            self,
+            restart_delay: float = RESTART_DELAY_SECONDS,
+            restart_delay_max: float = RESTART_DELAY_MAX_SECONDS,
+            healthy_after: float = HEALTHY_AFTER_SECONDS,
+    ):
+        self.restart_delay = restart_delay
+        self.restart_delay_max = restart_delay_max
+        self.healthy_after = healthy_after
+        self.jobs: dict[str, JobFactory] = {}
+        self.tasks: dict[str, asyncio.Task] = {}
+        self.stopping = False
+
+    def add(self, name: str, factory: JobFactory):
+        """Add a job, as something that makes a fresh coroutine each time the job is started."""
+        if name in self.jobs:
+            raise ValueError(f'There is already a job called "{name}".')
+        self.jobs[name] = factory
+        if self.tasks and not self.stopping:
+            # already running, so start it straight away
+            self.tasks[name] = asyncio.ensure_future(self.supervise(name, factory))
+
+    async def supervise(self, name: str, factory: JobFactory):
+        loop = asyncio.get_event_loop()
+        delay = self.restart_delay
+        while True:
+            started_at = loop.time()
+            metrics.set_gauge('pixels_job_up', 1, job=name)
+            try:
+                await factory()
+            except asyncio.CancelledError:
+                metrics.set_gauge('pixels_job_up', 0, job=name)
+                raise
+            except Exception:
+                log.exception(f'Job {name} failed')
+            else:
+                metrics.set_gauge('pixels_job_up', 0, job=name)
+                log.info(f'Job {name} finished')
+                return
+
+            metrics.set_gauge('pixels_job_up', 0, job=name)
+            metrics.inc('pixels_job_restarts_total', job=name)
+            if loop.time() - started_at >= self.healthy_after:
+                delay = self.restart_delay
+            log.info(f'Restarting job {name} in {delay} seconds')
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.restart_delay_max)
+
+    async def run(self):
+        """Run every job until they have all finished or stop() is called."""
+        if self.stopping:
+            # stopped before it got going, or this is a second call after stop(), so just let the jobs clean up
+            await self.wait()
+            return
+        if not self.jobs:
+            log.warning('Nothing to run.')
+            return
+        for name, factory in self.jobs.items():
+            self.tasks[name] = asyncio.ensure_future(self.supervise(name, factory))
+        log.info(f'Running {", ".join(self.jobs)}.')
+        await self.wait()
+
+    async def wait(self):
+        """Wait for every running job to finish."""
+        # jobs added while running join self.tasks, so keep waiting until there are none left
+        while self.tasks:
+            tasks = list(self.tasks.values())
+            await asyncio.gather(*tasks, return_exceptions=True)
+            for name, task in list(self.tasks.items()):
+                if task.done():
+                    del self.tasks[name]
+
+    def stop(self):
+        """Cancel every job. run() returns once they have all cleaned up."""
+        if self.stopping:
+            return
+        self.stopping = True
+        log.info('Stopping.')
+        for task in self.tasks.values():
+            task.cancel()
+
+    def stop_on_signals(self, loop: asyncio.AbstractEventLoop):
+        """Stop gracefully on ctrl+c or a terminate signal, where the platform lets the loop handle signals."""
+        for signal_number in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(signal_number, self.stop)
+            except (NotImplementedError, RuntimeError):
+                # windows, main() catches KeyboardInterrupt instead
+                pass
@@ -0,0 +1,319 @@
+import argparse
+import collections
+import io
+import itertools
+import logging
+import os
+import struct
+import sys
+import zlib
+from concurrent.futures import Executor, Future, ProcessPoolExecutor
+from pathlib import Path
+from typing import Iterable, Iterator, Optional
+
+from PIL import Image
+
+from . import history
+from . import util
+from . import zone
+
+
+__version__ = '1.0.0'
+
+
+FORMATS = ('gif', 'apng', 'frames')
+FRAME_INTERVAL_SECONDS = 60
+FRAME_DURATION_MS = 50
+PALETTE_MAX_COLOURS = 256
+# frames being encoded at once per worker, so memory stays bounded however long the history is
+FRAMES_IN_FLIGHT_PER_WORKER = 4
+FRAME_NAME_FORMAT = 'frame_{index:06}.png'
+# zlib level for the pngs, lower is bigger but a lot faster
+COMPRESS_LEVEL = 3
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+
+log = logging.getLogger(__name__)
+
+
+def get_parser() -> argparse.ArgumentParser:
+    """Get this script's parser."""
+    parser = argparse.ArgumentParser(description='render a timelapse from a recorded canvas history')
+
+    parser.add_argument('--version', action='version', version=__version__)
+    parser.add_argument('output', type=Path, help='file to write, or folder for --format frames')
+    parser.add_argument('-i', '--input', type=Path, default=Path('canvas.log'), help='default %(default)s')
+    parser.add_argument('-f', '--format', choices=FORMATS, help='default from the output\'s suffix, or gif')
+    parser.add_argument(
+        '--interval', type=float, default=FRAME_INTERVAL_SECONDS,
+        help='seconds of history per frame, default %(default)s'
+    )
+    parser.add_argument(
+        '--duration', type=int, default=FRAME_DURATION_MS, help='milliseconds each frame shows, default %(default)s'
+    )
+    parser.add_argument('--start', type=float, help='unix timestamp to start at, default the start of the history')
+    parser.add_argument('--end', type=float, help='unix timestamp to end at, default the end of the history')
+    parser.add_argument('-z', '--zone', type=Path, help='crop to this zone\'s json')
+    parser.add_argument('-s', '--scale', type=int, default=1, help='default %(default)s')
+    parser.add_argument('-w', '--workers', type=int, help='processes encoding frames, default one per cpu')
+
+    return parser
+
+
+def get_frame_times(start: float, end: float, interval: float) -> Iterator[float]:
+    for index in itertools.count():
+        frame_time = start + index * interval
+        if frame_time > end:
+            return
+        yield frame_time
+
+
+def iter_frames(
+        canvas_history: history.CanvasHistory,
+        frame_times: Iterable[float],
+        box: Optional[tuple[int, int, int, int]] = None,
+        scale: int = 1,
+) -> Iterator[Image.Image]:
+    """Yield the canvas at each of the frame times, in order, replaying the history only once."""
+    frame_times = iter(frame_times)
+    first_time = next(frame_times, None)
+    if first_time is None or not len(canvas_history):
+        return
+
+    canvases = canvas_history.iter_canvases(first_time)
+    position = canvas_history.find(max(first_time, canvas_history.timestamps[0]))
+    _, canvas = next(canvases)
+    for frame_time in itertools.chain((first_time,), frame_times):
+        if frame_time >= canvas_history.timestamps[0]:
+            # catch up to the last record before the frame, without looking any further ahead
+            target = canvas_history.find(frame_time)
+            while position < target:
+                _, canvas = next(canvases)
+                position += 1
+
+        frame = canvas.crop(box) if box is not None else canvas.copy()
+        if scale != 1:
+            frame = util.scale_image(frame, scale, down=False)
+        yield frame
+
+
+def quantize(frame: Image.Image) -> Image.Image:
+    """Get a palette image, exactly when there are few enough colours."""
+    colours = frame.getcolors(PALETTE_MAX_COLOURS)
+    if colours is None:
+        return frame.quantize(PALETTE_MAX_COLOURS)
+    palette = Image.new('P', (1, 1))
+    palette.putpalette([channel for _, colour in colours for channel in colour[:3]])
+    return frame.quantize(palette=palette, dither=Image.NONE)
+
+
+def encode_gif_frame(frame: Image.Image, duration: int) -> bytes:
+    """Encode a frame as the blocks it takes up in an animated gif, with its own colour table.
+
+    Each frame is encoded on its own as a whole gif,
+    then the header is dropped and the global colour table becomes the frame's local one,
+    so the frames can be joined without the encoder seeing them all at once.
+    """
+    buffer = io.BytesIO()
+    quantize(frame).save(buffer, 'GIF')
+    data = buffer.getvalue()
+
+    # header, then the logical screen descriptor, then maybe a global colour table
+    packed = data[10]
+    offset = 13
+    colour_table = b''
+    if packed & 0x80:
+        table_length = 3 << ((packed & 0x07) + 1)
+        colour_table = data[offset:offset + table_length]
+        offset += table_length
+    # skip any extensions before the image
+    while data[offset] == 0x21:
+        offset += 2
+        while data[offset]:
+            offset += data[offset] + 1
+        offset += 1
+
+    descriptor = bytearray(data[offset:offset + 10])
+    if colour_table and not descriptor[9] & 0x80:
+        descriptor[9] = (descriptor[9] & 0x40) | 0x80 | (packed & 0x07)
+    image_data = data[offset + 10:data.rindex(b'\x3b')]
+
+    control = b'\x21\xf9\x04\x00' + struct.pack('<H', max(duration // 10, 1)) + b'\x00\x00'
+    return control + bytes(descriptor) + colour_table + image_data
+
+
+def get_gif_header(width: int, height: int) -> bytes:
+    # no global colour table, and loop forever
+    screen = b'GIF89a' + struct.pack('<HHBBB', width, height, 0, 0, 0)
+    return screen + b'\x21\xff\x0bNETSCAPE2.0\x03\x01\x00\x00\x00'
+
+
+def png_chunk(chunk_type: bytes, data: bytes) -> bytes:
+    return struct.pack('>I', len(data)) + chunk_type + data + struct.pack('>I', zlib.crc32(chunk_type + data))
+
+
+def encode_apng_frame(frame: Image.Image) -> bytes:
+    """Encode a frame as a png and return just its compressed image data, to go in the frame's data chunks."""
+    buffer = io.BytesIO()
+    frame.convert('RGB').save(buffer, 'PNG', compress_level=COMPRESS_LEVEL)
+    data = buffer.getvalue()
+
+    image_data = bytearray()
+    offset = len(PNG_SIGNATURE)
+    while offset < len(data):
+        length, chunk_type = struct.unpack_from('>I4s', data, offset)
+        if chunk_type == b'IDAT':
+            image_data += data[offset + 8:offset + 8 + length]
+        offset += length + 12
+    return bytes(image_data)
+
+
+def save_frame(frame: Image.Image, path: Path):
+    frame.save(path, compress_level=COMPRESS_LEVEL)
+
+
+class APNGWriter:
+    """Writes an animated png a frame at a time. The number of frames has to be known up front."""
+
+    def __init__(self, file, width: int, height: int, frame_count: int, duration: int):
+        self.file = file
+        self.width = width
+        self.height = height
+        self.duration = duration
+        self.sequence = 0
+        self.frame_index = 0
+
+        file.write(PNG_SIGNATURE)
+        # 8 bit truecolour
+        file.write(png_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)))
+        file.write(png_chunk(b'acTL', struct.pack('>II', frame_count, 0)))
+
+    def next_sequence(self) -> int:
+        sequence = self.sequence
+        self.sequence += 1
+        return sequence
+
+    def write(self, image_data: bytes):
+        control = struct.pack(
+            '>IIIIIHHBB', self.next_sequence(), self.width, self.height, 0, 0, self.duration, 1000, 0, 0
+        )
+        self.file.write(png_chunk(b'fcTL', control))
+        if self.frame_index == 0:
+            # the first frame doubles as the still image for viewers that don't animate
+            self.file.write(png_chunk(b'IDAT', image_data))
+        else:
+            self.file.write(png_chunk(b'fdAT', struct.pack('>I', self.next_sequence()) + image_data))
+        self.frame_index += 1
+
+    def close(self):
+        self.file.write(png_chunk(b'IEND', b''))
+
+
+def encode_frames(executor: Executor, encode, jobs: Iterable[tuple], max_in_flight: int) -> Iterator:
+    """Run encode over the jobs in the executor, yielding the results in order with at most max_in_flight at once."""
+    in_flight: collections.deque[Future] = collections.deque()
+    for job in jobs:
+        if len(in_flight) >= max_in_flight:
+            yield in_flight.popleft().result()
+        in_flight.append(executor.submit(encode, *job))
+    while in_flight:
+        yield in_flight.popleft().result()
+
+
+def render(
+        canvas_history: history.CanvasHistory,
+        output: Path,
+        output_format: str = 'gif',
+        interval: float = FRAME_INTERVAL_SECONDS,
+        duration: int = FRAME_DURATION_MS,
+        start: Optional[float] = None,
+        end: Optional[float] = None,
+        box: Optional[tuple[int, int, int, int]] = None,
+        scale: int = 1,
+        workers: Optional[int] = None,
+) -> int:
+    """Render the history between start and end to output, and return how many frames it took."""
+    if not len(canvas_history):
+        raise ValueError(f'There is no history in "{canvas_history.path}".')
+    if start is None:
+        start = canvas_history.timestamps[0]
+    if end is None:
+        end = canvas_history.timestamps[len(canvas_history) - 1]
+    frame_count = sum(1 for _ in get_frame_times(start, end, interval))
+    if not frame_count:
+        raise ValueError('The end is before the start.')
+
+    if box is None:
+        width, height = canvas_history.get_canvas(max(start, canvas_history.timestamps[0])).size
+    else:
+        width, height = box[2] - box[0], box[3] - box[1]
+    width, height = width * scale, height * scale
+
+    frames = iter_frames(canvas_history, get_frame_times(start, end, interval), box, scale)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    max_in_flight = workers * FRAMES_IN_FLIGHT_PER_WORKER
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        if output_format == 'frames':
+            output.mkdir(parents=True, exist_ok=True)
+            paths = (output / FRAME_NAME_FORMAT.format(index=index) for index in itertools.count())
+            for _ in encode_frames(executor, save_frame, zip(frames, paths), max_in_flight):
+                pass
+
+        elif output_format == 'apng':
+            with open(output, 'wb') as output_file:
+                writer = APNGWriter(output_file, width, height, frame_count, duration)
+                jobs = ((frame,) for frame in frames)
+                for image_data in encode_frames(executor, encode_apng_frame, jobs, max_in_flight):
+                    writer.write(image_data)
+                writer.close()
+
+        else:
+            with open(output, 'wb') as output_file:
+                output_file.write(get_gif_header(width, height))
+                jobs = ((frame, duration) for frame in frames)
+                for frame_bytes in encode_frames(executor, encode_gif_frame, jobs, max_in_flight):
+                    output_file.write(frame_bytes)
+                output_file.write(b'\x3b')
+
+    return frame_count
+
+
+def main():
+    """Render a timelapse from the command line."""
+    parser = get_parser()
+    args = parser.parse_args()
+
+    output_format = args.format
+    if output_format is None:
+        output_format = {'.png': 'apng', '.apng': 'apng', '': 'frames'}.get(args.output.suffix, 'gif')
+
+    box = None
+    if args.zone is not None:
+        z = zone.Zone(args.zone)
+        x, y = z.coords
+        box = (x, y, x + z.width, y + z.height)
+
+    canvas_history = history.CanvasHistory(args.input)
+    try:
+        frame_count = render(
+            canvas_history, args.output, output_format,
+            interval=args.interval,
+            duration=args.duration,
+            start=args.start,
+            end=args.end,
+            box=box,
+            scale=args.scale,
+            workers=args.workers,
+        )
+    except ValueError as error:
+        print(error, file=sys.stderr)
+        sys.exit(1)
+    finally:
+        canvas_history.close()
+    log.info(f'Rendered {frame_count} frames to "{args.output}".')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,23 @@
+import re
 from typing import Union
+
 from PIL import Image
 
 
+NONZERO_BYTE = re.compile(rb'[^\x00]')
+
+
 def rgb_to_hex(rgb_ints: Union[list[int], bytes], prefix: str = '#') -> str:
     """Take a list of ints and convert it to a colour e.g. [255, 255, 255] -> ffffff."""
     return '{prefix}{:02x}{:02x}{:02x}'.format(*rgb_ints, prefix=prefix)
 
 
+def hex_to_rgb(hex_str: str) -> list[int]:
+    """Take a colour and convert it to a list of ints e.g. ffffff -> [255, 255, 255]."""
+    hex_str = hex_str.removeprefix('#')
+    return list(bytes.fromhex(hex_str))
+
+
 def bytes_to_image(image_bytes: bytes, width: int, height: int) -> Image.Image:
     return Image.frombytes(
         mode='RGB',
@@ -28,3 +39,15 @@ def scale_image(image: Image.Image, scale: int, down: bool = True) -> Image.Imag
             image.height * scale
         )
     return image.resize(size=new_size, resample=Image.NEAREST)
+
+
+def binary_mask(image: Image.Image) -> Image.Image:
+    """Turn a single band image into a mask that is 255 wherever it isn't 0."""
+    return image.point(lambda v: 255 if v else 0)
+
+
+def mask_indices(mask: Image.Image) -> list[int]:
+    """Get the flat indices of every set pixel in a mask, without visiting the unset ones in python."""
+    if mask.getbbox() is None:
+        return []
+    return [match.start() for match in NONZERO_BYTE.finditer(mask.tobytes())]
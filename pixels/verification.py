@@ -0,0 +1,182 @@
+import asyncio
+import logging
+import math
+import random
+from typing import Optional
+
+from . import diff
+from . import hotspots
+from . import metrics
+from . import zone
+from .api import APIBase
+from .api._base import Pixel
+
+
+# until there's evidence, assume a wrong pixel gets fixed by someone else about once every couple of hours,
+# weighted like a few minutes of evidence so real evidence soon outweighs it
+PRIOR_FIXED = 0.05
+PRIOR_EXPOSURE_SECONDS = 300
+# evidence this much older counts for half as much
+EVIDENCE_HALF_LIFE_SECONDS = 600
+# what a request is assumed to cost before any have been timed
+DEFAULT_REQUEST_SECONDS = 0.1
+# how much each new timing moves the average cost of a request, once there have been a few
+COST_SMOOTHING = 0.1
+# verify this share of the pixels that wouldn't be worth it anyway, so the estimates keep learning,
+# unless it would mean downloading the canvas
+EXPLORE_RATIO = 0.05
+
+READ_LIVE = 'live'
+READ_PIXEL = 'pixel'
+READ_CANVAS = 'canvas'
+WRITE = 'set'
+
+
+log = logging.getLogger(__name__)
+
+
+class VerificationPolicy:
+    """Decides whether to read a pixel before writing it, by whether the read is likely to pay for itself.
+
+    A pixel that was wrong in a snapshot t seconds older than what a read would see has been fixed by someone else
+    with probability 1 - exp(-rate * t), where the rate is learned from what earlier reads found,
+    and is higher in tiles the hotspot tracker knows are busy.
+    Reading is worth it when that probability times the cost of a write beats the cost of the read.
+    Costs are the average seconds a request of each kind takes, rate limit waits included,
+    so reads and writes are budgeted separately even when they share a rate limit.
+    """
+
+    def __init__(
+            self,
+            api_instance: APIBase,
+            hotspot_tracker: Optional[hotspots.HotspotTracker] = None,
+            explore_ratio: float = EXPLORE_RATIO,
+            rng: Optional[random.Random] = None,
+    ):
+        self.api_instance = api_instance
+        self.hotspots = hotspot_tracker
+        self.explore_ratio = explore_ratio
+        self.rng = rng if rng is not None else random.Random()
+
+        # decayed counts of pixels found already fixed, and the seconds of staleness they were checked over
+        self.fixed = 0.0
+        self.exposure = 0.0
+        self.updated_at = self.time()
+        self.costs = {kind: DEFAULT_REQUEST_SECONDS for kind in (READ_PIXEL, READ_CANVAS, WRITE)}
+        self.timings = {kind: 0 for kind in self.costs}
+
+    @staticmethod
+    def time() -> float:
+        return asyncio.get_event_loop().time()
+
+    def get_snapshot_time(self) -> float:
+        """When the canvas a diff would be worked out from was true."""
+        cache = self.api_instance.canvas_cache
+        return self.time() if cache.live else cache.fetched_at
+
+    def get_read(self) -> tuple[str, float, float]:
+        """What reading a pixel now would cost: the kind of request, when what it returns was true, and seconds."""
+        cache = self.api_instance.canvas_cache
+        if cache.live:
+            # kept up to date by live updates, so it's as good as asking
+            return READ_LIVE, self.time(), 0.0
+        if self.api_instance.direct_pixel_reads:
+            return READ_PIXEL, self.time(), self.costs[READ_PIXEL]
+        if cache.age <= cache.max_age:
+            # straight out of the cached canvas, for free
+            return READ_CANVAS, cache.fetched_at, 0.0
+        return READ_CANVAS, self.time(), self.costs[READ_CANVAS]
+
+    def get_fix_rate(self, x: int, y: int) -> float:
+        """How often a wrong pixel here gets fixed by someone else, per second."""
+        self.decay()
+        rate = (self.fixed + PRIOR_FIXED) / (self.exposure + PRIOR_EXPOSURE_SECONDS)
+        if self.hotspots is not None:
+            # busy tiles are busy for everyone, whoever is winning
+            rate *= 1 + self.hotspots.get_heat(x, y)
+        return rate
+
+    def get_fixed_probability(self, x: int, y: int, staleness: float) -> float:
+        return 1 - math.exp(-self.get_fix_rate(x, y) * staleness)
+
+    def should_verify(self, x: int, y: int, snapshot_at: float) -> bool:
+        """Whether to read a pixel that was wrong in the snapshot from snapshot_at before writing it."""
+        kind, read_at, read_cost = self.get_read()
+        staleness = read_at - snapshot_at
+        if staleness <= 0:
+            # it would only see the same snapshot again
+            return False
+        if self.get_fixed_probability(x, y, staleness) * self.costs[WRITE] > read_cost:
+            return True
+        if kind == READ_CANVAS and read_cost:
+            # downloading the whole canvas is too much to pay just to learn from one pixel
+            return False
+        return self.rng.random() < self.explore_ratio
+
+    def decay(self):
+        now = self.time()
+        factor = 2 ** (-(now - self.updated_at) / EVIDENCE_HALF_LIFE_SECONDS)
+        self.fixed *= factor
+        self.exposure *= factor
+        self.updated_at = now
+
+    def record_cost(self, kind: str, seconds: float):
+        self.timings[kind] += 1
+        # a plain average of the first few, so the default is forgotten straight away
+        smoothing = max(COST_SMOOTHING, 1 / self.timings[kind])
+        self.costs[kind] += (seconds - self.costs[kind]) * smoothing
+
+    def record_verified(
+            self,
+            x: int,
+            y: int,
+            z: zone.Zone,
+            staleness: float,
+            previous: Pixel,
+            current: Pixel,
+            target: tuple[int, int, int],
+    ):
+        """Learn from what a read found, given what the snapshot said and what the zone wants."""
+        self.decay()
+        self.exposure += staleness
+        if diff.is_correct(z, current, target):
+            self.fixed += 1
+        elif tuple(current[:3]) != tuple(previous[:3]) and self.hotspots is not None:
+            # overwritten again since the snapshot, and still wrong
+            self.hotspots.record_damage(x, y, current)
+
+    async def read(self, kind: str, x: int, y: int) -> Pixel:
+        if kind == READ_PIXEL:
+            return await self.api_instance.get_pixel(x, y)
+        # from the cached canvas, downloading a new one first if it's too old
+        canvas = await self.api_instance.canvas_cache.get()
+        return canvas.getpixel((x, y))
+
+    async def verify(
+            self,
+            x: int,
+            y: int,
+            z: zone.Zone,
+            previous: Pixel,
+            target: tuple[int, int, int],
+            snapshot_at: float,
+    ) -> Pixel:
+        """Read a pixel that was previous in the snapshot from snapshot_at, learning what it cost and what it found."""
+        kind, read_at, cost = self.get_read()
+        started_at = self.time()
+        current = await self.read(kind, x, y)
+        metrics.inc('pixels_verified_total')
+        if kind == READ_LIVE:
+            # anyone else's fix was heard about as it happened, so this says nothing about how often that is
+            return current
+        if cost:
+            self.record_cost(kind, self.time() - started_at)
+        self.record_verified(x, y, z, read_at - snapshot_at, previous, current, target)
+        return current
+
+    async def write(self, x: int, y: int, colour: tuple[int, int, int], priority: float = 0) -> bool:
+        """Set a pixel, learning what it cost."""
+        started_at = self.time()
+        success = await self.api_instance.set_pixel(x=x, y=y, colour=colour, priority=priority)
+        self.record_cost(WRITE, self.time() - started_at)
+        return success
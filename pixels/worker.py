@@ -0,0 +1,90 @@
+import argparse
+import asyncio
+import logging
+import signal
+from pathlib import Path
+from typing import Optional, Union
+
+from . import IMAGES_FOLDER
+from . import coordinator
+from . import palette
+from . import run_protections
+from . import supervisor
+from . import zone
+from .api.coordinated import APICoordinated, parse_address
+
+
+__version__ = '1.0.0'
+
+
+log = logging.getLogger(__name__)
+
+
+def get_parser() -> argparse.ArgumentParser:
+    """Get this script's parser."""
+    parser = argparse.ArgumentParser(
+        description='protect one shard of the zones, placing pixels through a coordinator'
+    )
+
+    parser.add_argument('--version', action='version', version=__version__)
+    parser.add_argument('coordinator', help='host:port of the coordinator')
+    parser.add_argument('--shard', type=int, default=0, help='which shard to protect, from 0, default %(default)s')
+    parser.add_argument('--shards', type=int, default=1, help='how many shards the zones are split into')
+    parser.add_argument('--images', type=Path, default=IMAGES_FOLDER, help='default %(default)s')
+    parser.add_argument('--checkpoint', type=Path, help='save and resume the repair queue here')
+
+    return parser
+
+
+async def run(
+        api_instance: APICoordinated,
+        shard: int,
+        shards: int,
+        images_folder: Union[str, Path] = IMAGES_FOLDER,
+        checkpoint_path: Optional[Union[str, Path]] = None,
+):
+    """Protect this worker's shard of the zones until the coordinator goes away."""
+    zone_palette = None
+    if api_instance.palette is not None:
+        zone_palette = palette.Palette(api_instance.palette)
+    zones = zone.load_zones(images_folder, zone_palette, api_instance.dither)
+    zones_to_do = coordinator.shard_zones(zones, shards)[shard]
+    if not zones_to_do:
+        log.warning(f'Shard {shard} of {shards} has no zones, there are only {len(zones)}')
+        return
+    log.info(f'Shard {shard} of {shards}: {", ".join(z.name for z in zones_to_do)}')
+
+    await supervisor.run_together(
+        api_instance.listen(),
+        api_instance.report([z.name for z in zones_to_do]),
+        run_protections(zones_to_do, api_instance, api_instance.updates, checkpoint_path),
+    )
+
+
+def main():
+    """Connect to the coordinator and protect a shard until it goes away."""
+    parser = get_parser()
+    args = parser.parse_args()
+    if not 0 <= args.shard < args.shards:
+        parser.error(f'--shard should be from 0 to {args.shards - 1}.')
+
+    host, port = parse_address(args.coordinator)
+    api_instance = APICoordinated(host, port, name=f'{args.shard}/{args.shards}')
+    loop = api_instance.loop
+    task = asyncio.ensure_future(run(api_instance, args.shard, args.shards, args.images, args.checkpoint))
+    # stopped by the coordinator or ctrl+c in the same terminal, either way save the checkpoint first
+    for signal_number in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(signal_number, task.cancel)
+        except NotImplementedError:
+            pass
+    try:
+        loop.run_until_complete(task)
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        log.info('Stopping.')
+    finally:
+        loop.run_until_complete(api_instance.close())
+
+
+if __name__ == '__main__':
+    main()
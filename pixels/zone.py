@@ -1,13 +1,20 @@
+import array
+import hashlib
 import json
 import logging
+import mmap
+import os
 from pathlib import Path
-from typing import Union
+from typing import Optional, Union
 
 from PIL import Image
 from . import util
+from .palette import Palette
 
 
 IMAGES_FOLDER = Path('images')
+ZONE_CACHE_FOLDER = IMAGES_FOLDER / 'ignore' / 'zone_cache'
+ZONE_CACHE_MAGIC = b'PIXZONE1\n'
 Image2D = list[list[str]]
 
 log = logging.getLogger(__name__)
@@ -16,13 +23,25 @@ log = logging.getLogger(__name__)
 class Zone:
     """An area of pixels on the canvas, to be maintained."""
 
-    def __init__(self, json_path: Union[str, Path]):
-        """Load a zone from its json definition file."""
+    def __init__(
+            self,
+            json_path: Union[str, Path],
+            cache_folder: Optional[Union[str, Path]] = ZONE_CACHE_FOLDER,
+            palette: Optional[Palette] = None,
+            dither: bool = False,
+    ):
+        """Load a zone from its json definition file, compiling it into the cache folder if it isn't already there.
+
+        With a palette, the image is mapped onto the palette's colours, dithered or to the nearest colour.
+        """
         json_path = Path(json_path)
         self.json_path = json_path
+        self.palette = palette
+        self.dither = dither
 
-        with open(json_path) as json_file:
-            zone_definition = json.load(json_file)
+        with open(json_path, 'rb') as json_file:
+            json_bytes = json_file.read()
+        zone_definition = json.loads(json_bytes)
         try:
             self.name = zone_definition['name']
             self.image_path = IMAGES_FOLDER / zone_definition['image']
@@ -32,24 +51,39 @@ class Zone:
             raise ValueError(
                 f'The metadata "{error.args[0]}" is missing from the zone "{json_path.name}".'
             ) from error
+        # how much this zone matters compared to the others when choosing what to repair first
+        self.weight = zone_definition.get('weight', 1)
+        if self.weight <= 0:
+            raise ValueError(f'The weight of the zone "{json_path.name}" must be positive.')
+        # which zone gets the pixels where zones overlap, the highest wins
+        self.priority = zone_definition.get('priority', 0)
+
+        image_stat = self.image_path.stat()
+        cache_key = hashlib.sha256(json_bytes)
+        cache_key.update(f'{image_stat.st_mtime_ns}:{image_stat.st_size}'.encode())
+        if palette is not None:
+            cache_key.update(f'{palette.key}:{dither}'.encode())
+        self.cache_key = cache_key.hexdigest()
+
+        # packed RGBA, one bit per pixel for opacity, and the flat x, y pairs of the opaque pixels
+        self.image: Image.Image
+        # and with a palette, the index of each pixel's colour in it
+        self.indices: Optional[Image.Image] = None
+        self.opacity_bitmask: Union[bytes, memoryview]
+        self.opaque_coords: memoryview
+        self._mmap: Optional[mmap.mmap] = None
+
+        cache_path = None
+        if cache_folder is not None:
+            cache_path = Path(cache_folder) / f'{json_path.stem}.zone'
+        if cache_path is None or not self.load_cache(cache_path):
+            self.compile()
+            if cache_path is not None:
+                self.save_cache(cache_path)
 
-        image = Image.open(self.image_path)
-        image = image.convert('RGBA')
-        self.image_unscaled = image
-        if self.scale != 1:
-            self.image = util.scale_image(self.image_unscaled, self.scale)
-        else:
-            self.image = self.image_unscaled
         self.width, self.height = self.image.size
         self.area = self.width * self.height
-
-        area_opaque = self.area
-        for y in range(self.image.height):
-            for x in range(self.image.width):
-                pixel = self.image.getpixel((x, y))
-                if pixel[3]:
-                    area_opaque -= 1
-        self.area_opaque = area_opaque
+        self.area_opaque = len(self.opaque_coords) // 2
 
         log.info(
             f'Loaded zone {self.name}\n'
@@ -58,14 +92,118 @@ class Zone:
             f'    area:   {self.area}'
         )
 
+    @property
+    def image_unscaled(self) -> Image.Image:
+        return Image.open(self.image_path).convert('RGBA')
+
+    def compile(self):
+        """Work out everything about the zone from its image."""
+        image = self.image_unscaled
+        if self.scale != 1:
+            image = util.scale_image(image, self.scale)
+        if self.palette is not None:
+            self.indices = self.palette.to_indices(image, self.dither)
+            alpha = image.getchannel('A')
+            image = self.palette.to_rgb(self.indices)
+            image.putalpha(alpha)
+        self.image = image
+
+        opaque = util.binary_mask(image.getchannel('A'))
+        self.opacity_bitmask = opaque.convert('1').tobytes()
+        opaque_coords = array.array('H')
+        for index in util.mask_indices(opaque):
+            index_y, index_x = divmod(index, image.width)
+            opaque_coords.extend((index_x, index_y))
+        self.opaque_coords = memoryview(opaque_coords)
+
+    def save_cache(self, cache_path: Path):
+        """Write the compiled zone to the cache, replacing it in one go so a reader never sees half a file."""
+        image_bytes = self.image.tobytes()
+        coords_bytes = self.opaque_coords.tobytes()
+        indices_bytes = self.indices.tobytes() if self.indices is not None else b''
+        header = {
+            'key': self.cache_key,
+            'width': self.image.width,
+            'height': self.image.height,
+            'image_length': len(image_bytes),
+            'bitmask_length': len(self.opacity_bitmask),
+            'coords_length': len(coords_bytes),
+            'indices_length': len(indices_bytes),
+        }
+
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = cache_path.with_suffix('.tmp')
+        with open(temp_path, 'wb') as cache_file:
+            cache_file.write(ZONE_CACHE_MAGIC)
+            cache_file.write(json.dumps(header).encode() + b'\n')
+            cache_file.write(image_bytes)
+            cache_file.write(self.opacity_bitmask)
+            cache_file.write(coords_bytes)
+            cache_file.write(indices_bytes)
+        os.replace(temp_path, cache_path)
+        log.debug(f'Cached zone {self.name} to {cache_path}')
+
+    def load_cache(self, cache_path: Path) -> bool:
+        """Memory map the compiled zone from the cache, and return whether it was there and up to date."""
+        try:
+            with open(cache_path, 'rb') as cache_file:
+                cache_mmap = mmap.mmap(cache_file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (FileNotFoundError, ValueError):
+            return False
+
+        header_end = cache_mmap.find(b'\n', len(ZONE_CACHE_MAGIC))
+        if cache_mmap[:len(ZONE_CACHE_MAGIC)] != ZONE_CACHE_MAGIC or header_end == -1:
+            cache_mmap.close()
+            return False
+        try:
+            header = json.loads(cache_mmap[len(ZONE_CACHE_MAGIC):header_end])
+            key = header['key']
+            size = (int(header['width']), int(header['height']))
+            lengths = [int(header[name]) for name in ('image_length', 'bitmask_length', 'coords_length')]
+            lengths.append(int(header.get('indices_length', 0)))
+        except (ValueError, KeyError, TypeError):
+            # garbled, which is as good as not there
+            cache_mmap.close()
+            return False
+        image_length, bitmask_length, coords_length, indices_length = lengths
+        if (
+                key != self.cache_key
+                or image_length != size[0] * size[1] * 4
+                or coords_length % 2
+                or indices_length not in (0, size[0] * size[1])
+                or min(lengths) < 0
+        ):
+            cache_mmap.close()
+            return False
+
+        view = memoryview(cache_mmap)
+        image_start = header_end + 1
+        bitmask_start = image_start + image_length
+        coords_start = bitmask_start + bitmask_length
+        coords_end = coords_start + coords_length
+        indices_end = coords_end + indices_length
+        if len(cache_mmap) < indices_end:
+            view.release()
+            cache_mmap.close()
+            return False
+
+        # shares the mapped memory instead of copying it
+        self.image = Image.frombuffer('RGBA', size, view[image_start:bitmask_start], 'raw', 'RGBA', 0, 1)
+        self.opacity_bitmask = view[bitmask_start:coords_start]
+        self.opaque_coords = view[coords_start:coords_end].cast('H')
+        if indices_end > coords_end:
+            self.indices = Image.frombuffer('L', size, view[coords_end:indices_end], 'raw', 'L', 0, 1)
+        self._mmap = cache_mmap
+        return True
+
 
-def load_zones(directory: Union[str, Path]) -> list[Zone]:
+def load_zones(directory: Union[str, Path], palette: Optional[Palette] = None, dither: bool = False) -> list[Zone]:
     """Load zones that match img_names from directory and return them."""
     directory = Path(directory)
     zones = []
 
     for path in directory.iterdir():
         if path.is_file() and path.suffix == '.json':
-            zones.append(Zone(path))
+            zones.append(Zone(path, palette=palette, dither=dither))
 
     return zones